@@ -0,0 +1,162 @@
+# HOW TO MEASURE WHAT RAW psycopg2, SQLAlchemy CORE & THE ORM EACH COST.
+
+# sql-psycopg2.py, sql-expression.py & sql-orm.py run the same six queries
+# three different ways. This script runs all six through all three paths,
+# with a warm connection pool (connections are reused) & a cold one (every
+# call opens a new connection), on the normal "Track" table & on copies of
+# it scaled up 10x & 100x, and reports the p50/p99 latency, the rows per
+# second & how many bytes of Python memory each returned row costs.
+# NOTE: the scaled runs add extra rows to "Track" & delete them again
+# afterwards, so only run this against a database you can rebuild.
+import argparse
+import time
+import tracemalloc
+
+from sqlalchemy.orm import sessionmaker
+
+from sql_connection import close_all, connection, get_engine
+from sql_models import Album, Artist, Track
+from sql_queries import QUERIES
+from sql_scaling import scale_tracks, unscale_tracks
+
+
+DEFAULT_ITERATIONS = 200
+DEFAULT_SCALES = [1, 10, 100]
+
+# The Core Table objects behind our ORM models, so the Core path queries
+# exactly the same tables & columns.
+artist_table = Artist.__table__
+album_table = Album.__table__
+track_table = Track.__table__
+
+# The six queries the way sql-expression.py writes them.
+CORE_STATEMENTS = {
+    "all_artists": artist_table.select(),
+    "artist_names": artist_table.select().with_only_columns(
+        [artist_table.c.Name]),
+    "artist_by_name": artist_table.select().where(
+        artist_table.c.Name == "Queen"),
+    "artist_by_id": artist_table.select().where(
+        artist_table.c.ArtistId == 51),
+    "albums_by_artist": album_table.select().where(
+        album_table.c.ArtistId == 51),
+    "tracks_by_composer": track_table.select().where(
+        track_table.c.Composer == "Queen"),
+}
+
+# The six queries the way sql-orm.py writes them. Each one takes a session
+# & returns a list of results so we can count the rows.
+ORM_QUERIES = {
+    "all_artists": lambda session: session.query(Artist).all(),
+    "artist_names": lambda session: session.query(Artist).all(),
+    "artist_by_name": lambda session: [
+        session.query(Artist).filter_by(Name="Queen").first()],
+    "artist_by_id": lambda session: [
+        session.query(Artist).filter_by(ArtistId=51).first()],
+    "albums_by_artist": lambda session: session.query(Album).filter_by(
+        ArtistId=51).all(),
+    "tracks_by_composer": lambda session: session.query(Track).filter_by(
+        Composer="Queen").all(),
+}
+
+
+def run_psycopg2(name):
+    query, params = QUERIES[name]
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        return cursor.fetchall()
+
+
+def run_core(name):
+    with get_engine().connect() as conn:
+        return conn.execute(CORE_STATEMENTS[name]).fetchall()
+
+
+def run_orm(name):
+    session = sessionmaker(get_engine())()
+    try:
+        return ORM_QUERIES[name](session)
+    finally:
+        session.close()
+
+
+PATHS = {"psycopg2": run_psycopg2, "core": run_core, "orm": run_orm}
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[round(fraction * (len(ordered) - 1))]
+
+
+# Time 'iterations' calls of one query through one path. With a cold pool,
+# every pooled connection is closed before each call so it has to connect
+# again, which is what a script that connects on every run pays.
+def benchmark(run, name, iterations, warm):
+    run(name)
+    timings = []
+    rows = 0
+    for _ in range(iterations):
+        if not warm:
+            close_all()
+        started = time.perf_counter()
+        rows += len(run(name))
+        timings.append(time.perf_counter() - started)
+
+    # Measure memory on a separate call, since tracing every allocation
+    # would slow down the timed calls above.
+    tracemalloc.start()
+    row_count = len(run(name))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return (
+        percentile(timings, 0.5),
+        percentile(timings, 0.99),
+        rows / sum(timings),
+        peak / row_count if row_count else 0,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark psycopg2, SQLAlchemy Core & the ORM.")
+    parser.add_argument(
+        "--iterations", type=int, default=DEFAULT_ITERATIONS)
+    parser.add_argument(
+        "--scales", type=int, nargs="+", default=DEFAULT_SCALES)
+    parser.add_argument(
+        "--paths", nargs="+", choices=list(PATHS), default=list(PATHS))
+    parser.add_argument(
+        "--queries", nargs="+", choices=list(QUERIES), default=list(QUERIES))
+    args = parser.parse_args()
+
+    print(
+        "Scale", "Pool", "Path", "Query", "p50 ms", "p99 ms", "Rows/s",
+        "Bytes/row", sep=" | ")
+    for scale in args.scales:
+        offset = scale_tracks(scale) if scale > 1 else None
+        try:
+            for warm in (True, False):
+                for path in args.paths:
+                    for name in args.queries:
+                        p50, p99, rows_per_second, bytes_per_row = benchmark(
+                            PATHS[path], name, args.iterations, warm)
+                        print(
+                            "{}x".format(scale),
+                            "warm" if warm else "cold",
+                            path,
+                            name,
+                            "{:.3f}".format(p50 * 1000),
+                            "{:.3f}".format(p99 * 1000),
+                            "{:.0f}".format(rows_per_second),
+                            "{:.0f}".format(bytes_per_row),
+                            sep=" | "
+                        )
+        finally:
+            if offset is not None:
+                unscale_tracks(offset)
+    close_all()
+
+# command to type at the terminal in order to run our code is:
+# python3 sql-benchmark.py --iterations 100 --scales 1 10
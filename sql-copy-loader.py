@@ -0,0 +1,207 @@
+# HOW TO BULK LOAD THE CHINOOK DATABASE USING psycopg2's "COPY FROM STDIN".
+
+# Running "psql -f Chinook_PostgreSql.sql" sends about 15,500 separate
+# INSERT statements to the server. Each one is parsed, planned and
+# round-tripped on its own, and because the foreign keys & their indexes
+# are created before the data, every single row also has to update those
+# indexes & check those constraints one at a time.
+# This script parses the dump file ONCE in Python, then streams every table
+# to Postgres with a single COPY per table, and only builds the "IFK_*"
+# indexes & "FK_*" constraints once all of the data is in.
+import argparse
+import io
+import re
+import time
+
+import psycopg2
+
+
+# The dump file that sits next to this script. It was saved with the
+# Latin-1 (ISO-8859-1) encoding, so that's what we need to read it with.
+DUMP_FILE = "Chinook_PostgreSql.sql"
+DUMP_ENCODING = "latin-1"
+
+# Regular expressions used to pull the pieces we need out of the dump.
+# CREATE TABLE "Album" ( ... );  ->  the table name & its column block.
+CREATE_TABLE_RE = re.compile(r'CREATE TABLE "(\w+)"\s*\((.*?)\)\s*$', re.S)
+# "AlbumId" INT NOT NULL,  ->  the column name at the start of a line.
+COLUMN_RE = re.compile(r'^\s*"(\w+)"', re.M)
+# INSERT INTO "Genre" ("GenreId", "Name") VALUES (1, N'Rock');
+INSERT_RE = re.compile(
+    r'^INSERT INTO "(\w+)" \((.*?)\) VALUES \((.*)\);\s*$')
+# A single value within the VALUES (...) list. This is either a (possibly
+# N-prefixed) quoted string with '' as an escaped quote, NULL, or a bare
+# number/literal.
+VALUE_RE = re.compile(
+    r"\s*(?:N?'((?:[^']|'')*)'|(NULL)|([^,\s]+))\s*(?:,|$)")
+# Any /* ... */ block comment between the DDL statements.
+COMMENT_RE = re.compile(r"/\*.*?\*/", re.S)
+
+
+# Split the VALUES (...) part of an INSERT statement into a list of Python
+# strings (or None for NULL). We keep numbers as text since COPY will
+# convert them into the right column type on the server for us.
+def parse_values(text):
+    values = []
+    position = 0
+    while position < len(text):
+        match = VALUE_RE.match(text, position)
+        if match is None:
+            raise ValueError("Cannot parse VALUES list: " + text)
+        string, null, literal = match.groups()
+        if string is not None:
+            values.append(string.replace("''", "'"))
+        elif null is not None:
+            values.append(None)
+        else:
+            values.append(literal)
+        position = match.end()
+    return values
+
+
+# Read the whole dump once & sort everything into three buckets:
+#   tables      - {table name: [column names]} in the order they're created.
+#   rows        - {table name: [row tuples]} in the table's column order.
+#   constraints - the ALTER TABLE/CREATE INDEX statements to run at the end.
+def parse_dump(path):
+    tables = {}
+    rows = {}
+    create_statements = []
+    constraints = []
+    ddl_lines = []
+
+    with open(path, encoding=DUMP_ENCODING) as dump:
+        for line in dump:
+            match = INSERT_RE.match(line)
+            if match is None:
+                # Not a row, so it's part of the schema (or a comment).
+                ddl_lines.append(line)
+                continue
+            # The schema is always defined before the first INSERT, so we
+            # can parse the DDL we've collected so far as soon as we hit it.
+            if ddl_lines:
+                parse_ddl(
+                    "".join(ddl_lines), tables, create_statements,
+                    constraints)
+                ddl_lines = []
+
+            table, column_list, value_list = match.groups()
+            columns = re.findall(r'"(\w+)"', column_list)
+            values = parse_values(value_list)
+            if len(columns) != len(values):
+                raise ValueError("Column/value mismatch: " + line)
+            # Some INSERTs leave out columns that are NULL, so we line each
+            # row up against the full column list from CREATE TABLE.
+            record = dict(zip(columns, values))
+            rows.setdefault(table, []).append(
+                tuple(record.get(column) for column in tables[table]))
+
+    if ddl_lines:
+        parse_ddl("".join(ddl_lines), tables, create_statements, constraints)
+    return tables, rows, create_statements, constraints
+
+
+# Split a block of DDL text into single statements & file them under
+# "create the table now" or "build this once the data is loaded".
+def parse_ddl(text, tables, create_statements, constraints):
+    for statement in COMMENT_RE.sub("", text).split(";"):
+        statement = statement.strip()
+        if not statement:
+            continue
+        match = CREATE_TABLE_RE.match(statement)
+        if match is not None:
+            table, body = match.groups()
+            tables[table] = COLUMN_RE.findall(body)
+            create_statements.append((table, statement))
+        else:
+            constraints.append(statement)
+
+
+# Turn one Python value into the COPY text format, where NULL is written
+# as \N & backslashes, tabs and newlines need to be escaped.
+def copy_field(value):
+    if value is None:
+        return "\\N"
+    return (
+        value.replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+# Stream every row of one table through a single COPY & report how long
+# it took. The rows are written to an in-memory file object first, which
+# is what psycopg2's copy_expert() reads from.
+def copy_table(cursor, table, columns, table_rows):
+    buffer = io.StringIO()
+    for row in table_rows:
+        buffer.write("\t".join(copy_field(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+
+    column_list = ", ".join('"{}"'.format(column) for column in columns)
+    started = time.perf_counter()
+    cursor.copy_expert(
+        'COPY "{}" ({}) FROM STDIN'.format(table, column_list), buffer)
+    return time.perf_counter() - started
+
+
+def load(connection, path):
+    tables, rows, create_statements, constraints = parse_dump(path)
+    cursor = connection.cursor()
+
+    # Everything happens in one transaction. Creating & filling a table in
+    # the same transaction also lets Postgres skip a lot of WAL writing.
+    total_started = time.perf_counter()
+    for table, statement in create_statements:
+        cursor.execute('DROP TABLE IF EXISTS "{}" CASCADE'.format(table))
+        cursor.execute(statement)
+
+    print("Table", "Rows", "Seconds", "Rows/s", sep=" | ")
+    for table, table_rows in rows.items():
+        elapsed = copy_table(cursor, table, tables[table], table_rows)
+        print(
+            table,
+            len(table_rows),
+            "{:.4f}".format(elapsed),
+            "{:.0f}".format(len(table_rows) / elapsed if elapsed else 0),
+            sep=" | "
+        )
+
+    # Now that all of the data is in, build the indexes & check the
+    # foreign keys in one pass per table instead of once per row.
+    started = time.perf_counter()
+    for statement in constraints:
+        cursor.execute(statement)
+    print("Indexes & constraints: {:.4f}s".format(
+        time.perf_counter() - started))
+
+    # Refresh the planner statistics so the first queries against the new
+    # tables get sensible plans.
+    started = time.perf_counter()
+    cursor.execute("ANALYZE")
+    print("ANALYZE: {:.4f}s".format(time.perf_counter() - started))
+
+    connection.commit()
+    total_rows = sum(len(table_rows) for table_rows in rows.values())
+    total = time.perf_counter() - total_started
+    print("Loaded {} rows in {:.4f}s ({:.0f} rows/s)".format(
+        total_rows, total, total_rows / total if total else 0))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Rebuild the Chinook database using COPY.")
+    parser.add_argument("dump", nargs="?", default=DUMP_FILE)
+    parser.add_argument("--database", default="chinook")
+    args = parser.parse_args()
+
+    connection = psycopg2.connect(database=args.database)
+    try:
+        load(connection, args.dump)
+    finally:
+        connection.close()
+
+# command to type at the terminal in order to run our code is:
+# python3 sql-copy-loader.py
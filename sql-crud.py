@@ -1,27 +1,19 @@
 # HOW TO PERFORM 'CR' OF CRUD FUNCTIONALITY USING THE "SQLAlchemy" ORM.
 
-from sqlalchemy import (
-    create_engine, Column, Integer, String
-)
-from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
-
-# executing the instructions from our localhost "chinook" db.
-db = create_engine("postgresql:///chinook")
-base = declarative_base()
+from sql_connection import get_engine
+from sql_instrumentation import instrument_engine
+# The class-based model for the "Programmer" table lives in sql_models.py
+# along with our other models, so the bulk CRUD helpers can share it.
+from sql_models import Programmer
 
 
-# Create a class-based model for the "Programmer" table.
-class Programmer(base):
-    # The __tablename__ will match the class itself, "Programmer".
-    __tablename__ = "Programmer"
-    id = Column(Integer, primary_key=True)
-    first_name = Column(String)
-    last_name = Column(String)
-    gender = Column(String)
-    nationality = Column(String)
-    famous_for = Column(String)
+# executing the instructions from our localhost "chinook" db.
+# The engine (and its connection pool) is shared by all of our scripts.
+db = get_engine()
+# Record how long every statement takes, see sql_instrumentation.py.
+instrument_engine(db)
 
 
 # instead of connecting to the database directly, we will ask for
@@ -33,8 +25,9 @@ Session = sessionmaker(db)
 # above.
 session = Session()
 
-# creating the database using declarative_base subclass.
-base.metadata.create_all(db)
+# The "Programmer" table is created by running
+#   python3 sql_startup.py migrate
+# once beforehand, rather than checking for it every time we start.
 
 
 # creating records on our Programmer table.
@@ -111,6 +104,18 @@ christiana_temiola = Programmer(
 # session.add(tim_berners_lee)
 # session.add(christiana_temiola)
 
+# adding many records at once.
+# Rather than one session.add() & one INSERT per programmer, we can send
+# them all in a single INSERT ... RETURNING id statement, which gives us
+# back the id of every new record.
+# from sql_bulk_crud import bulk_insert_programmers
+# ids = bulk_insert_programmers([
+#     {"first_name": "Ada", "last_name": "Lovelace", "gender": "F",
+#      "nationality": "British", "famous_for": "First Programmer"},
+#     {"first_name": "Alan", "last_name": "Turing", "gender": "M",
+#      "nationality": "British", "famous_for": "Modern Computing"},
+# ])
+
 
 # updating a single record.
 # Since we only want one specific record, we must add the
@@ -136,6 +141,13 @@ christiana_temiola = Programmer(
 #         print("Gender not defined")
 #     session.commit()
 
+# updating multiple records in one go.
+# The loop above sends one UPDATE & commits once for every single person.
+# bulk_update_gender() lets the database do the whole job with a single
+# UPDATE ... SET gender = CASE ... statement & a single commit instead.
+# from sql_bulk_crud import bulk_update_gender
+# print(bulk_update_gender(), "records updated")
+
 # deleting a single record
 # fname = input("Enter a first name: ")
 # lname = input("Enter a last name: ")
@@ -157,6 +169,11 @@ christiana_temiola = Programmer(
 # else:
 #     print("No records found")
 
+# deleting multiple records in one go, by first & last name.
+# from sql_bulk_crud import bulk_delete_programmers
+# print(bulk_delete_programmers([("Bill", "Gates"), ("Alan", "Turing")]),
+#       "records deleted")
+
 
 # query the database to find all Programmers i.e check
 # that Ada is added correctly. We'll create a new
@@ -175,3 +192,14 @@ for programmer in programmers:
         programmer.famous_for,
         sep=" | "
     )
+
+# following changes to the Programmer table as they happen, instead of
+# re-running the query above on a timer. Run
+# "python3 sql_changefeed.py setup --tables Programmer" once beforehand.
+# from sql_changefeed import Subscriber
+# with Subscriber(["Programmer"]) as subscriber:
+#     for changes in subscriber.batches():
+#         ids = [change.key for change in changes if change.op in "IU"]
+#         for programmer in session.query(Programmer).filter(
+#                 Programmer.id.in_(ids)):
+#             print(programmer.id, programmer.first_name, sep=" | ")
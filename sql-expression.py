@@ -2,20 +2,25 @@
 
 
 from sqlalchemy import (
-    create_engine, Table, Column, Float, ForeignKey, Integer, String, MetaData
+    Table, Column, Float, ForeignKey, Integer, String, MetaData
 )
 
+from sql_connection import get_engine
+from sql_instrumentation import instrument_engine
+from sql_streaming import DEFAULT_ITERSIZE as STREAM_ITERSIZE
+
 # executing the instructions from our localhost "chinook" db.
 # Next, we need to link our Python file to our Chinook database,
-# and that's where the 'create_engine' component comes into play.
+# and that's where the engine comes into play.
 # We'll assign this to a variable of "db" to represent our database,
-# and using create_engine, we can tell it to point to our local Chinook
-# database within our Postgres server.
-# The 3 slashes here signifies that our database is hosted locally within
-# our workspace environment.
-# This command/expression below creates the engine & connects it to our
-# database.
-db = create_engine("postgresql:///chinook")
+# and using get_engine() from sql_connection.py, we can point it to our
+# local Chinook database within our Postgres server.
+# This command/expression below returns the one engine shared by all of
+# our scripts, along with its pool of already-open connections.
+db = get_engine()
+# Record how long every statement takes (and log the slow ones along with
+# their EXPLAIN plan). See sql_instrumentation.py.
+instrument_engine(db)
 
 # We'll use the MetaData class, which we can save to a variable name
 # of 'meta'. This class will contain a collection of our table objects
@@ -76,6 +81,13 @@ track_table = Table(
     Column("UnitPrice", Float)
 )
 
+# Rather than typing out every table like above, we can also ask the
+# database for them ("reflect" them). load_metadata() from sql_startup.py
+# does that once & keeps the result on disk, so later runs only pay for
+# one quick check that the schema hasn't changed since.
+# from sql_startup import load_metadata
+# track_table = load_metadata().tables["Track"]
+
 # Making the connection. We'll connect to the database using the
 # .connect() method & the Python with-statement. This saves our
 # connection to the database into a variable called 'connection'.
@@ -120,7 +132,24 @@ with db.connect() as connection:
     # We'll run this query using the .execute() method from our
     # database connection & store the query results into a
     # variable called "results".
-    results = connection.execute(select_query)
+    # stream_results asks for a server-side cursor, so the rows are
+    # fetched in batches of STREAM_ITERSIZE as we loop over them rather
+    # than all at once, which keeps big tables from filling our memory.
+    results = connection.execution_options(
+        stream_results=True, max_row_buffer=STREAM_ITERSIZE
+    ).execute(select_query)
     # Iterate over each result found & print it to the Terminal.
     for result in results:
         print(result)
+
+# Running several of the queries above in one round trip. execute_core()
+# turns each select into SQL & sends them all to Postgres together, then
+# hands back each one's rows separately. album_table needs uncommenting.
+# It needs a psycopg2 cursor, which we get from our engine's connection.
+# from sql_batch import execute_core
+# with db.connect() as connection:
+#     albums, tracks = execute_core(connection.connection.cursor(), [
+#         album_table.select().where(album_table.c.ArtistId == 51),
+#         track_table.select().where(track_table.c.Composer == "Queen"),
+#     ])
+# print(albums.rows, tracks.rows)
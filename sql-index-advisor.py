@@ -0,0 +1,158 @@
+# HOW TO FIND (AND ADD) THE INDEXES OUR QUERIES ARE MISSING.
+
+# The Chinook schema only indexes the foreign key columns ("IFK_*"), but
+# our scripts mostly look things up by "Track"."Composer" & "Artist"."Name",
+# which means Postgres has to read every row of those tables to answer.
+# This script runs EXPLAIN (ANALYZE, BUFFERS) on the six queries from
+# sql_queries.py, collects every column that's filtered on with a
+# sequential scan, proposes a B-tree index (for =) or a trigram index (for
+# LIKE/ILIKE) for it and, with --create, builds them & shows the plan cost
+# & latency of each query before and after.
+import argparse
+import re
+
+from sql_connection import connection
+from sql_queries import QUERIES
+
+
+# Picks the column & operator out of a plan "Filter" such as
+#   (("Composer")::text = 'Queen'::text)   or   ("ArtistId" = 51)
+# "~~" & "~~*" are how Postgres writes LIKE & ILIKE in a plan.
+FILTER_RE = re.compile(r'\(*"?(\w+)"?\)*(?:::[\w ]+?)?\s+(=|~~\*|~~)\s')
+
+# Which kind of index serves which operator.
+INDEX_KINDS = {"=": "btree", "~~": "trgm", "~~*": "trgm"}
+
+# Each query is explained this many times & the fastest run is reported,
+# so a cold cache on the first run doesn't skew the numbers.
+DEFAULT_REPEAT = 5
+
+
+# Run EXPLAIN (ANALYZE, BUFFERS) on one query & return the plan as a dict.
+# psycopg2 turns the JSON output into Python lists/dicts for us.
+def explain(cursor, query, params, repeat=DEFAULT_REPEAT):
+    best = None
+    for _ in range(repeat):
+        cursor.execute(
+            "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query, params)
+        plan = cursor.fetchone()[0][0]
+        if best is None or plan["Execution Time"] < best["Execution Time"]:
+            best = plan
+    return best
+
+
+# Walk every node of a plan tree, starting at the top.
+def plan_nodes(node):
+    yield node
+    for child in node.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+# The (table, column, index kind) of every predicate that Postgres had to
+# answer with a sequential scan.
+def seq_scan_predicates(plan):
+    for node in plan_nodes(plan["Plan"]):
+        if node["Node Type"] != "Seq Scan" or "Filter" not in node:
+            continue
+        for column, operator in FILTER_RE.findall(node["Filter"]):
+            yield node["Relation Name"], column, INDEX_KINDS[operator]
+
+
+# The (table, column, index kind) of every column that already leads an
+# index, so we never propose one that's already there.
+def existing_indexes(cursor):
+    cursor.execute("""
+        SELECT c.relname, a.attname, am.amname
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indrelid
+        JOIN pg_class ic ON ic.oid = i.indexrelid
+        JOIN pg_am am ON am.oid = ic.relam
+        JOIN pg_attribute a
+            ON a.attrelid = c.oid AND a.attnum = i.indkey[0]
+        WHERE c.relnamespace = 'public'::regnamespace
+    """)
+    return {
+        (table, column, "trgm" if access_method == "gin" else access_method)
+        for table, column, access_method in cursor.fetchall()
+    }
+
+
+# The CREATE INDEX statement for one proposal, named in the same style as
+# the "IFK_*" indexes from the Chinook schema.
+def index_statement(table, column, kind):
+    if kind == "trgm":
+        return (
+            'CREATE INDEX "ITRGM_{0}{1}" ON "{0}" '
+            'USING gin ("{1}" gin_trgm_ops)'.format(table, column))
+    return 'CREATE INDEX "IX_{0}{1}" ON "{0}" ("{1}")'.format(table, column)
+
+
+def summary(plan):
+    scans = ", ".join(
+        node["Node Type"] for node in plan_nodes(plan["Plan"])
+        if "Relation Name" in node)
+    return plan["Plan"]["Total Cost"], plan["Execution Time"], scans
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Propose or create indexes for the Chinook queries.")
+    parser.add_argument(
+        "--create", action="store_true",
+        help="build the proposed indexes & compare the plans")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    args = parser.parse_args()
+
+    with connection() as conn:
+        cursor = conn.cursor()
+
+        before = {
+            name: explain(cursor, query, params, args.repeat)
+            for name, (query, params) in QUERIES.items()
+        }
+        existing = existing_indexes(cursor)
+        proposals = []
+        for plan in before.values():
+            for predicate in seq_scan_predicates(plan):
+                if predicate not in existing and predicate not in proposals:
+                    proposals.append(predicate)
+
+        if not proposals:
+            print("No missing indexes found.")
+        for table, column, kind in proposals:
+            print(index_statement(table, column, kind) + ";")
+
+        after = before
+        if args.create and proposals:
+            if any(kind == "trgm" for _, _, kind in proposals):
+                cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            for table, column, kind in proposals:
+                cursor.execute(index_statement(table, column, kind))
+            for table in {table for table, _, _ in proposals}:
+                cursor.execute('ANALYZE "{}"'.format(table))
+            after = {
+                name: explain(cursor, query, params, args.repeat)
+                for name, (query, params) in QUERIES.items()
+            }
+
+    print()
+    print(
+        "Query", "Cost before", "Cost after", "ms before", "ms after",
+        "Scans before", "Scans after", sep=" | ")
+    for name in QUERIES:
+        cost_before, ms_before, scans_before = summary(before[name])
+        cost_after, ms_after, scans_after = summary(after[name])
+        print(
+            name,
+            cost_before,
+            cost_after,
+            "{:.3f}".format(ms_before),
+            "{:.3f}".format(ms_after),
+            scans_before,
+            scans_after,
+            sep=" | "
+        )
+
+# command to type at the terminal in order to run our code is:
+# python3 sql-index-advisor.py            (only print the proposals)
+# python3 sql-index-advisor.py --create   (build them & compare)
@@ -2,78 +2,29 @@
 
 # We don't need to import the Table class here because with
 # the ORM, we won't create tables but instead, we'll be
-# creating Python classes. These Python classes that we'll
-# create will subclass the declarative_base, meaning that
-# any class we're making will extend from the main class
-# within the ORM.
-from sqlalchemy import (
-    create_engine, Column, Float, ForeignKey, Integer, String
-)
-from sqlalchemy.ext.declarative import declarative_base
+# using Python classes. Our class-based models for the Artist,
+# Album & Track tables all subclass the declarative_base, and
+# they live in sql_models.py so that other scripts can share them.
 # instead of making a connection to the database directly,
 # we'll be asking for a session.
 from sqlalchemy.orm import sessionmaker
 
+from sql_connection import get_engine
+from sql_instrumentation import instrument_engine
+from sql_models import Album, Artist, Track  # noqa: F401
+from sql_streaming import stream_orm
 
-# executing the instructions from our localhost "chinook" db.
-# We'll create a new variable of 'db', and use create_engine
-# to point to our specific database location. This tells the
-# application that we're using the Postgres server, on a local
-# host since there are 3 slashes, in order to connect to our
-# Chinook database.
-db = create_engine("postgresql:///chinook")
-
-# We'll make a variable called 'base' which will be set to the
-# declarative_base() class. This new 'base' class will essent-
-# ially grab the metadata that is produced by our database
-# table schema & create a subclass to map everything back to us
-# here within the 'base' variable i.e we're piggybacking off of
-# an existing ORM class & let it do all of the dirty work while
-# we're reaping the benefits from it behind the scenes.
-base = declarative_base()
-
-
-# We'll start to build our class-based models by simply building
-# a normal Python object that subclasses 'base'. We'll work with
-# the same 3 tables in 'chinook' database as before i.e Artist,
-# Album & Track but ensure these are added before the Session is
-# created but after the base is declared since we need to use the
-# base subclass.
-# NOTE: For best practice, it's best to use PascalCase (i.e the
-# first letter of each word is capitalized) when defining your
-# classes in Python & don't use underscores.
-# Create a class-based model for the "Artist" table.
-class Artist(base):
-    __tablename__ = "Artist"
-    ArtistId = Column(Integer, primary_key=True)
-    Name = Column(String)
-
-
-# Create a class-based model for the "Album" table.
-class Album(base):
-    __tablename__ = "Album"
-    AlbumId = Column(Integer, primary_key=True)
-    Title = Column(String)
-    ArtistId = Column(Integer, ForeignKey("Artist.ArtistId"))
-
-
-# Create a class-based model for the "Track" table.
-class Track(base):
-    __tablename__ = "Track"
-    TrackId = Column(Integer, primary_key=True)
-    Name = Column(String)
-    AlbumId = Column(Integer, ForeignKey("Album.AlbumId"))
-    MediaTypeId = Column(Integer, primary_key=False)
-    GenreId = Column(Integer, primary_key=False)
-    Composer = Column(String)
-    Milliseconds = Column(Integer, primary_key=False)
-    Bytes = Column(Integer, primary_key=False)
-    # If we ever confuse Float with Decimal & are in
-    # doubt as to which is the right one to use, just
-    # check on the SQLAlchemy documentation under the
-    # section called "Column and Data Types".
-    UnitPrice = Column(Float)
 
+# executing the instructions from our localhost "chinook" db.
+# We'll create a new variable of 'db', and use get_engine() from
+# sql_connection.py which points to our specific database location.
+# This tells the application that we're using the Postgres server,
+# on a local host, in order to connect to our Chinook database.
+# Every script shares this one engine & its pool of open connections.
+db = get_engine()
+# Record how long every statement takes (and log the slow ones along with
+# their EXPLAIN plan). See sql_instrumentation.py.
+instrument_engine(db)
 
 # instead of connecting to the database directly, we will ask for
 # a session.
@@ -86,11 +37,11 @@ Session = sessionmaker(db)
 # 's') & set it to equal the new instance of the Session() from above.
 session = Session()
 
-# create the database subclass and generate all metadata i.e creating
-# the database using declarative_base subclass.
-# The base variable, since it's a subclass from the declarative_base,
-# will now use the .create_all() method from our database metadata.
-base.metadata.create_all(db)
+# Any missing tables are created by running
+#   python3 sql_startup.py migrate
+# once beforehand. Doing it here with base.metadata.create_all(db) would
+# connect & query Postgres's catalog every time the script starts, before
+# any of our own queries have run.
 
 
 # Query 1 - Select ALL records from the "Artist" table.
@@ -136,7 +87,9 @@ base.metadata.create_all(db)
 
 # Query 6 - Select all tracks where the composer is "Queen" from the
 # "Track" table.
-tracks = session.query(Track).filter_by(Composer="Queen")
+# stream_orm() builds the Track objects in batches from a server-side
+# cursor instead of loading the whole result into memory first.
+tracks = stream_orm(session.query(Track).filter_by(Composer="Queen"))
 for track in tracks:
     print(
         track.TrackId,
@@ -150,3 +103,53 @@ for track in tracks:
         track.UnitPrice,
         sep=" | "
     )
+
+# Caching repeated lookups. cached_orm() keeps the results of a query in
+# memory for a while, so running the same lookup again doesn't need to go
+# back to the database. Writing to the "Album" table clears it again.
+# from sql_cache import cached_orm
+# albums = cached_orm(session, session.query(Album).filter_by(ArtistId=51))
+# for album in albums:
+#     print(album.AlbumId, album.Title, album.ArtistId, sep=" | ")
+
+# Walking from an artist to their albums & tracks. Thanks to the
+# relationships in sql_models.py we can use artist.albums & album.tracks
+# directly, and artist_catalogue() loads them all up front with a fixed
+# number of queries rather than one extra query for every album.
+# from sql_loading import artist_catalogue
+# artist = artist_catalogue(session, artist_id=51, strategy="selectin")
+# for album in artist.albums:
+#     for track in album.tracks:
+#         print(artist.Name, album.Title, track.Name, sep=" | ")
+
+# Reading precomputed sales reports. SalesByArtist & friends in
+# sql_models.py are mapped onto materialized views that sql_rollups.py
+# keeps up to date, so this is a plain indexed read rather than joining
+# every invoice line to its track, album & artist.
+# from sql_rollups import top_artists
+# for sales in top_artists(session, limit=10):
+#     print(sales.ArtistId, sales.Name, sales.Revenue, sep=" | ")
+
+# Searching by words rather than exact values. filter_by(Composer="Queen")
+# misses "Queen, Freddie Mercury", but search_orm() finds every track
+# with those words in its Name or Composer (even slightly misspelt), best
+# match first. Run "python3 sql_search.py setup" once beforehand.
+# from sql_search import search_orm
+# for track, rank in search_orm(session, Track, "freddie mercury"):
+#     print(track.TrackId, track.Name, track.Composer, rank, sep=" | ")
+
+# Reading rows we only want to print. read_only() runs the same query for
+# just the Track columns, so no Track objects are built or added to the
+# session, and each row is a small read-only object instead.
+# from sql_rows import read_only
+# for track in read_only(session.query(Track).filter_by(GenreId=1)):
+#     print(track.TrackId, track.Name, track.Composer, sep=" | ")
+
+# Reading one month of invoices. Once "python3 sql_partitioning.py
+# migrate" has split "Invoice" into one partition per month, a plain
+# range on "InvoiceDate" means only that month's partition is read.
+# Filtering on func.extract("year", Invoice.InvoiceDate) instead would
+# read every partition, so use the helpers to build the filter.
+# from sql_partitioning import invoices_between, month_range
+# for invoice in invoices_between(session, *month_range(2013, 12)):
+#     print(invoice.InvoiceId, invoice.InvoiceDate, invoice.Total, sep=" | ")
@@ -1,15 +1,17 @@
 # HOW TO EXECUTE SIX QUERIES USING THE POPULAR "psycopg2" LIBRARY.
 
-import psycopg2
+from sql_connection import getconn, putconn
+from sql_instrumentation import InstrumentedCursor
 
 
 # We need to have psycopg2 connect to our Postgres database
-# called chinook using the .connect() method, and we'll assign
-# that to a variable of 'connection'.
-# We specified the name of our database, "chinook", in double
-# -quotes, but we can include additional connection values such
-# as host, username, password etc.
-connection = psycopg2.connect(database="chinook")
+# called chinook, and we'll assign that to a variable of 'connection'.
+# Rather than opening a brand new connection with psycopg2.connect()
+# on every run, we borrow one that's already open from the shared pool
+# in sql_connection.py using getconn(). The name of our database,
+# "chinook", and any additional connection values such as host,
+# username, password etc. all live in that shared module.
+connection = getconn()
 
 
 # build a cursor object of the database. The connection needs an
@@ -18,7 +20,10 @@ connection = psycopg2.connect(database="chinook")
 # Essentially, anything that we query from the database will become
 # part of this cursor object and to read that data, we should iterate
 # over the cursor using for e.g a for-loop.
-cursor = connection.cursor()
+# InstrumentedCursor works just like a normal cursor, but also records how
+# long each query takes & how many rows it returns, and logs slow ones
+# along with their EXPLAIN plan (see sql_instrumentation.py).
+cursor = connection.cursor(cursor_factory=InstrumentedCursor)
 
 # In between when our cursor variable being defined & our results fetched,
 # we need to perform our queries using the .execute() method.
@@ -74,6 +79,12 @@ cursor.execute('SELECT * FROM "Artist"')
 
 # Query 11 - Select ALL from the "Album" table.
 # cursor.execute('SELECT * FROM "Album"')
+# To show a big table one page at a time, ask for the rows after the last
+# key we showed rather than using OFFSET, which gets slower the deeper we
+# go (see sql_pagination.py for opaque cursors & the benchmark).
+# cursor.execute(
+#     'SELECT * FROM "Album" WHERE "AlbumId" > %s '
+#     'ORDER BY "AlbumId" LIMIT %s', [last_album_id, 50])
 
 # fetch the results (multiple). We need to set up a way for our data
 # to be retrieved or fetched from the cursor before we can start to
@@ -88,9 +99,9 @@ results = cursor.fetchall()
 # fetch the result (single):
 # results = cursor.fetchone()
 
-# Close the connection i.e end the connection to the database so the
-# connection is not always persistent.
-connection.close()
+# Hand the connection back to the pool i.e we're done with it for now,
+# but rather than closing it, it stays open for the next query to reuse.
+putconn(connection)
 
 # Since our data sits within a cursor object, similar to an array, in
 # order to retrieve each record individually, we need to iterate over
@@ -99,5 +110,36 @@ connection.close()
 for result in results:
     print(result)
 
+# Streaming large results. For big tables like "PlaylistTrack" or
+# "InvoiceLine", fetchall() would load every row into memory before we
+# print the first one. stream_query() uses a named (server-side) cursor
+# instead, which hands us the rows in small batches as we loop over them.
+# from sql_streaming import stream_query
+# for result in stream_query('SELECT * FROM "PlaylistTrack"'):
+#     print(result)
+
+# Caching repeated lookups. If we run the same query with the same values
+# again & again, cached_query() keeps the results in memory for a while so
+# only the first call has to go to the database at all.
+# from sql_cache import cached_query, query_cache
+# results = cached_query('SELECT * FROM "Album" WHERE "ArtistId" = %s', [51])
+# print(query_cache.stats())
+
+# Preparing repeated lookups. run_prepared() sends a named query from
+# sql_queries.py to the server once with PREPARE, and after that only
+# sends EXECUTE with the new values, so Postgres doesn't need to parse &
+# plan the same query all over again.
+# from sql_prepared import run_prepared
+# results = run_prepared("artist_by_id", [51])
+
+# Running several queries in one go. Rather than waiting for Query 4,
+# then Query 5, then the tracks one after another, execute_combined()
+# sends them to Postgres as one statement & hands back each result on
+# its own, so we only wait for one round trip to the database.
+# This uses our cursor, so it has to run before putconn() above.
+# from sql_batch import artist_page, execute_combined
+# artist, albums, tracks = execute_combined(cursor, artist_page(51))
+# print(artist.rows, len(albums.rows), len(tracks.rows))
+
 # command to type at the terminal in order to run our code is:
 # python3 sql-psycopg2.py
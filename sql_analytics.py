@@ -0,0 +1,246 @@
+# HOW TO ANSWER REPORTING QUESTIONS WITH NumPy INSTEAD OF PYTHON LOOPS.
+
+# Our reports are all "group by something & add things up" questions:
+#   - total "Milliseconds" & "Bytes" per Composer,
+#   - revenue ("UnitPrice" * "Quantity" from "InvoiceLine") per Genre,
+#   - the top customers (by spend) in each country.
+# Looping over ORM objects to answer them builds one Python object per row
+# & does the maths one row at a time. Instead, we load just the columns we
+# need ONCE into NumPy arrays (see sql_export.py) & answer each question
+# with a handful of whole-array operations. The same reports can also be
+# pushed down to Postgres as GROUP BY queries, and the benchmark at the
+# bottom compares all three.
+import argparse
+import collections
+import time
+
+import numpy
+from sqlalchemy.orm import sessionmaker
+
+from sql_connection import connection, get_engine
+from sql_export import record_batches
+from sql_models import Customer, Invoice, InvoiceLine, Track
+
+
+# The columns each report needs, one query per table.
+COLUMN_QUERIES = {
+    "Track": 'SELECT "TrackId", "Composer", "Milliseconds", "Bytes", '
+             '"GenreId" FROM "Track"',
+    "Genre": 'SELECT "GenreId", "Name" FROM "Genre"',
+    "InvoiceLine": 'SELECT "InvoiceId", "TrackId", "UnitPrice", "Quantity" '
+                   'FROM "InvoiceLine"',
+    "Invoice": 'SELECT "InvoiceId", "CustomerId", "Total" FROM "Invoice"',
+    "Customer": 'SELECT "CustomerId", "FirstName", "LastName", "Country" '
+                'FROM "Customer"',
+}
+
+# The same reports as SQL, for pushing the work down to Postgres.
+SQL_REPORTS = {
+    "composer_totals": """
+        SELECT "Composer", sum("Milliseconds"), sum("Bytes")
+        FROM "Track"
+        WHERE "Composer" IS NOT NULL
+        GROUP BY "Composer"
+        ORDER BY "Composer"
+    """,
+    "genre_revenue": """
+        SELECT g."Name", sum(il."UnitPrice" * il."Quantity")
+        FROM "InvoiceLine" il
+        JOIN "Track" t ON t."TrackId" = il."TrackId"
+        JOIN "Genre" g ON g."GenreId" = t."GenreId"
+        GROUP BY g."Name"
+        ORDER BY g."Name"
+    """,
+    "top_customers": """
+        SELECT "Country", "CustomerId", "FirstName", "LastName", spend
+        FROM (
+            SELECT c."Country", c."CustomerId", c."FirstName",
+                c."LastName", sum(i."Total") AS spend,
+                row_number() OVER (
+                    PARTITION BY c."Country" ORDER BY sum(i."Total") DESC
+                ) AS rank
+            FROM "Customer" c
+            JOIN "Invoice" i ON i."CustomerId" = c."CustomerId"
+            GROUP BY c."CustomerId"
+        ) ranked
+        WHERE rank <= %(top)s
+        ORDER BY "Country", spend DESC
+    """,
+}
+
+DEFAULT_TOP = 3
+
+
+# Load one query into a dict of {column name: NumPy array}. Text columns
+# become object arrays, integer columns with NULLs become floats with NaN.
+def load_columns(query):
+    import pyarrow
+
+    schema, batches = record_batches(query)
+    table = pyarrow.Table.from_batches(batches, schema=schema)
+    return {
+        name: table.column(name).to_numpy(zero_copy_only=False)
+        for name in table.column_names
+    }
+
+
+# Load every column the reports need, one query per table.
+def load_all():
+    return {table: load_columns(sql) for table, sql in COLUMN_QUERIES.items()}
+
+
+# An array where lookup[key] gives the position of 'key' in 'keys', so we
+# can "join" one table to another with a single fancy-indexing step.
+def index_by(keys):
+    lookup = numpy.full(int(keys.max()) + 1, -1, dtype=numpy.int64)
+    lookup[keys.astype(numpy.int64)] = numpy.arange(len(keys))
+    return lookup
+
+
+# Total "Milliseconds" & "Bytes" per Composer, as {composer: (ms, bytes)}.
+def composer_totals(data):
+    tracks = data["Track"]
+    known = numpy.not_equal(tracks["Composer"], None)
+    composers, groups = numpy.unique(
+        tracks["Composer"][known].astype(str), return_inverse=True)
+    milliseconds = numpy.bincount(
+        groups, weights=tracks["Milliseconds"][known])
+    sizes = numpy.bincount(
+        groups, weights=numpy.nan_to_num(tracks["Bytes"][known]))
+    return {
+        str(composer): (int(ms), int(size))
+        for composer, ms, size in zip(composers, milliseconds, sizes)
+    }
+
+
+# Revenue ("UnitPrice" * "Quantity") per Genre name.
+def genre_revenue(data):
+    tracks, lines, genres = data["Track"], data["InvoiceLine"], data["Genre"]
+    # InvoiceLine -> Track -> GenreId, without a Python loop.
+    track_rows = index_by(tracks["TrackId"])[lines["TrackId"]]
+    genre_ids = numpy.nan_to_num(
+        tracks["GenreId"][track_rows]).astype(numpy.int64)
+    revenue = numpy.bincount(
+        genre_ids, weights=lines["UnitPrice"] * lines["Quantity"])
+    return {
+        name: round(float(revenue[genre_id]), 2)
+        for genre_id, name in zip(genres["GenreId"], genres["Name"])
+        if genre_id < len(revenue) and revenue[genre_id]
+    }
+
+
+# The 'top' customers by total spend in each country, as
+# {country: [(CustomerId, FirstName, LastName, spend), ...]}.
+# Like the JOIN in the SQL version, customers without any invoices are
+# left out rather than ranked with a spend of 0.
+def top_customers(data, top=DEFAULT_TOP):
+    customers, invoices = data["Customer"], data["Invoice"]
+    customer_ids = customers["CustomerId"].astype(numpy.int64)
+    invoice_customers = invoices["CustomerId"].astype(numpy.int64)
+    size = int(customer_ids.max(initial=0)) + 1
+    has_invoices = numpy.bincount(
+        invoice_customers, minlength=size)[customer_ids] > 0
+    customers = {
+        name: column[has_invoices] for name, column in customers.items()
+    }
+    spend = numpy.bincount(
+        invoice_customers, weights=invoices["Total"], minlength=size,
+    )[customer_ids[has_invoices]]
+    countries, country_groups = numpy.unique(
+        customers["Country"].astype(str), return_inverse=True)
+    # Sort by country, then by spend (highest first), and keep the first
+    # 'top' rows of each country.
+    order = numpy.lexsort((-spend, country_groups))
+    sorted_groups = country_groups[order]
+    starts = numpy.searchsorted(sorted_groups, sorted_groups, side="left")
+    keep = order[numpy.arange(len(order)) - starts < top]
+    result = collections.defaultdict(list)
+    for row in keep:
+        result[str(countries[country_groups[row]])].append((
+            int(customers["CustomerId"][row]),
+            customers["FirstName"][row],
+            customers["LastName"][row],
+            round(float(spend[row]), 2),
+        ))
+    return dict(result)
+
+
+VECTORIZED_REPORTS = {
+    "composer_totals": composer_totals,
+    "genre_revenue": genre_revenue,
+    "top_customers": top_customers,
+}
+
+
+# Run one of the SQL_REPORTS on the server & return its rows.
+def sql_report(name, top=DEFAULT_TOP):
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(SQL_REPORTS[name], {"top": top})
+        return cursor.fetchall()
+
+
+# The same reports the slow way: load ORM objects & loop over them.
+def naive_report(session, name, top=DEFAULT_TOP):
+    if name == "composer_totals":
+        totals = collections.defaultdict(lambda: [0, 0])
+        for track in session.query(Track):
+            if track.Composer is not None:
+                totals[track.Composer][0] += track.Milliseconds
+                totals[track.Composer][1] += track.Bytes or 0
+        return totals
+    if name == "genre_revenue":
+        revenue = collections.defaultdict(float)
+        for line in session.query(InvoiceLine):
+            revenue[line.track.genre.Name] += line.UnitPrice * line.Quantity
+        return revenue
+    spend = collections.defaultdict(float)
+    for invoice in session.query(Invoice):
+        spend[invoice.CustomerId] += invoice.Total
+    by_country = collections.defaultdict(list)
+    for customer in session.query(Customer):
+        if customer.CustomerId not in spend:
+            continue
+        by_country[customer.Country].append(
+            (spend[customer.CustomerId], customer.CustomerId))
+    return {
+        country: sorted(rows, reverse=True)[:top]
+        for country, rows in by_country.items()
+    }
+
+
+def timed(run):
+    started = time.perf_counter()
+    run()
+    return time.perf_counter() - started
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare vectorized, SQL & ORM-loop reports.")
+    parser.add_argument("--top", type=int, default=DEFAULT_TOP)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    data = load_all()
+    print("Loading the columns took {:.4f}s".format(
+        time.perf_counter() - started))
+
+    print("Report", "NumPy (s)", "SQL (s)", "ORM loop (s)", sep=" | ")
+    for name, report in VECTORIZED_REPORTS.items():
+        kwargs = {"top": args.top} if name == "top_customers" else {}
+        session = sessionmaker(get_engine())()
+        try:
+            print(
+                name,
+                "{:.4f}".format(timed(lambda: report(data, **kwargs))),
+                "{:.4f}".format(timed(lambda: sql_report(name, args.top))),
+                "{:.4f}".format(
+                    timed(lambda: naive_report(session, name, args.top))),
+                sep=" | "
+            )
+        finally:
+            session.close()
+
+# command to type at the terminal in order to run our code is:
+# python3 sql_analytics.py
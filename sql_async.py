@@ -0,0 +1,201 @@
+# HOW TO RUN MANY CHINOOK LOOKUPS AT THE SAME TIME USING asyncio.
+
+# Our scripts are synchronous: they send one query, wait for the answer,
+# then send the next. When one request needs hundreds of independent
+# lookups (albums for many "ArtistId"s, tracks for many Composers etc.),
+# most of that time is spent waiting on the network.
+# This module runs the same six queries & the "Programmer" CRUD through
+# SQLAlchemy's AsyncSession & the asyncpg driver, so many lookups can be
+# waiting on the database at once. A semaphore caps how many run at the
+# same time, and the async engine's pool caps the open connections.
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import delete, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from sql_bulk_crud import (
+    gender_update_statement, insert_statements, programmer_table
+)
+from sql_connection import close_all_async, get_async_engine, get_engine
+from sql_models import Album, Artist, Programmer, Track
+
+
+# The most lookups we let run at the same time by default.
+DEFAULT_CONCURRENCY = 20
+
+
+# A new AsyncSession on the shared async engine. expire_on_commit=False
+# lets us keep reading the objects after the session has committed.
+def async_session():
+    return AsyncSession(get_async_engine(), expire_on_commit=False)
+
+
+# Run an ORM select() in its own session & return the mapped objects.
+# An AsyncSession can't be shared by tasks running at the same time, so
+# every lookup gets its own (its connection still comes from the pool).
+async def fetch_objects(statement):
+    async with async_session() as session:
+        result = await session.execute(statement)
+        return result.scalars().all()
+
+
+# Query 1 - Select ALL records from the "Artist" table.
+async def all_artists():
+    return await fetch_objects(select(Artist))
+
+
+# Query 2 - Select only the "Name" column from the "Artist" table.
+async def artist_names():
+    async with async_session() as session:
+        result = await session.execute(select(Artist.Name))
+        return result.scalars().all()
+
+
+# Query 3 - Select only the "Queen" from the "Artist" table.
+async def artist_by_name(name="Queen"):
+    artists = await fetch_objects(select(Artist).filter_by(Name=name))
+    return artists[0] if artists else None
+
+
+# Query 4 - Select only by "ArtistId" #51 from the "Artist" table.
+async def artist_by_id(artist_id=51):
+    async with async_session() as session:
+        return await session.get(Artist, artist_id)
+
+
+# Query 5 - Select only the albums with "ArtistId" #51 on the "Album" table.
+async def albums_by_artist(artist_id=51):
+    return await fetch_objects(select(Album).filter_by(ArtistId=artist_id))
+
+
+# Query 6 - Select all tracks where the composer is "Queen" from the
+# "Track" table.
+async def tracks_by_composer(composer="Queen"):
+    return await fetch_objects(select(Track).filter_by(Composer=composer))
+
+
+# Run a list of coroutines with at most 'limit' of them in flight at once,
+# and return their results in the same order.
+async def gather_limited(coroutines, limit=DEFAULT_CONCURRENCY):
+    semaphore = asyncio.Semaphore(limit)
+
+    async def limited(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(limited(c) for c in coroutines))
+
+
+# The fan-out lookups: one query per value, all in flight together.
+async def albums_for_artists(artist_ids, limit=DEFAULT_CONCURRENCY):
+    return await gather_limited(
+        [albums_by_artist(artist_id) for artist_id in artist_ids], limit)
+
+
+async def tracks_for_composers(composers, limit=DEFAULT_CONCURRENCY):
+    return await gather_limited(
+        [tracks_by_composer(composer) for composer in composers], limit)
+
+
+# The "Programmer" CRUD from sql-crud.py, batched like sql_bulk_crud.py.
+async def create_programmers(records):
+    ids = []
+    if not records:
+        return ids
+    async with get_async_engine().begin() as conn:
+        for statement in insert_statements(records):
+            result = await conn.execute(statement)
+            ids.extend(row[0] for row in result)
+    return ids
+
+
+async def list_programmers():
+    return await fetch_objects(select(Programmer))
+
+
+async def update_programmer(programmer_id, **values):
+    async with async_session() as session:
+        async with session.begin():
+            programmer = await session.get(Programmer, programmer_id)
+            if programmer is not None:
+                for column, value in values.items():
+                    setattr(programmer, column, value)
+            return programmer
+
+
+async def update_gender(mapping=None, where=None):
+    async with get_async_engine().begin() as conn:
+        result = await conn.execute(gender_update_statement(mapping, where))
+        return result.rowcount
+
+
+async def delete_programmers(names):
+    async with get_async_engine().begin() as conn:
+        result = await conn.execute(
+            delete(programmer_table).where(
+                tuple_(
+                    programmer_table.c.first_name,
+                    programmer_table.c.last_name,
+                ).in_(names)))
+        return result.rowcount
+
+
+# The synchronous sql-orm.py way of doing one lookup, for comparison.
+def sync_albums_by_artist(artist_id):
+    session = sessionmaker(get_engine())()
+    try:
+        return session.query(Album).filter_by(ArtistId=artist_id).all()
+    finally:
+        session.close()
+
+
+# Run 'lookups' album lookups with 'callers' of them at a time, first with
+# asyncio, then with the same number of threads calling the sync ORM.
+async def benchmark_async(artist_ids, callers):
+    started = time.perf_counter()
+    await albums_for_artists(artist_ids, limit=callers)
+    return time.perf_counter() - started
+
+
+def benchmark_sync(artist_ids, callers):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=callers) as executor:
+        list(executor.map(sync_albums_by_artist, artist_ids))
+    return time.perf_counter() - started
+
+
+async def main(lookups, concurrency_levels):
+    # ArtistIds 1-275 exist in Chinook, so we cycle through them.
+    artist_ids = [number % 275 + 1 for number in range(lookups)]
+    await albums_for_artists(artist_ids[:10])
+    print("Callers", "Mode", "Seconds", "Lookups/s", sep=" | ")
+    for callers in concurrency_levels:
+        for mode, elapsed in (
+            ("async", await benchmark_async(artist_ids, callers)),
+            ("sync", benchmark_sync(artist_ids, callers)),
+        ):
+            print(
+                callers,
+                mode,
+                "{:.3f}".format(elapsed),
+                "{:.0f}".format(lookups / elapsed),
+                sep=" | "
+            )
+    await close_all_async()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare async & sync ORM lookup throughput.")
+    parser.add_argument("--lookups", type=int, default=1000)
+    parser.add_argument(
+        "--concurrency", type=int, nargs="+", default=[1, 10, 100])
+    args = parser.parse_args()
+    asyncio.run(main(args.lookups, args.concurrency))
+
+# command to type at the terminal in order to run our code is:
+# python3 sql_async.py --lookups 1000 --concurrency 1 10 100
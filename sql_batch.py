@@ -0,0 +1,317 @@
+# HOW TO SEND SEVERAL QUERIES TO POSTGRES IN ONE ROUND TRIP.
+
+# Every cursor.execute() is a full trip to the database & back: send the
+# query, wait, fetch the rows. A page showing an artist, their albums &
+# their tracks runs three queries that don't depend on each other, but
+# still waits for three round trips one after another. Locally that's
+# nothing, but across a network at 20ms a trip it's 60ms of waiting.
+# execute_combined() sends all of them as ONE statement:
+#   WITH q0 AS (SELECT * FROM "Artist" WHERE "ArtistId" = 51),
+#        q1 AS (SELECT * FROM "Album" WHERE "ArtistId" = 51), ...
+#   SELECT (SELECT coalesce(json_agg(q0), '[]') FROM q0),
+#          (SELECT coalesce(json_agg(q1), '[]') FROM q1), ...
+# and splits the one row it gets back into each query's own result.
+# execute_core() does the same for SQLAlchemy Core select()s, e.g. on the
+# Table objects in sql-expression.py, and execute_pipeline() uses libpq's
+# pipeline mode through psycopg 3 (if it's installed) instead.
+# Some things to know:
+#   - every statement has to return rows, so writes need RETURNING,
+#   - the statements all see the same snapshot, so a SELECT won't see
+#     the rows an INSERT in the same batch adds,
+#   - values come back through JSON, so dates & times are strings, and
+#     two columns with the same name in one query need different aliases.
+import argparse
+import collections
+import decimal
+import functools
+import json
+import queue
+import socket
+import statistics
+import threading
+import time
+
+import psycopg2
+import psycopg2.extras
+
+from sql_connection import DATABASE_URL
+
+
+# One statement's result: the names of its columns & its rows as tuples.
+# A result with no rows can't tell us its columns, so they're [] then.
+Result = collections.namedtuple("Result", ["columns", "rows"])
+
+# NUMERIC columns like "UnitPrice" come back as Decimals, just like they
+# do from an ordinary psycopg2 query, rather than as floats.
+JSON_LOADS = functools.partial(json.loads, parse_float=decimal.Decimal)
+JSON_OID, JSON_ARRAY_OID = 114, 199
+
+
+def as_sql(cursor, sql, params=None):
+    query = cursor.mogrify(sql, params)
+    return query.decode(cursor.connection.encoding).strip().rstrip(";")
+
+
+# The one statement that runs every (sql, params) in 'statements'.
+def combined_sql(cursor, statements):
+    queries = [as_sql(cursor, sql, params) for sql, params in statements]
+    return "WITH {} SELECT {}".format(
+        ", ".join(
+            "q{} AS ({})".format(number, query)
+            for number, query in enumerate(queries)),
+        ", ".join(
+            "(SELECT coalesce(json_agg(q{0}), '[]') FROM q{0})".format(number)
+            for number in range(len(queries))))
+
+
+# Run several (sql, params) statements in one round trip & return one
+# Result for each, in the same order, e.g.
+#   artist, albums = execute_combined(cursor, [
+#       ('SELECT * FROM "Artist" WHERE "ArtistId" = %s', [51]),
+#       ('SELECT * FROM "Album" WHERE "ArtistId" = %s', [51]),
+#   ])
+def execute_combined(cursor, statements):
+    statements = list(statements)
+    if not statements:
+        return []
+    # The JSON is only decoded for this cursor, other queries are left be.
+    psycopg2.extras.register_json(
+        cursor, loads=JSON_LOADS, oid=JSON_OID, array_oid=JSON_ARRAY_OID)
+    cursor.execute(combined_sql(cursor, statements))
+    results = []
+    for rows in cursor.fetchone():
+        results.append(Result(
+            list(rows[0]) if rows else [],
+            [tuple(row.values()) for row in rows]))
+    return results
+
+
+# The usual way, one round trip per statement, for comparison.
+def execute_sequential(cursor, statements):
+    results = []
+    for sql, params in statements:
+        cursor.execute(sql, params)
+        results.append(Result(
+            [column.name for column in cursor.description],
+            cursor.fetchall()))
+    return results
+
+
+# SQLAlchemy Core statements compiled to SQL for psycopg2, with any
+# IN (...) lists written out so the SQL can be combined with others.
+@functools.lru_cache(maxsize=None)
+def _dialect():
+    from sqlalchemy.dialects.postgresql import psycopg2 as dialect
+    return dialect.dialect()
+
+
+def compile_statement(statement):
+    compiled = statement.compile(
+        dialect=_dialect(), compile_kwargs={"render_postcompile": True})
+    return str(compiled), compiled.params
+
+
+# The same as execute_combined() for Core statements, e.g.
+#   artist, albums = execute_core(cursor, [
+#       artist_table.select().where(artist_table.c.ArtistId == 51),
+#       album_table.select().where(album_table.c.ArtistId == 51),
+#   ])
+def execute_core(cursor, statements):
+    return execute_combined(
+        cursor, [compile_statement(statement) for statement in statements])
+
+
+# Run the statements in libpq's pipeline mode, where every query is sent
+# without waiting for the one before it to finish, so the results are
+# real, fully typed result sets. It needs psycopg 3 (pip install psycopg)
+# & one of its own connections, e.g. psycopg.connect(DATABASE_URL).
+def execute_pipeline(conn, statements):
+    statements = list(statements)
+    cursors = [conn.cursor() for _ in statements]
+    with conn.pipeline():
+        for cursor, (sql, params) in zip(cursors, statements):
+            cursor.execute(sql, params)
+    # Leaving the pipeline block waits for every result to arrive.
+    return [
+        Result([column.name for column in cursor.description],
+               cursor.fetchall())
+        for cursor in cursors
+    ]
+
+
+# A local TCP proxy in front of Postgres that holds every chunk of data
+# for 'delay' seconds in each direction, so a query on localhost takes as
+# long as it would across a real network, e.g.
+#   with DelayProxy(("localhost", 5432), delay=0.01) as proxy:
+#       conn = psycopg2.connect(DATABASE_URL, host="127.0.0.1",
+#                               port=proxy.port)
+# Data keeps flowing while it's held, like a real link with latency.
+class DelayProxy:
+    def __init__(self, upstream, delay):
+        self.upstream = upstream
+        self.delay = delay
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.port = self.server.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.server.close()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.server.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(self.upstream)
+            for sock in (client, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._forward(client, upstream)
+            self._forward(upstream, client)
+
+    # Copy everything from 'source' to 'target', each chunk 'delay'
+    # seconds after it was read.
+    def _forward(self, source, target):
+        chunks = queue.Queue()
+
+        def read():
+            while True:
+                try:
+                    data = source.recv(65536)
+                except OSError:
+                    data = b""
+                chunks.put((time.monotonic() + self.delay, data))
+                if not data:
+                    return
+
+        def write():
+            while True:
+                due, data = chunks.get()
+                pause = due - time.monotonic()
+                if pause > 0:
+                    time.sleep(pause)
+                try:
+                    if not data:
+                        target.shutdown(socket.SHUT_WR)
+                        return
+                    target.sendall(data)
+                except OSError:
+                    return
+
+        threading.Thread(target=read, daemon=True).start()
+        threading.Thread(target=write, daemon=True).start()
+
+
+# The three independent queries behind one artist's page.
+def artist_page(artist_id):
+    return [
+        ('SELECT * FROM "Artist" WHERE "ArtistId" = %s', [artist_id]),
+        ('SELECT * FROM "Album" WHERE "ArtistId" = %s ORDER BY "AlbumId"',
+         [artist_id]),
+        ('SELECT t."TrackId", t."Name", t."AlbumId", t."Milliseconds" '
+         'FROM "Track" t JOIN "Album" a ON a."AlbumId" = t."AlbumId" '
+         'WHERE a."ArtistId" = %s ORDER BY t."TrackId"', [artist_id]),
+    ]
+
+
+# The same page as Core statements on the model's Tables.
+def artist_page_core(artist_id):
+    from sqlalchemy import select
+
+    from sql_models import Album, Artist, Track
+
+    artist, album, track = (
+        Artist.__table__, Album.__table__, Track.__table__)
+    return [
+        select(artist).where(artist.c.ArtistId == artist_id),
+        select(album).where(album.c.ArtistId == artist_id)
+        .order_by(album.c.AlbumId),
+        select(track.c.TrackId, track.c.Name, track.c.AlbumId,
+               track.c.Milliseconds)
+        .join(album, album.c.AlbumId == track.c.AlbumId)
+        .where(album.c.ArtistId == artist_id)
+        .order_by(track.c.TrackId),
+    ]
+
+
+def median_ms(run, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        times.append((time.perf_counter() - started) * 1000)
+    return statistics.median(times)
+
+
+# Time each way of loading one artist's page through a DelayProxy for
+# each one-way delay (in ms). Every connection is in autocommit mode, so
+# no extra round trip is spent on BEGIN.
+def benchmark(upstream, delays, artist_id, repeat):
+    try:
+        import psycopg
+    except ImportError:
+        psycopg = None
+        print("(psycopg 3 isn't installed, so pipeline mode is skipped)")
+    statements = artist_page(artist_id)
+    core_statements = artist_page_core(artist_id)
+    print("One-way delay ms", "Path", "Round trips", "Median ms", sep=" | ")
+    for delay in delays:
+        with DelayProxy(upstream, delay / 1000) as proxy:
+            conn = psycopg2.connect(
+                DATABASE_URL, host="127.0.0.1", port=proxy.port)
+            conn.autocommit = True
+            cursor = conn.cursor()
+            paths = [
+                ("sequential (psycopg2)", len(statements),
+                 lambda: execute_sequential(cursor, statements)),
+                ("combined (psycopg2)", 1,
+                 lambda: execute_combined(cursor, statements)),
+                ("combined (Core)", 1,
+                 lambda: execute_core(cursor, core_statements)),
+            ]
+            conn3 = None
+            if psycopg is not None:
+                conn3 = psycopg.connect(
+                    DATABASE_URL, host="127.0.0.1", port=proxy.port,
+                    autocommit=True)
+                paths.append((
+                    "pipeline (psycopg 3)", 1,
+                    lambda: execute_pipeline(conn3, statements)))
+            try:
+                for name, round_trips, run in paths:
+                    print(
+                        delay, name, round_trips,
+                        "{:.2f}".format(median_ms(run, repeat)), sep=" | ")
+            finally:
+                conn.close()
+                if conn3 is not None:
+                    conn3.close()
+
+
+def host_and_port(value):
+    host, _, port = value.rpartition(":")
+    return host or "localhost", int(port)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare one query at a time with batched queries.")
+    parser.add_argument(
+        "--upstream", type=host_and_port, default=("localhost", 5432),
+        help="where Postgres listens for TCP connections, as host:port")
+    parser.add_argument(
+        "--delays", type=float, nargs="+", default=[0, 1, 5, 20],
+        help="one-way network delays to add, in milliseconds")
+    parser.add_argument("--artist-id", type=int, default=51)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    benchmark(args.upstream, args.delays, args.artist_id, args.repeat)
+
+# command to type at the terminal in order to run our code is:
+# python3 sql_batch.py --upstream localhost:5432 --delays 0 5 20
@@ -0,0 +1,214 @@
+# HOW TO CREATE, UPDATE & DELETE MANY "Programmer" RECORDS AT ONCE.
+
+# sql-crud.py adds programmers one at a time with session.add(), and its
+# "update multiple records" example commits once for every single row.
+# That's one statement & one transaction (with its own round trip & disk
+# flush) per row. The helpers below do the same jobs with ONE statement
+# per batch of rows, and ONE transaction per call.
+import argparse
+import time
+
+from psycopg2.extras import execute_values
+from sqlalchemy import case, delete, insert, tuple_, update
+from sqlalchemy.orm import sessionmaker
+
+from sql_cache import invalidate_table
+from sql_connection import connection, get_engine
+from sql_models import Programmer
+
+
+# Postgres allows at most 65,535 parameters in one statement, so we send
+# big inserts in batches of this many rows (5 columns each).
+BATCH_SIZE = 5000
+
+# The Core Table object behind the Programmer model.
+programmer_table = Programmer.__table__
+
+# The columns we fill in when creating programmers (id is generated).
+INSERT_COLUMNS = [
+    "first_name", "last_name", "gender", "nationality", "famous_for"]
+
+# The same change sql-crud.py makes to every programmer's gender.
+GENDER_NAMES = {"F": "Female", "M": "Male"}
+
+
+# One INSERT ... VALUES (...), (...) ... RETURNING id per BATCH_SIZE
+# programmer dicts, which keeps each one well under Postgres's limit of
+# 65,535 parameters per statement. Also used by sql_async.py.
+def insert_statements(records):
+    for start in range(0, len(records), BATCH_SIZE):
+        yield insert(programmer_table).values(
+            records[start:start + BATCH_SIZE]
+        ).returning(programmer_table.c.id)
+
+
+# Insert a list of programmer dicts & return the new ids in the same order.
+def bulk_insert_programmers(records):
+    ids = []
+    if not records:
+        return ids
+    with get_engine().begin() as conn:
+        for statement in insert_statements(records):
+            ids.extend(row[0] for row in conn.execute(statement))
+    return ids
+
+
+# The same thing using psycopg2's execute_values(), which builds the
+# VALUES list on the client without going through SQLAlchemy at all.
+def bulk_insert_programmers_raw(records):
+    rows = [
+        tuple(record.get(column) for column in INSERT_COLUMNS)
+        for record in records
+    ]
+    with connection() as conn:
+        cursor = conn.cursor()
+        returned = execute_values(
+            cursor,
+            'INSERT INTO "Programmer" ({}) VALUES %s RETURNING id'.format(
+                ", ".join(INSERT_COLUMNS)),
+            rows,
+            page_size=BATCH_SIZE,
+            fetch=True,
+        )
+    # This insert didn't go through SQLAlchemy, so we need to tell the
+    # query cache ourselves that the "Programmer" table has changed.
+    invalidate_table("Programmer")
+    return [row[0] for row in returned]
+
+
+# A single statement that changes every programmer's gender on the server:
+#   UPDATE "Programmer" SET gender = CASE gender WHEN 'F' THEN 'Female'
+#   WHEN 'M' THEN 'Male' END WHERE gender IN ('F', 'M')
+# 'where' can narrow it down further, e.g. programmer_table.c.id > 7.
+def gender_update_statement(mapping=None, where=None):
+    mapping = mapping or GENDER_NAMES
+    statement = update(programmer_table).values(
+        gender=case(mapping, value=programmer_table.c.gender)
+    ).where(programmer_table.c.gender.in_(list(mapping)))
+    if where is not None:
+        statement = statement.where(where)
+    return statement
+
+
+# Run the statement above & return how many rows were changed.
+def bulk_update_gender(mapping=None, where=None):
+    with get_engine().begin() as conn:
+        return conn.execute(
+            gender_update_statement(mapping, where)).rowcount
+
+
+# Delete every programmer whose (first_name, last_name) is in 'names' with
+# a single DELETE ... WHERE (first_name, last_name) IN (...) statement.
+# Returns how many rows were deleted.
+def bulk_delete_programmers(names):
+    deleted = 0
+    with get_engine().begin() as conn:
+        for start in range(0, len(names), BATCH_SIZE):
+            statement = delete(programmer_table).where(
+                tuple_(
+                    programmer_table.c.first_name,
+                    programmer_table.c.last_name,
+                ).in_(names[start:start + BATCH_SIZE])
+            )
+            deleted += conn.execute(statement).rowcount
+    return deleted
+
+
+# Made-up programmers for the benchmark below.
+def fake_programmers(count):
+    return [
+        {
+            "first_name": "Bench",
+            "last_name": "Programmer {}".format(number),
+            "gender": "F" if number % 2 else "M",
+            "nationality": "Benchmark",
+            "famous_for": "Being Fast",
+        }
+        for number in range(count)
+    ]
+
+
+# The one-row-at-a-time way sql-crud.py does it, for comparison.
+def row_by_row(records):
+    session = sessionmaker(get_engine())()
+    timings = {}
+    try:
+        started = time.perf_counter()
+        for record in records:
+            session.add(Programmer(**record))
+            session.commit()
+        timings["insert"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        people = session.query(Programmer).filter_by(nationality="Benchmark")
+        for person in people:
+            person.gender = GENDER_NAMES.get(person.gender, person.gender)
+            session.commit()
+        timings["update"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for record in records:
+            programmer = session.query(Programmer).filter_by(
+                first_name=record["first_name"],
+                last_name=record["last_name"]).first()
+            session.delete(programmer)
+            session.commit()
+        timings["delete"] = time.perf_counter() - started
+    finally:
+        session.close()
+    return timings
+
+
+def batched(records, insert_function):
+    names = [(record["first_name"], record["last_name"]) for record in records]
+    timings = {}
+    started = time.perf_counter()
+    insert_function(records)
+    timings["insert"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    bulk_update_gender(where=programmer_table.c.nationality == "Benchmark")
+    timings["update"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    bulk_delete_programmers(names)
+    timings["delete"] = time.perf_counter() - started
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare row-by-row & batched Programmer CRUD.")
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument(
+        "--skip-row-by-row", action="store_true",
+        help="only time the batched paths (row-by-row is very slow)")
+    args = parser.parse_args()
+
+    methods = {
+        "batched (SQLAlchemy)": lambda records: batched(
+            records, bulk_insert_programmers),
+        "batched (execute_values)": lambda records: batched(
+            records, bulk_insert_programmers_raw),
+    }
+    if not args.skip_row_by_row:
+        methods["row by row"] = row_by_row
+
+    print("Rows", "Method", "Insert (s)", "Update (s)", "Delete (s)",
+          sep=" | ")
+    for size in args.sizes:
+        records = fake_programmers(size)
+        for method, run in methods.items():
+            timings = run(records)
+            print(
+                size,
+                method,
+                "{:.3f}".format(timings["insert"]),
+                "{:.3f}".format(timings["update"]),
+                "{:.3f}".format(timings["delete"]),
+                sep=" | "
+            )
+
+# command to type at the terminal in order to run our code is:
+# python3 sql_bulk_crud.py --sizes 10000 100000
@@ -0,0 +1,229 @@
+# HOW TO CACHE THE RESULTS OF OUR MOST COMMON LOOKUPS IN MEMORY.
+
+# Most of our traffic is the same few lookups over & over again: tracks by
+# Composer, albums by "ArtistId" = 51 & artists by Name. Rather than asking
+# Postgres every time, we keep the results of recent queries in memory,
+# keyed on the (normalized) SQL & its parameters.
+# Entries are thrown away when they get too old (TTL), when the cache is
+# full (least recently used first), and whenever something writes to one
+# of the tables they were read from.
+import collections
+import pickle
+import re
+import threading
+import time
+
+from sqlalchemy import event
+
+from sql_connection import connection, on_engine_created
+
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_TTL_SECONDS = 60
+
+# Every table a SELECT reads from, e.g. FROM "Track" or JOIN "Album".
+READ_TABLES_RE = re.compile(r'\b(?:FROM|JOIN)\s+"?(\w+)"?', re.I)
+# The table an INSERT, UPDATE, DELETE or TRUNCATE writes to.
+WRITE_TABLE_RE = re.compile(
+    r'^\s*(?:INSERT\s+INTO|UPDATE|DELETE\s+FROM|TRUNCATE(?:\s+TABLE)?)'
+    r'\s+"?(\w+)"?', re.I)
+
+
+# Squash all runs of whitespace so the same query written on one line or
+# across several lines is cached only once.
+def normalize_sql(query):
+    return " ".join(query.split()).rstrip(";")
+
+
+# Turn the query parameters into something we can use as a dict key.
+# Lists (e.g. for = ANY(%s) or an expanding in_()) & dicts inside them are
+# turned into tuples too, since they can't be hashed as they are.
+def freeze_params(params):
+    if params is None:
+        return ()
+    if isinstance(params, dict):
+        return tuple(sorted(
+            (name, freeze_params(value) if isinstance(
+                value, (list, tuple, dict, set)) else value)
+            for name, value in params.items()))
+    if isinstance(params, set):
+        params = sorted(params)
+    return tuple(
+        freeze_params(value)
+        if isinstance(value, (list, tuple, dict, set)) else value
+        for value in params)
+
+
+class QueryCache:
+    # An LRU + TTL cache of query results with a cap on the memory it uses.
+    # Results are stored pickled, which gives every caller its own copy &
+    # tells us exactly how many bytes each entry takes up.
+    def __init__(
+            self, max_entries=DEFAULT_MAX_ENTRIES,
+            max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # How many times each table has been invalidated. A result is only
+        # stored if none of its tables were invalidated while it was being
+        # read, otherwise it may be from before a write that's just been
+        # committed.
+        self._versions = collections.Counter()
+
+    # The current versions of 'tables', to pass to set() later.
+    def version(self, tables):
+        with self._lock:
+            return tuple(self._versions[table] for table in tables)
+
+    # Return the cached result for 'key', or None if there isn't one.
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return pickle.loads(entry[1])
+
+    # Store 'rows' under 'key', remembering which tables they came from.
+    # 'version' is what version(tables) returned before they were read.
+    def set(self, key, rows, tables, version=None):
+        data = pickle.dumps(rows, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if version is not None and version != tuple(
+                    self._versions[table] for table in tables):
+                return
+            if key in self._entries:
+                self._remove(key)
+            expires = time.monotonic() + self.ttl
+            self._entries[key] = (expires, data, frozenset(tables))
+            self.size += len(data)
+            while (len(self._entries) > self.max_entries
+                    or self.size > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    # Throw away every entry that was read from 'table'.
+    def invalidate(self, table):
+        with self._lock:
+            self._versions[table] += 1
+            stale = [
+                key for key, (_, _, tables) in self._entries.items()
+                if table in tables
+            ]
+            for key in stale:
+                self._remove(key)
+            self.invalidations += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+    def _remove(self, key):
+        self.size -= len(self._entries.pop(key)[1])
+
+
+# The one cache shared by everything in this process.
+query_cache = QueryCache()
+
+
+# Run a raw SQL query through psycopg2, or return its cached result.
+def cached_query(query, params=None, cache=query_cache):
+    sql = normalize_sql(query)
+    key = (sql, freeze_params(params))
+    rows = cache.get(key)
+    if rows is None:
+        tables = READ_TABLES_RE.findall(sql)
+        version = cache.version(tables)
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+        cache.set(key, rows, tables, version)
+    return rows
+
+
+# Run an ORM query, e.g. session.query(Track).filter_by(Composer="Queen"),
+# or return its cached result. Cached objects are merged into the caller's
+# session without going back to the database (load=False).
+def cached_orm(session, query, cache=query_cache):
+    compiled = query.statement.compile(dialect=session.bind.dialect)
+    sql = normalize_sql(str(compiled))
+    key = (sql, freeze_params(compiled.params))
+    objects = cache.get(key)
+    if objects is None:
+        tables = READ_TABLES_RE.findall(sql)
+        version = cache.version(tables)
+        objects = query.all()
+        cache.set(key, objects, tables, version)
+        return objects
+    return [session.merge(obj, load=False) for obj in objects]
+
+
+# Throw away cached results for a table after writing to it outside of
+# SQLAlchemy, e.g. with a raw psycopg2 cursor.
+def invalidate_table(table, cache=query_cache):
+    cache.invalidate(table)
+
+
+# Every INSERT/UPDATE/DELETE that goes through our shared engines (the ORM
+# sessions in sql-crud.py, the bulk helpers in sql_bulk_crud.py & the
+# asyncio ones in sql_async.py) clears the cached results for the table
+# it wrote to. Other connections can't see the write until it's
+# committed, so a read that runs in between may cache the old rows again.
+# That's why the tables written in a transaction are remembered & cleared
+# a second time when it commits.
+def _invalidate_on_write(conn, cursor, statement, parameters, context,
+                         executemany):
+    match = WRITE_TABLE_RE.match(statement)
+    if match is not None:
+        table = match.group(1)
+        query_cache.invalidate(table)
+        conn.info.setdefault("cache_written_tables", set()).add(table)
+
+
+def _invalidate_on_commit(conn):
+    for table in conn.info.pop("cache_written_tables", ()):
+        query_cache.invalidate(table)
+
+
+def _forget_rolled_back_writes(conn):
+    conn.info.pop("cache_written_tables", None)
+
+
+# The listeners go on every engine sql_connection.py makes, not just the
+# one that exists now, since close_all() throws that one away.
+def _listen(engine):
+    event.listen(engine, "after_cursor_execute", _invalidate_on_write)
+    event.listen(engine, "commit", _invalidate_on_commit)
+    event.listen(engine, "rollback", _forget_rolled_back_writes)
+
+
+on_engine_created(_listen)
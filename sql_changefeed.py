@@ -0,0 +1,536 @@
+# HOW TO BE TOLD ABOUT NEW & CHANGED ROWS INSTEAD OF ASKING OVER & OVER.
+
+# The only way our consumers could spot new or changed rows was to run
+# session.query(Programmer) or SELECT * FROM "Album" again on a timer, so
+# most of those queries found nothing new, and a change could still sit
+# unnoticed for a whole polling interval.
+# This module installs triggers on each table we want to follow that send
+# a tiny notification (with Postgres's NOTIFY) after every statement that
+# inserts, updates or deletes rows, e.g.
+#   {"k": [1042, 1043], "n": 1, "o": "I", "t": "Programmer"}
+# i.e. the table, the operation (Insert/Update/Delete/Truncate) & the
+# primary keys of the rows. Notifications are only sent when the
+# transaction commits, so consumers never hear about changes that were
+# rolled back.
+# Subscriber (blocking) & AsyncSubscriber (asyncio) LISTEN for them on a
+# connection of their own & hand them over in batches, with repeated
+# changes to the same row merged into one, so a consumer only queries the
+# rows that actually changed, and only when they've changed.
+import argparse
+import asyncio
+import collections
+import json
+import select
+import threading
+import time
+
+import psycopg2
+
+from sql_connection import DATABASE_URL, connection
+
+
+# The tables we can follow & their primary key column.
+FEED_TABLES = {
+    "Programmer": "id",
+    "Invoice": "InvoiceId",
+    "InvoiceLine": "InvoiceLineId",
+    "Track": "TrackId",
+}
+
+# How long a batch waits for more changes after its first one arrives,
+# and the most changes (before merging) it holds.
+DEFAULT_MAX_WAIT = 0.05
+DEFAULT_MAX_BATCH = 1000
+
+# The most keys sent in one notification. NOTIFY payloads must be under
+# 8000 bytes, which leaves room for 300 keys even if they're all bigints.
+CHUNK_KEYS = 300
+
+# One change to one row. key is None for a TRUNCATE, which empties the
+# whole table.
+Change = collections.namedtuple("Change", ["table", "op", "key"])
+
+# The trigger function for TRUNCATE, & for the one-notification-per-row
+# "TR_ChangeFeed" triggers that setup() used to make, which are replaced
+# the next time it's run. It's passed the channel to notify, the name of
+# the key column & the name of the table. The table is passed in rather
+# than read from TG_TABLE_NAME because on a partitioned table (see
+# sql_partitioning.py) row triggers run on each partition, which would
+# report "Invoice_2013_12" where a TRUNCATE reports "Invoice", so a
+# TRUNCATE wouldn't replace the earlier row changes & a row moving
+# between partitions wouldn't merge into a single update. Triggers made
+# before the table name was passed fall back to TG_TABLE_NAME.
+# pg_notify drops a notification that's identical to one already sent in
+# the same transaction. That's what we want for updates: a row updated
+# many times in one transaction is only announced once. But it would also
+# drop the second insert of a row that's inserted, deleted & inserted
+# again, leaving the consumer to think it's gone. So inserts, deletes &
+# truncates carry a number ('n') that goes up by one each time, kept in a
+# setting that only lasts until the end of the transaction, which makes
+# every one of them different.
+# An UPDATE that changes the key itself is announced as the old key being
+# deleted & the new one inserted.
+TRIGGER_FUNCTION = """
+    CREATE OR REPLACE FUNCTION changefeed_notify() RETURNS trigger AS $$
+    DECLARE
+        feed_table text := coalesce(TG_ARGV[2], TG_TABLE_NAME);
+        seq bigint := coalesce(nullif(
+            current_setting('changefeed.seq', true), ''), '0')::bigint + 1;
+    BEGIN
+        PERFORM set_config('changefeed.seq', seq::text, true);
+        IF TG_OP = 'TRUNCATE' THEN
+            PERFORM pg_notify(TG_ARGV[0], jsonb_build_object(
+                't', feed_table, 'o', 'T', 'n', seq)::text);
+        ELSIF TG_OP = 'DELETE' THEN
+            PERFORM pg_notify(TG_ARGV[0], jsonb_build_object(
+                't', feed_table, 'o', 'D', 'n', seq,
+                'k', to_jsonb(OLD) -> TG_ARGV[1])::text);
+        ELSIF TG_OP = 'UPDATE'
+                AND to_jsonb(OLD) -> TG_ARGV[1]
+                    IS DISTINCT FROM to_jsonb(NEW) -> TG_ARGV[1] THEN
+            PERFORM pg_notify(TG_ARGV[0], jsonb_build_object(
+                't', feed_table, 'o', 'D', 'n', seq,
+                'k', to_jsonb(OLD) -> TG_ARGV[1])::text);
+            PERFORM pg_notify(TG_ARGV[0], jsonb_build_object(
+                't', feed_table, 'o', 'I', 'n', seq,
+                'k', to_jsonb(NEW) -> TG_ARGV[1])::text);
+        ELSIF TG_OP = 'INSERT' THEN
+            PERFORM pg_notify(TG_ARGV[0], jsonb_build_object(
+                't', feed_table, 'o', 'I', 'n', seq,
+                'k', to_jsonb(NEW) -> TG_ARGV[1])::text);
+        ELSE
+            PERFORM pg_notify(TG_ARGV[0], jsonb_build_object(
+                't', feed_table, 'o', 'U',
+                'k', to_jsonb(NEW) -> TG_ARGV[1])::text);
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+# The trigger function for inserts, updates & deletes, passed the same
+# arguments. It runs once per statement rather than once per row, and
+# reads the keys of every row the statement changed from its transition
+# tables (new_rows & old_rows), so a COPY of a million rows into
+# "InvoiceLine" sends a few thousand notifications of CHUNK_KEYS
+# keys each, not a million that sit in the NOTIFY queue until the commit
+# & can overflow it.
+# Keys that are only in new_rows were inserted, ones only in old_rows
+# were deleted & ones in both were updated, which also covers an UPDATE
+# that changes a key, or moves a row to another partition.
+# Like above, every payload but an update's is numbered to keep
+# pg_notify from dropping it.
+ROWS_TRIGGER_FUNCTION = """
+    CREATE OR REPLACE FUNCTION changefeed_notify_rows()
+    RETURNS trigger AS $$
+    DECLARE
+        added jsonb[] := ARRAY[]::jsonb[];
+        removed jsonb[] := ARRAY[]::jsonb[];
+        seq bigint;
+        change_op text;
+        change_keys jsonb;
+    BEGIN
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            SELECT coalesce(array_agg(to_jsonb(r) -> TG_ARGV[1]), added)
+            INTO added FROM new_rows r;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            SELECT coalesce(array_agg(to_jsonb(r) -> TG_ARGV[1]), removed)
+            INTO removed FROM old_rows r;
+        END IF;
+        FOR change_op, change_keys IN
+            WITH a(key) AS (SELECT unnest(added)),
+            r(key) AS (SELECT unnest(removed)),
+            changes(op, key) AS (
+                SELECT 'I', key
+                FROM (SELECT key FROM a EXCEPT SELECT key FROM r) k
+                UNION ALL
+                SELECT 'D', key
+                FROM (SELECT key FROM r EXCEPT SELECT key FROM a) k
+                UNION ALL
+                SELECT 'U', key
+                FROM (SELECT key FROM a INTERSECT SELECT key FROM r) k
+            ),
+            chunks AS (
+                SELECT op, key, (row_number() OVER (
+                    PARTITION BY op ORDER BY key) - 1) / %(chunk_keys)s
+                    AS chunk
+                FROM changes
+            )
+            SELECT op, jsonb_agg(key ORDER BY key)
+            FROM chunks
+            GROUP BY op, chunk
+            ORDER BY op, chunk
+        LOOP
+            IF change_op = 'U' THEN
+                PERFORM pg_notify(TG_ARGV[0], jsonb_build_object(
+                    't', TG_ARGV[2], 'o', 'U', 'k', change_keys)::text);
+            ELSE
+                seq := coalesce(nullif(current_setting(
+                    'changefeed.seq', true), ''), '0')::bigint + 1;
+                PERFORM set_config('changefeed.seq', seq::text, true);
+                PERFORM pg_notify(TG_ARGV[0], jsonb_build_object(
+                    't', TG_ARGV[2], 'o', change_op, 'n', seq,
+                    'k', change_keys)::text);
+            END IF;
+        END LOOP;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+""" % {"chunk_keys": CHUNK_KEYS}
+
+# The statement-level triggers setup() makes, with the transition tables
+# each one needs. A trigger with transition tables can only fire on one
+# kind of statement, hence three of them.
+ROW_TRIGGERS = {
+    "TR_ChangeFeedInsert":
+        'INSERT ON "{}" REFERENCING NEW TABLE AS new_rows',
+    "TR_ChangeFeedUpdate":
+        'UPDATE ON "{}" REFERENCING OLD TABLE AS old_rows '
+        "NEW TABLE AS new_rows",
+    "TR_ChangeFeedDelete":
+        'DELETE ON "{}" REFERENCING OLD TABLE AS old_rows',
+}
+
+
+# Each table has a channel of its own, so a subscriber only receives the
+# tables it asked for, e.g. "Programmer" -> changefeed_programmer.
+def channel(table):
+    return "changefeed_" + table.lower()
+
+
+# Install the trigger function & the triggers on 'tables'. Safe to run
+# more than once.
+def setup(cursor, tables=None):
+    cursor.execute(TRIGGER_FUNCTION)
+    cursor.execute(ROWS_TRIGGER_FUNCTION)
+    for table in tables or FEED_TABLES:
+        teardown(cursor, [table])
+        for trigger, event in ROW_TRIGGERS.items():
+            cursor.execute(
+                'CREATE TRIGGER "{}" AFTER {} FOR EACH STATEMENT '
+                "EXECUTE PROCEDURE changefeed_notify_rows('{}', '{}', '{}')"
+                .format(trigger, event.format(table), channel(table),
+                        FEED_TABLES[table], table))
+        # A TRUNCATE has no row, so no key column either.
+        cursor.execute(
+            'CREATE TRIGGER "TR_ChangeFeedTruncate" AFTER TRUNCATE ON "{}" '
+            "FOR EACH STATEMENT EXECUTE PROCEDURE "
+            "changefeed_notify('{}', '', '{}')"
+            .format(table, channel(table), table))
+
+
+# Stop sending notifications for 'tables'. "TR_ChangeFeed" is the old
+# per-row trigger.
+def teardown(cursor, tables=None):
+    for table in tables or FEED_TABLES:
+        for trigger in ["TR_ChangeFeed", *ROW_TRIGGERS,
+                        "TR_ChangeFeedTruncate"]:
+            cursor.execute('DROP TRIGGER IF EXISTS "{}" ON "{}"'.format(
+                trigger, table))
+
+
+# One notification holds a list of keys, or a single key if it came from
+# an old per-row trigger, or none for a TRUNCATE.
+def parse(payload):
+    change = json.loads(payload)
+    keys = change.get("k")
+    if not isinstance(keys, list):
+        keys = [keys]
+    return [Change(change["t"], change["o"], key) for key in keys]
+
+
+# What a row's earlier change followed by a later one amounts to, e.g. a
+# row that was inserted & then updated is, to the consumer, just a new
+# row. None means there's nothing left to tell (inserted, then deleted).
+MERGED_OPS = {
+    ("I", "U"): "I",
+    ("I", "D"): None,
+    ("U", "U"): "U",
+    ("U", "D"): "D",
+    ("D", "I"): "U",
+}
+
+
+# Merge the changes to each row into one, in the order each row last
+# changed. A TRUNCATE replaces every earlier change to its table.
+def coalesce(changes):
+    merged = {}
+    for change in changes:
+        if change.op == "T":
+            for key in [key for key in merged if key[0] == change.table]:
+                del merged[key]
+        key = (change.table, change.key)
+        previous = merged.pop(key, None)
+        op = change.op
+        if previous is not None:
+            op = MERGED_OPS.get((previous.op, change.op), change.op)
+        if op is not None:
+            merged[key] = change._replace(op=op)
+    return list(merged.values())
+
+
+# The part that's the same for both subscribers: a connection of its own,
+# since LISTEN belongs to the connection & a pooled one would be handed
+# to someone else (and hear our notifications) once we gave it back.
+class _Listener:
+    def __init__(self, tables=None, dsn=DATABASE_URL):
+        self.tables = list(tables or FEED_TABLES)
+        self.conn = psycopg2.connect(dsn)
+        # Notifications are delivered between transactions, so we must
+        # never sit inside one.
+        self.conn.autocommit = True
+        cursor = self.conn.cursor()
+        for table in self.tables:
+            cursor.execute("LISTEN {}".format(channel(table)))
+
+    # Read whatever notifications have arrived, without waiting.
+    def _drain(self):
+        self.conn.poll()
+        changes = [
+            change for notify in self.conn.notifies
+            for change in parse(notify.payload)
+        ]
+        del self.conn.notifies[:]
+        return changes
+
+    def close(self):
+        self.conn.close()
+
+
+# Receive changes by blocking until they arrive, e.g.
+#   with Subscriber(["Programmer"]) as subscriber:
+#       for changes in subscriber.batches():
+#           ids = [change.key for change in changes if change.op != "D"]
+#           ... session.query(Programmer).filter(Programmer.id.in_(ids))
+class Subscriber(_Listener):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # The changes that arrive within 'timeout' seconds (None waits for as
+    # long as it takes), unmerged & in the order they were sent.
+    def poll(self, timeout=None):
+        changes = self._drain()
+        if not changes and select.select([self.conn], [], [], timeout)[0]:
+            changes = self._drain()
+        return changes
+
+    # Yield the changes a batch at a time, merged with coalesce(). Once
+    # the first change of a batch arrives we wait up to 'max_wait' seconds
+    # for more, so a burst of writes turns into one batch, not hundreds.
+    # With a 'timeout', an empty batch is yielded if nothing arrives in
+    # that time, which gives the caller a chance to stop.
+    def batches(self, max_wait=DEFAULT_MAX_WAIT, max_batch=DEFAULT_MAX_BATCH,
+                timeout=None):
+        while True:
+            changes = self.poll(timeout)
+            if not changes and timeout is None:
+                continue
+            deadline = time.monotonic() + max_wait
+            while changes and len(changes) < max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                changes += self.poll(remaining)
+            yield coalesce(changes)
+
+
+# The asyncio version, e.g.
+#   async with AsyncSubscriber(["Invoice", "InvoiceLine"]) as subscriber:
+#       async for changes in subscriber.batches():
+#           ...
+# The event loop watches the connection's socket, so waiting for changes
+# doesn't hold up any other task.
+class AsyncSubscriber(_Listener):
+    async def __aenter__(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._loop.add_reader(self.conn.fileno(), self._readable)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._loop.remove_reader(self.conn.fileno())
+        self.close()
+
+    def _readable(self):
+        for change in self._drain():
+            self._queue.put_nowait(change)
+
+    async def batches(self, max_wait=DEFAULT_MAX_WAIT,
+                      max_batch=DEFAULT_MAX_BATCH):
+        while True:
+            changes = [await self._queue.get()]
+            deadline = self._loop.time() + max_wait
+            while len(changes) < max_batch:
+                remaining = deadline - self._loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    changes.append(
+                        await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            yield coalesce(changes)
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+# Insert 'count' programmers, 'gap' seconds apart, & return when each was
+# committed, by id. The time is taken just before the commit, so the
+# latencies measured from it include the commit itself.
+def write_programmers(count, gap):
+    sent = {}
+    for number in range(count):
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'INSERT INTO "Programmer" (first_name, last_name, famous_for) '
+                "VALUES ('Change', %s, 'Change feed benchmark') RETURNING id",
+                [str(number)])
+            sent[cursor.fetchone()[0]] = time.perf_counter()
+        time.sleep(gap)
+    return sent
+
+
+def delete_programmers(ids):
+    with connection() as conn:
+        conn.cursor().execute(
+            'DELETE FROM "Programmer" WHERE id = ANY(%s)', [list(ids)])
+
+
+# Consume the change feed on a thread while writing, & return when each
+# new row was seen (by id) & how many queries the consumer ran (none).
+def measure_feed(count, gap, max_wait):
+    seen = {}
+    stop = threading.Event()
+    with Subscriber(["Programmer"]) as subscriber:
+
+        def consume():
+            for changes in subscriber.batches(max_wait, timeout=0.1):
+                now = time.perf_counter()
+                for change in changes:
+                    if change.op == "I":
+                        seen.setdefault(change.key, now)
+                if stop.is_set():
+                    return
+
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+        sent = write_programmers(count, gap)
+        time.sleep(max_wait + 0.2)
+        stop.set()
+        consumer.join()
+    return sent, seen, 0
+
+
+# The same, but by querying for new rows every 'interval' seconds the way
+# our consumers used to.
+def measure_polling(count, gap, interval):
+    seen = {}
+    queries = [0]
+    stop = threading.Event()
+
+    def poll():
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT coalesce(max(id), 0) FROM "Programmer"')
+            last_id = cursor.fetchone()[0]
+            conn.commit()
+            while not stop.wait(interval):
+                cursor.execute(
+                    'SELECT id FROM "Programmer" WHERE id > %s', [last_id])
+                conn.commit()
+                queries[0] += 1
+                now = time.perf_counter()
+                for (row_id,) in cursor.fetchall():
+                    seen.setdefault(row_id, now)
+                    last_id = max(last_id, row_id)
+
+    poller = threading.Thread(target=poll)
+    poller.start()
+    sent = write_programmers(count, gap)
+    time.sleep(interval + 0.2)
+    stop.set()
+    poller.join()
+    return sent, seen, queries[0]
+
+
+def benchmark(count, gap, intervals, max_wait):
+    with connection() as conn:
+        setup(conn.cursor(), ["Programmer"])
+    print(
+        "Consumer", "Changes seen", "p50 ms", "p95 ms", "Max ms",
+        "Queries/s", sep=" | ")
+    runs = [("change feed", lambda: measure_feed(count, gap, max_wait))]
+    runs += [
+        ("polling every {}s".format(interval),
+         lambda interval=interval: measure_polling(count, gap, interval))
+        for interval in intervals
+    ]
+    for name, run in runs:
+        started = time.perf_counter()
+        sent, seen, queries = run()
+        elapsed = time.perf_counter() - started
+        try:
+            latencies = [
+                (seen[row_id] - at) * 1000
+                for row_id, at in sent.items() if row_id in seen
+            ]
+            print(
+                name,
+                "{}/{}".format(len(latencies), len(sent)),
+                "{:.1f}".format(percentile(latencies, 50)),
+                "{:.1f}".format(percentile(latencies, 95)),
+                "{:.1f}".format(max(latencies, default=0)),
+                "{:.1f}".format(queries / elapsed),
+                sep=" | ")
+        finally:
+            delete_programmers(sent)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Set up, follow & benchmark the change feed.")
+    parser.add_argument(
+        "command", choices=["setup", "teardown", "listen", "benchmark"])
+    parser.add_argument(
+        "--tables", nargs="+", choices=list(FEED_TABLES),
+        default=list(FEED_TABLES))
+    parser.add_argument("--max-wait", type=float, default=DEFAULT_MAX_WAIT)
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument(
+        "--gap", type=float, default=0.01,
+        help="seconds between the benchmark's writes")
+    parser.add_argument(
+        "--intervals", type=float, nargs="+", default=[1, 0.1],
+        help="polling intervals to compare against, in seconds")
+    args = parser.parse_args()
+
+    if args.command == "setup":
+        with connection() as conn:
+            setup(conn.cursor(), args.tables)
+        print("Change feed triggers are installed.")
+    elif args.command == "teardown":
+        with connection() as conn:
+            teardown(conn.cursor(), args.tables)
+        print("Change feed triggers are removed.")
+    elif args.command == "listen":
+        with Subscriber(args.tables) as subscriber:
+            for changes in subscriber.batches(args.max_wait):
+                for change in changes:
+                    print(*change, sep=" | ")
+    else:
+        benchmark(args.count, args.gap, args.intervals, args.max_wait)
+
+# command to type at the terminal in order to run our code is:
+# python3 sql_changefeed.py setup --tables Programmer Invoice InvoiceLine
+# python3 sql_changefeed.py listen --tables Programmer
+# python3 sql_changefeed.py benchmark --count 200 --intervals 1 0.1
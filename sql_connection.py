@@ -0,0 +1,250 @@
+# HOW TO SHARE ONE CONNECTION POOL & ONE ENGINE BETWEEN ALL OF OUR SCRIPTS.
+
+# Opening a brand new connection to Postgres means a TCP (or socket)
+# handshake, authentication & a new server process every single time,
+# which is often slower than the query itself. Instead of every script
+# calling psycopg2.connect() or create_engine() on its own, they all import
+# this module & borrow an already-open connection from a pool.
+# Nothing here connects, or even imports psycopg2.pool or SQLAlchemy,
+# until a pool or engine is first asked for, so a short-lived script only
+# pays for the parts it actually uses.
+import contextlib
+import os
+import threading
+import time
+
+
+# The 3 slashes mean our database is hosted locally within our workspace.
+# libpq understands the same URL, so both psycopg2 & SQLAlchemy use it.
+DATABASE_URL = os.environ.get(
+    "CHINOOK_DATABASE_URL", "postgresql:///chinook")
+
+# How many connections each pool opens straight away & the most it will
+# ever open. Connections that are handed back are kept open (up to the
+# maximum) however small the minimum is.
+POOL_MIN_SIZE = int(os.environ.get("CHINOOK_POOL_MIN_SIZE", 1))
+POOL_MAX_SIZE = int(os.environ.get("CHINOOK_POOL_MAX_SIZE", 10))
+# How many extra connections SQLAlchemy may open above POOL_MAX_SIZE when
+# it's busy, which are closed again once they're handed back.
+POOL_MAX_OVERFLOW = int(os.environ.get("CHINOOK_POOL_MAX_OVERFLOW", 5))
+# Recycle connections after half an hour so none of them go stale.
+POOL_RECYCLE_SECONDS = 1800
+
+# Both the pool & the engine are only created the first time they're
+# needed, and the lock makes sure two threads can't both create one.
+_lock = threading.Lock()
+_pool = None
+_pool_slots = None
+_engine = None
+_async_engine = None
+
+# The pool (& its semaphore) each borrowed psycopg2 connection came from,
+# by id(), so putconn() gives it back to the right one even if close_all()
+# has replaced the pool in the meantime.
+_borrowed = {}
+
+# Functions to call with (DBAPI connection, seconds waited) every time a
+# connection is handed out by either pool, e.g. sql_instrumentation.py.
+_pool_wait_listeners = []
+
+# Functions to call with every engine we create, e.g. sql_cache.py.
+_engine_listeners = []
+
+
+# Register a function to be told how long each caller waited for a
+# pooled connection.
+def on_pool_wait(listener):
+    if listener not in _pool_wait_listeners:
+        _pool_wait_listeners.append(listener)
+
+
+# Register a function to be called with every SQLAlchemy engine, both
+# the one that exists now (if any) & every one created later, e.g. after
+# close_all(). The asyncio engine is passed as its .sync_engine, which is
+# what SQLAlchemy's events are attached to.
+def on_engine_created(listener):
+    if listener in _engine_listeners:
+        return
+    _engine_listeners.append(listener)
+    for engine in (_engine, _async_engine):
+        if engine is not None:
+            listener(getattr(engine, "sync_engine", engine))
+
+
+def _report_engine_created(engine):
+    for listener in _engine_listeners:
+        listener(getattr(engine, "sync_engine", engine))
+
+
+def _report_pool_wait(conn, started):
+    if _pool_wait_listeners:
+        waited = time.perf_counter() - started
+        for listener in _pool_wait_listeners:
+            listener(conn, waited)
+
+
+# SQLAlchemy's usual pool, but it also reports how long every checkout
+# took, including waiting for another caller to hand a connection back.
+# The class is only made when the engine is, along with the import.
+def _timed_queue_pool():
+    from sqlalchemy.pool import QueuePool
+
+    class TimedQueuePool(QueuePool):
+        def connect(self):
+            started = time.perf_counter()
+            fairy = super().connect()
+            _report_pool_wait(fairy.dbapi_connection, started)
+            return fairy
+
+    return TimedQueuePool
+
+
+# psycopg2's pool closes a connection that's handed back whenever it
+# already has 'minconn' idle ones, so with a minimum of 1 every other
+# concurrent borrower would open a brand new connection. This one keeps
+# up to 'maxconn' idle connections instead, but still only opens
+# 'minconn' to begin with.
+def _idle_keeping_pool():
+    from psycopg2.pool import ThreadedConnectionPool
+
+    class IdleKeepingPool(ThreadedConnectionPool):
+        def __init__(self, minconn, maxconn, *args, **kwargs):
+            super().__init__(minconn, maxconn, *args, **kwargs)
+            self.minconn = maxconn
+
+    return IdleKeepingPool
+
+
+# Return the process-wide psycopg2 pool, creating it on first use.
+def get_pool():
+    global _pool, _pool_slots
+    if _pool is None:
+        with _lock:
+            if _pool is None:
+                # ThreadedConnectionPool raises an error straight away when
+                # every connection is in use, so we guard it with a
+                # semaphore to make callers wait for a free one instead.
+                _pool_slots = threading.BoundedSemaphore(POOL_MAX_SIZE)
+                _pool = _idle_keeping_pool()(
+                    POOL_MIN_SIZE, POOL_MAX_SIZE, DATABASE_URL)
+    return _pool
+
+
+# Return the process-wide SQLAlchemy engine, creating it on first use.
+# pool_pre_ping checks each connection is still alive before handing it
+# out, so a restarted database doesn't break the next query.
+def get_engine():
+    global _engine
+    if _engine is None:
+        with _lock:
+            if _engine is None:
+                from sqlalchemy import create_engine
+                _engine = create_engine(
+                    DATABASE_URL,
+                    poolclass=_timed_queue_pool(),
+                    pool_size=POOL_MAX_SIZE,
+                    max_overflow=POOL_MAX_OVERFLOW,
+                    pool_pre_ping=True,
+                    pool_recycle=POOL_RECYCLE_SECONDS,
+                )
+                _report_engine_created(_engine)
+    return _engine
+
+
+# Return the process-wide asyncio engine, creating it on first use. It
+# talks to the same database through the asyncpg driver, which is only
+# imported here so the synchronous scripts don't need it installed.
+def get_async_engine():
+    global _async_engine
+    if _async_engine is None:
+        with _lock:
+            if _async_engine is None:
+                from sqlalchemy.ext.asyncio import create_async_engine
+                _async_engine = create_async_engine(
+                    DATABASE_URL.replace(
+                        "postgresql:", "postgresql+asyncpg:", 1),
+                    pool_size=POOL_MAX_SIZE,
+                    max_overflow=POOL_MAX_OVERFLOW,
+                    pool_pre_ping=True,
+                    pool_recycle=POOL_RECYCLE_SECONDS,
+                )
+                _report_engine_created(_async_engine)
+    return _async_engine
+
+
+# Borrow a psycopg2 connection from the pool, waiting for one to be handed
+# back if they're all in use. Every getconn() needs a matching putconn().
+def getconn():
+    get_pool()
+    with _lock:
+        pool, slots = _pool, _pool_slots
+    started = time.perf_counter()
+    slots.acquire()
+    try:
+        conn = pool.getconn()
+    except BaseException:
+        slots.release()
+        raise
+    _borrowed[id(conn)] = (pool, slots)
+    _report_pool_wait(conn, started)
+    return conn
+
+
+# Hand a borrowed connection back to the pool instead of closing it. Any
+# transaction still open is rolled back so the next borrower starts clean,
+# and a connection that died mid-query is thrown away rather than reused.
+# If close_all() has closed the pool it came from since the connection
+# was borrowed, there's nothing to give it back to, so it's just closed.
+def putconn(conn):
+    pool, slots = _borrowed.pop(id(conn), (None, None))
+    try:
+        if pool is None or pool.closed:
+            conn.close()
+            return
+        broken = bool(conn.closed)
+        if not broken:
+            try:
+                conn.rollback()
+            except Exception:
+                # The rollback fails on a broken connection, which the
+                # pool still has to be told about, or it would count the
+                # connection as borrowed forever.
+                broken = True
+        pool.putconn(conn, close=broken)
+    finally:
+        if slots is not None:
+            slots.release()
+
+
+# Borrow a psycopg2 connection for the length of a with-statement. The
+# transaction is committed if the block finishes & rolled back if it
+# raises, and the connection always goes back to the pool afterwards.
+@contextlib.contextmanager
+def connection():
+    conn = getconn()
+    try:
+        yield conn
+        conn.commit()
+    finally:
+        putconn(conn)
+
+
+# Close every pooled connection, e.g. before a worker process exits.
+def close_all():
+    global _pool, _pool_slots, _engine
+    with _lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+            _pool_slots = None
+        if _engine is not None:
+            _engine.dispose()
+            _engine = None
+
+
+# The asyncio version of close_all(), for the async engine.
+async def close_all_async():
+    global _async_engine
+    if _async_engine is not None:
+        engine, _async_engine = _async_engine, None
+        await engine.dispose()
@@ -0,0 +1,245 @@
+# HOW TO EXPORT QUERY RESULTS TO PARQUET, FEATHER, CSV, JSON & NumPy.
+
+# test.cv & test.json were made by hand from psql, and test.json even has
+# psql's table borders in it, so anything reading them has to clean them
+# up & parse them all over again.
+# This module exports any query straight from Postgres instead. It asks
+# the server for the result as CSV with COPY (SELECT ...) TO STDOUT, which
+# never builds a Python tuple (or ORM object) per row, and hands that to
+# Apache Arrow in record batches. From there the rows go to Parquet or
+# Feather files, or into a NumPy structured array of the numeric columns
+# like "Milliseconds", "Bytes" & "UnitPrice".
+# pyarrow & numpy are only needed for those formats; plain CSV & JSON work
+# without them.
+import argparse
+import datetime
+import decimal
+import json
+import tempfile
+
+from sql_connection import connection
+from sql_queries import QUERIES
+from sql_streaming import stream_query
+
+
+# The Arrow type to use for each Postgres type OID in cursor.description.
+# Anything not listed here is read as a string.
+ARROW_TYPES = {
+    16: "bool_",      # boolean
+    20: "int64",      # bigint
+    21: "int16",      # smallint
+    23: "int32",      # integer
+    700: "float32",   # real
+    701: "float64",   # double precision
+    1700: "float64",  # numeric, e.g. "UnitPrice"
+    1082: "date32",   # date
+    1114: "timestamp",  # timestamp, e.g. "InvoiceDate"
+}
+
+# How many bytes of CSV Arrow reads (and turns into a batch) at a time.
+DEFAULT_BLOCK_SIZE = 1 << 20
+
+EXTENSIONS = {
+    "parquet": ".parquet",
+    "feather": ".feather",
+    "csv": ".csv",
+    "json": ".json",
+}
+
+
+# Look up the SQL for one of the queries in sql_queries.py by name, or use
+# the SQL we're given as it is.
+def resolve(query, params=None):
+    if query in QUERIES:
+        return QUERIES[query]
+    return query, params
+
+
+# The (name, Arrow type name) of every column the query returns. Wrapping
+# the query with LIMIT 0 means Postgres only has to plan it, not run it.
+def describe(cursor, sql):
+    cursor.execute("SELECT * FROM ({}) AS q LIMIT 0".format(sql))
+    return [
+        (column.name, ARROW_TYPES.get(column.type_code, "string"))
+        for column in cursor.description
+    ]
+
+
+# Fill in the %s placeholders on the client with mogrify(), because COPY
+# can't take query parameters of its own.
+def inline_params(cursor, sql, params):
+    return cursor.mogrify(sql, params).decode(cursor.connection.encoding)
+
+
+# Write the whole result of the query as CSV (with a header row) into
+# 'output', a binary file object, using a single COPY on the server.
+def copy_csv(cursor, sql, output):
+    cursor.copy_expert(
+        "COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER true)".format(sql),
+        output)
+
+
+# Stream the query into Arrow record batches. The CSV from COPY is spooled
+# to a temporary file & read back 'block_size' bytes at a time, so memory
+# use stays flat however big the result is.
+# Returns the Arrow schema along with the batches, so callers still know
+# the columns (and can write an empty file) when the query returns no rows.
+def record_batches(query, params=None, block_size=DEFAULT_BLOCK_SIZE):
+    import pyarrow
+    from pyarrow import csv
+
+    sql, params = resolve(query, params)
+    spool = tempfile.TemporaryFile()
+    try:
+        # The pooled connection is handed back as soon as COPY is done,
+        # rather than being held while the batches are read.
+        with connection() as conn:
+            cursor = conn.cursor()
+            sql = inline_params(cursor, sql, params)
+            columns = describe(cursor, sql)
+            copy_csv(cursor, sql, spool)
+        spool.seek(0)
+
+        column_types = {
+            name: pyarrow.timestamp("us") if kind == "timestamp"
+            else getattr(pyarrow, kind)()
+            for name, kind in columns
+        }
+        reader = csv.open_csv(
+            spool,
+            read_options=csv.ReadOptions(block_size=block_size),
+            convert_options=csv.ConvertOptions(
+                column_types=column_types,
+                # COPY writes NULL as an empty field & an empty string as
+                # "", so only the unquoted ones should become null. Nothing
+                # else may count as null either, or an artist called "NA"
+                # or a track called "null" would be lost.
+                null_values=[""],
+                strings_can_be_null=True,
+                quoted_strings_can_be_null=False,
+                # Postgres writes booleans as t & f.
+                true_values=["t"],
+                false_values=["f"],
+            ),
+        )
+    except BaseException:
+        spool.close()
+        raise
+    return reader.schema, _read_batches(reader, spool)
+
+
+# The temporary file is closed once every batch has been read.
+def _read_batches(reader, spool):
+    with spool:
+        for batch in reader:
+            yield batch
+
+
+def export_parquet(query, path, params=None):
+    import pyarrow.parquet
+
+    schema, batches = record_batches(query, params)
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+
+
+# Feather (version 2) is the Arrow IPC file format, so we can write the
+# batches out exactly as they are.
+def export_feather(query, path, params=None):
+    import pyarrow.ipc
+
+    schema, batches = record_batches(query, params)
+    with pyarrow.ipc.new_file(path, schema) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+
+
+# Plain CSV with a header row, written by the server straight into the
+# file without passing through Python at all.
+def export_csv(query, path, params=None):
+    sql, params = resolve(query, params)
+    with connection() as conn:
+        cursor = conn.cursor()
+        sql = inline_params(cursor, sql, params)
+        with open(path, "wb") as output:
+            copy_csv(cursor, sql, output)
+
+
+# Values that json can't write by itself, i.e. "UnitPrice" & "InvoiceDate".
+def json_default(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(repr(value))
+
+
+# A clean JSON array of objects, one per row, streamed from a server-side
+# cursor so we never hold the whole result in memory.
+def export_json(query, path, params=None):
+    sql, params = resolve(query, params)
+    with connection() as conn:
+        cursor = conn.cursor()
+        columns = describe(cursor, inline_params(cursor, sql, params))
+    names = [name for name, _ in columns]
+    with open(path, "w") as output:
+        output.write("[")
+        for number, row in enumerate(stream_query(sql, params)):
+            output.write(",\n " if number else "\n ")
+            json.dump(dict(zip(names, row)), output, default=json_default)
+        output.write("\n]\n")
+
+
+EXPORTERS = {
+    "parquet": export_parquet,
+    "feather": export_feather,
+    "csv": export_csv,
+    "json": export_json,
+}
+
+
+# A NumPy structured array of the numeric columns of a query, e.g.
+#   tracks = numeric_array("tracks_by_composer")
+#   tracks["Milliseconds"].sum()
+# Integer columns that contain NULLs come back as floats with NaN.
+def numeric_array(query, params=None, columns=None):
+    import numpy
+    import pyarrow
+    import pyarrow.types
+
+    schema, batches = record_batches(query, params)
+    table = pyarrow.Table.from_batches(batches, schema=schema)
+    names = columns or [
+        field.name for field in table.schema
+        if pyarrow.types.is_integer(field.type)
+        or pyarrow.types.is_floating(field.type)
+    ]
+    arrays = [
+        table.column(name).to_numpy(zero_copy_only=False) for name in names
+    ]
+    result = numpy.empty(
+        table.num_rows,
+        dtype=[(name, array.dtype) for name, array in zip(names, arrays)])
+    for name, array in zip(names, arrays):
+        result[name] = array
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export a Chinook query to a columnar file.")
+    parser.add_argument(
+        "query", help="a query name from sql_queries.py, or SQL")
+    parser.add_argument(
+        "--format", choices=list(EXPORTERS), default="parquet")
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    name = args.query if args.query in QUERIES else "export"
+    output = args.output or name + EXTENSIONS[args.format]
+    EXPORTERS[args.format](args.query, output)
+    print("Exported", args.query, "to", output)
+
+# command to type at the terminal in order to run our code is:
+# python3 sql_export.py tracks_by_composer --format parquet
@@ -0,0 +1,316 @@
+# HOW TO SEE WHICH STATEMENTS ARE SLOW, HOW OFTEN THEY RUN & WHY.
+
+# None of our scripts time their queries, so when things get slow we
+# can't tell which statement is to blame.
+# This module records, for every statement sent to Postgres:
+#   - how long it took (wall-clock),
+#   - how many rows it returned or changed,
+#   - how long we waited for a pooled connection before it could run,
+# grouped by the statement's "fingerprint", i.e. its SQL with every value
+# replaced by ?, so 'WHERE "ArtistId" = 51' & '... = 52' count together.
+# Each of those goes into a histogram, so we can read off the median, the
+# 95th/99th percentile & the worst case. Any statement slower than
+# SLOW_QUERY_MS is written to the "chinook.slow_queries" log along with
+# its EXPLAIN plan.
+# SQLAlchemy engines are hooked with instrument_engine(), and psycopg2
+# cursors with connection.cursor(cursor_factory=InstrumentedCursor).
+import argparse
+import bisect
+import logging
+import os
+import re
+import runpy
+import threading
+import time
+import weakref
+
+import psycopg2
+import psycopg2.extensions
+
+from sql_connection import DATABASE_URL, get_engine, on_pool_wait
+
+
+# Statements slower than this many milliseconds go to the slow query log.
+SLOW_QUERY_MS = float(os.environ.get("CHINOOK_SLOW_QUERY_MS", 100))
+# Don't EXPLAIN the same slow statement more than once in this many
+# seconds, so a burst of slow queries doesn't turn into a burst of plans.
+EXPLAIN_INTERVAL_SECONDS = 60
+
+# The upper bound of each histogram bucket. Anything bigger than the last
+# bound goes into one extra "overflow" bucket.
+TIME_BUCKETS_MS = (
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000,
+    10000,
+)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+slow_query_log = logging.getLogger("chinook.slow_queries")
+
+# The values in a statement: quoted strings, numbers & placeholders.
+STRING_RE = re.compile(r"'(?:[^']|'')*'")
+NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+PLACEHOLDER_RE = re.compile(r"%\(\w+\)s|%s|\$\d+")
+# A list of values, e.g. IN (?, ?, ?) or VALUES (?, ?), (?, ?).
+VALUE_LIST_RE = re.compile(r"\(\?(?:, \?)*\)(?:, \(\?(?:, \?)*\))*")
+# Only these can be EXPLAINed (without ANALYZE, so nothing is run again).
+EXPLAINABLE_RE = re.compile(
+    r"^\s*(?:SELECT|WITH|VALUES|INSERT|UPDATE|DELETE)\b", re.I)
+
+
+# The statement with all of its values replaced by ?, and every list of
+# values squashed to (...), so statements that only differ in their
+# values are grouped together.
+def fingerprint(statement):
+    statement = " ".join(statement.split()).rstrip(";")
+    statement = STRING_RE.sub("?", statement)
+    statement = PLACEHOLDER_RE.sub("?", statement)
+    statement = NUMBER_RE.sub("?", statement)
+    return VALUE_LIST_RE.sub("(...)", statement)
+
+
+class Histogram:
+    # Counts how many values fall into each bucket, plus the total & the
+    # largest value, which is all we need for averages & percentiles.
+    def __init__(self, bounds=TIME_BUCKETS_MS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    # The upper bound of the bucket the p-th percentile falls into (or the
+    # largest value seen, if that's smaller or in the overflow bucket).
+    def percentile(self, p):
+        if not self.count:
+            return 0
+        wanted = p / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(bound, self.max)
+        return self.max
+
+
+class StatementStats:
+    def __init__(self):
+        self.time_ms = Histogram()
+        self.rows = Histogram(ROW_BUCKETS)
+        self.pool_wait_ms = Histogram()
+
+
+class Metrics:
+    # Every fingerprint's StatementStats, plus one histogram of every
+    # pool checkout. Callers on different threads share one Metrics.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.statements = {}
+        self.pool_wait_ms = Histogram()
+
+    def record(self, statement, seconds, rows, pool_wait):
+        key = fingerprint(statement)
+        with self._lock:
+            stats = self.statements.get(key)
+            if stats is None:
+                stats = self.statements[key] = StatementStats()
+            stats.time_ms.add(seconds * 1000)
+            # Server-side cursors & some statements report -1 rows.
+            if rows >= 0:
+                stats.rows.add(rows)
+            stats.pool_wait_ms.add(pool_wait * 1000)
+
+    def record_pool_wait(self, seconds):
+        with self._lock:
+            self.pool_wait_ms.add(seconds * 1000)
+
+    def reset(self):
+        with self._lock:
+            self.statements = {}
+            self.pool_wait_ms = Histogram()
+
+    # [(fingerprint, StatementStats)], the most total time first.
+    def slowest(self, limit=None):
+        with self._lock:
+            items = sorted(
+                self.statements.items(),
+                key=lambda item: item[1].time_ms.total,
+                reverse=True)
+        return items[:limit]
+
+
+metrics = Metrics()
+
+# How long each DBAPI connection waited in the pool before being handed
+# out, kept until the first statement that runs on it picks it up.
+_pending_waits = weakref.WeakKeyDictionary()
+_pending_lock = threading.Lock()
+
+
+def _pool_waited(conn, seconds):
+    metrics.record_pool_wait(seconds)
+    with _pending_lock:
+        _pending_waits[conn] = seconds
+
+
+def _take_pool_wait(conn):
+    with _pending_lock:
+        return _pending_waits.pop(conn, 0.0)
+
+
+on_pool_wait(_pool_waited)
+
+
+# The plans for the slow query log come from a connection of their own,
+# so that EXPLAINing can't break the caller's transaction or take a
+# connection from a pool that may already be exhausted.
+_explain_lock = threading.Lock()
+_explain_conn = None
+_last_explained = {}
+
+
+def explain(statement, parameters=None):
+    global _explain_conn
+    with _explain_lock:
+        try:
+            if _explain_conn is None or _explain_conn.closed:
+                _explain_conn = psycopg2.connect(DATABASE_URL)
+                _explain_conn.autocommit = True
+            cursor = _explain_conn.cursor()
+            cursor.execute("EXPLAIN " + statement, parameters or None)
+            return "\n".join(row[0] for row in cursor.fetchall())
+        except psycopg2.Error as error:
+            return "(no plan: {})".format(str(error).strip())
+
+
+# Record one finished statement, and log it if it was slow.
+def observe(conn, statement, parameters, seconds, rows, executemany=False):
+    metrics.record(statement, seconds, rows, _take_pool_wait(conn))
+    if seconds * 1000 < SLOW_QUERY_MS:
+        return
+    key = fingerprint(statement)
+    now = time.monotonic()
+    plan = "(plan logged less than {}s ago)".format(EXPLAIN_INTERVAL_SECONDS)
+    if (not executemany and EXPLAINABLE_RE.match(statement)
+            and now - _last_explained.get(key, -EXPLAIN_INTERVAL_SECONDS)
+            >= EXPLAIN_INTERVAL_SECONDS):
+        _last_explained[key] = now
+        plan = explain(statement, parameters)
+    slow_query_log.warning(
+        "%.1f ms, %s rows: %s\n%s", seconds * 1000, rows, key, plan)
+
+
+# The SQLAlchemy hooks. A connection can run a statement from inside
+# another listener, so the start times are kept as a stack.
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    seconds = time.perf_counter() - conn.info["query_started"].pop()
+    observe(cursor.connection, statement, parameters, seconds,
+            cursor.rowcount, executemany)
+
+
+# Start recording every statement that runs through a SQLAlchemy engine
+# (the shared one from sql_connection.py unless we're given another).
+# Calling it again for the same engine does nothing. SQLAlchemy is only
+# imported here, so psycopg2-only scripts like sql-psycopg2.py never load it.
+def instrument_engine(engine=None):
+    from sqlalchemy import event
+
+    engine = engine or get_engine()
+    if not event.contains(
+            engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    return engine
+
+
+# A psycopg2 cursor that records every statement it runs, e.g.
+#   cursor = connection.cursor(cursor_factory=InstrumentedCursor)
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        result = super().execute(query, vars)
+        observe(self.connection, self._text(query), vars,
+                time.perf_counter() - started, self.rowcount)
+        return result
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        result = super().executemany(query, vars_list)
+        observe(self.connection, self._text(query), None,
+                time.perf_counter() - started, self.rowcount, True)
+        return result
+
+    # Queries can also be bytes or psycopg2.sql objects.
+    def _text(self, query):
+        if isinstance(query, bytes):
+            return query.decode(self.connection.encoding)
+        if not isinstance(query, str):
+            return query.as_string(self.connection)
+        return query
+
+
+def print_report(limit=20):
+    print(
+        "Calls", "Total ms", "p50 ms", "p95 ms", "p99 ms", "Max ms",
+        "Avg rows", "p95 pool wait ms", "Statement", sep=" | ")
+    for key, stats in metrics.slowest(limit):
+        timing = stats.time_ms
+        print(
+            timing.count,
+            "{:.1f}".format(timing.total),
+            "{:.2f}".format(timing.percentile(50)),
+            "{:.2f}".format(timing.percentile(95)),
+            "{:.2f}".format(timing.percentile(99)),
+            "{:.2f}".format(timing.max),
+            "{:.1f}".format(stats.rows.mean()),
+            "{:.2f}".format(stats.pool_wait_ms.percentile(95)),
+            key[:100],
+            sep=" | "
+        )
+    waits = metrics.pool_wait_ms
+    print()
+    print(
+        "Pool checkouts:", waits.count,
+        "p50 {:.2f} ms, p95 {:.2f} ms, max {:.2f} ms".format(
+            waits.percentile(50), waits.percentile(95), waits.max))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run one of our scripts & report on its statements.")
+    parser.add_argument("script", help="e.g. sql-orm.py")
+    parser.add_argument(
+        "--slow-ms", type=float, default=SLOW_QUERY_MS,
+        help="log statements slower than this with their EXPLAIN plan")
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    # The script imports this module under its real name, so we use that
+    # copy too rather than this __main__ one, and both share one Metrics.
+    import sql_instrumentation
+
+    sql_instrumentation.SLOW_QUERY_MS = args.slow_ms
+    logging.basicConfig(format="SLOW QUERY %(message)s")
+    sql_instrumentation.instrument_engine()
+    try:
+        runpy.run_path(args.script, run_name="__main__")
+    finally:
+        print()
+        sql_instrumentation.print_report(args.limit)
+
+# command to type at the terminal in order to run our code is:
+# python3 sql_instrumentation.py sql-orm.py --slow-ms 50
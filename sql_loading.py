@@ -0,0 +1,128 @@
+# HOW TO WALK Artist -> Album -> Track WITHOUT ONE QUERY PER ROW.
+
+# With the relationships in sql_models.py, artist.albums & album.tracks
+# are loaded "lazily": the first time we touch them, the ORM runs another
+# query for just that one parent. Looping over 10 albums & their tracks
+# is therefore 1 query for the artist + 1 for the albums + 10 for the
+# tracks, which is known as the "N+1 problem".
+# Here every query picks its loading strategy up front instead:
+#   "selectin" - one extra SELECT ... WHERE id IN (...) per relationship.
+#   "joined"   - everything in one SELECT with LEFT OUTER JOINs.
+#   "lazy"     - the default one-query-per-parent behaviour, for comparison.
+import contextlib
+
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload, lazyload, selectinload, sessionmaker
+
+from sql_connection import get_engine
+from sql_models import Album, Artist, Track
+
+
+LOADERS = {
+    "selectin": selectinload,
+    "joined": joinedload,
+    "lazy": lazyload,
+}
+
+
+# Artist #51 with all of their albums & every track on each album.
+def artist_catalogue(session, artist_id=51, strategy="selectin"):
+    loader = LOADERS[strategy]
+    return (
+        session.query(Artist)
+        .options(loader(Artist.albums).options(loader(Album.tracks)))
+        .filter_by(ArtistId=artist_id)
+        .first()
+    )
+
+
+# Every track by a composer, along with its album, artist, genre & media
+# type, e.g. for printing a full track listing.
+def tracks_with_details(session, composer="Queen", strategy="selectin"):
+    loader = LOADERS[strategy]
+    return (
+        session.query(Track)
+        .options(
+            loader(Track.album).options(loader(Album.artist)),
+            loader(Track.genre),
+            loader(Track.media_type),
+        )
+        .filter_by(Composer=composer)
+        .all()
+    )
+
+
+# Count every statement sent through the engine inside a with-block:
+#   with count_queries() as queries:
+#       ...
+#   print(queries.count)
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+    def __call__(self, conn, cursor, statement, parameters, context,
+                 executemany):
+        self.count += 1
+        self.statements.append(statement)
+
+
+@contextlib.contextmanager
+def count_queries(engine=None):
+    engine = engine or get_engine()
+    counter = QueryCounter()
+    event.listen(engine, "before_cursor_execute", counter)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, "before_cursor_execute", counter)
+
+
+# Fail loudly if the block runs more than 'expected' statements, so a
+# relationship that slips back into lazy loading is caught straight away.
+@contextlib.contextmanager
+def assert_max_queries(expected, engine=None):
+    with count_queries(engine) as counter:
+        yield counter
+    if counter.count > expected:
+        raise AssertionError(
+            "Expected at most {} queries but {} were run:\n{}".format(
+                expected, counter.count, "\n".join(counter.statements)))
+
+
+# Touch every album & track, the way a page listing them would.
+def walk_catalogue(artist):
+    return sum(len(album.tracks) for album in artist.albums)
+
+
+# How many queries each strategy needs to walk artist 51's catalogue.
+# selectin: artist + albums + tracks = 3, joined: 1, lazy: 2 + one per album.
+EXPECTED_QUERIES = {"selectin": 3, "joined": 1}
+
+
+if __name__ == "__main__":
+    Session = sessionmaker(get_engine())
+    print("Strategy", "Queries", "Tracks", sep=" | ")
+    for strategy in ("lazy", "selectin", "joined"):
+        session = Session()
+        try:
+            with count_queries() as counter:
+                tracks = walk_catalogue(
+                    artist_catalogue(session, strategy=strategy))
+            print(strategy, counter.count, tracks, sep=" | ")
+        finally:
+            session.close()
+
+    # Prove the N+1 is gone: these must stay at a fixed number of queries
+    # however many albums the artist has.
+    for strategy, expected in EXPECTED_QUERIES.items():
+        session = Session()
+        try:
+            with assert_max_queries(expected):
+                walk_catalogue(artist_catalogue(session, strategy=strategy))
+        finally:
+            session.close()
+    print("OK - no N+1 queries with selectin or joined loading.")
+
+# command to type at the terminal in order to run our code is:
+# python3 sql_loading.py
@@ -0,0 +1,201 @@
+# THE CHINOOK MODELS SHARED BY OUR ORM SCRIPTS & TOOLS.
+
+# These class-based models used to live in sql-orm.py. They now live in
+# their own module so that every script & tool can import the same
+# classes instead of each one declaring its own copy.
+# We don't need to import the Table class here because with
+# the ORM, we won't create tables but instead, we'll be
+# creating Python classes. These Python classes that we'll
+# create will subclass the declarative_base, meaning that
+# any class we're making will extend from the main class
+# within the ORM.
+from sqlalchemy import (
+    Column, DateTime, Float, ForeignKey, Integer, String
+)
+from sqlalchemy.ext.declarative import declarative_base
+# relationship() lets us walk from one model to the rows it's linked to,
+# e.g. artist.albums or track.album, instead of writing the query by hand.
+from sqlalchemy.orm import relationship
+
+
+# We'll make a variable called 'base' which will be set to the
+# declarative_base() class. This new 'base' class will essent-
+# ially grab the metadata that is produced by our database
+# table schema & create a subclass to map everything back to us
+# here within the 'base' variable i.e we're piggybacking off of
+# an existing ORM class & let it do all of the dirty work while
+# we're reaping the benefits from it behind the scenes.
+base = declarative_base()
+
+
+# We'll start to build our class-based models by simply building
+# a normal Python object that subclasses 'base'. We'll work with
+# the same 3 tables in 'chinook' database as before i.e Artist,
+# Album & Track (plus the Genre & MediaType tables that every Track
+# points to) but ensure these are added before the Session is
+# created but after the base is declared since we need to use the
+# base subclass.
+# NOTE: For best practice, it's best to use PascalCase (i.e the
+# first letter of each word is capitalized) when defining your
+# classes in Python & don't use underscores.
+# Create a class-based model for the "Artist" table.
+class Artist(base):
+    __tablename__ = "Artist"
+    ArtistId = Column(Integer, primary_key=True)
+    Name = Column(String)
+    # Every Album whose "ArtistId" points at this artist. back_populates
+    # links it to Album.artist, so both sides always agree.
+    albums = relationship("Album", back_populates="artist")
+
+
+# Create a class-based model for the "Album" table.
+class Album(base):
+    __tablename__ = "Album"
+    AlbumId = Column(Integer, primary_key=True)
+    Title = Column(String)
+    ArtistId = Column(Integer, ForeignKey("Artist.ArtistId"))
+    artist = relationship("Artist", back_populates="albums")
+    tracks = relationship("Track", back_populates="album")
+
+
+# Create a class-based model for the "Genre" table.
+class Genre(base):
+    __tablename__ = "Genre"
+    GenreId = Column(Integer, primary_key=True)
+    Name = Column(String)
+    tracks = relationship("Track", back_populates="genre")
+
+
+# Create a class-based model for the "MediaType" table.
+class MediaType(base):
+    __tablename__ = "MediaType"
+    MediaTypeId = Column(Integer, primary_key=True)
+    Name = Column(String)
+    tracks = relationship("Track", back_populates="media_type")
+
+
+# Create a class-based model for the "Track" table.
+class Track(base):
+    __tablename__ = "Track"
+    TrackId = Column(Integer, primary_key=True)
+    Name = Column(String)
+    AlbumId = Column(Integer, ForeignKey("Album.AlbumId"))
+    MediaTypeId = Column(Integer, ForeignKey("MediaType.MediaTypeId"))
+    GenreId = Column(Integer, ForeignKey("Genre.GenreId"))
+    Composer = Column(String)
+    Milliseconds = Column(Integer, primary_key=False)
+    Bytes = Column(Integer, primary_key=False)
+    # If we ever confuse Float with Decimal & are in
+    # doubt as to which is the right one to use, just
+    # check on the SQLAlchemy documentation under the
+    # section called "Column and Data Types".
+    UnitPrice = Column(Float)
+    album = relationship("Album", back_populates="tracks")
+    genre = relationship("Genre", back_populates="tracks")
+    media_type = relationship("MediaType", back_populates="tracks")
+
+
+# Create a class-based model for the "Playlist" table.
+class Playlist(base):
+    __tablename__ = "Playlist"
+    PlaylistId = Column(Integer, primary_key=True)
+    Name = Column(String)
+
+
+# Create a class-based model for the "PlaylistTrack" table, which links
+# playlists to their tracks. Its primary key is both columns together.
+class PlaylistTrack(base):
+    __tablename__ = "PlaylistTrack"
+    PlaylistId = Column(
+        Integer, ForeignKey("Playlist.PlaylistId"), primary_key=True)
+    TrackId = Column(Integer, ForeignKey("Track.TrackId"), primary_key=True)
+    playlist = relationship("Playlist")
+    track = relationship("Track")
+
+
+# Create a class-based model for the "Customer" table.
+class Customer(base):
+    __tablename__ = "Customer"
+    CustomerId = Column(Integer, primary_key=True)
+    FirstName = Column(String)
+    LastName = Column(String)
+    Company = Column(String)
+    City = Column(String)
+    State = Column(String)
+    Country = Column(String)
+    Email = Column(String)
+    invoices = relationship("Invoice", back_populates="customer")
+
+
+# Create a class-based model for the "Invoice" table.
+class Invoice(base):
+    __tablename__ = "Invoice"
+    InvoiceId = Column(Integer, primary_key=True)
+    CustomerId = Column(Integer, ForeignKey("Customer.CustomerId"))
+    InvoiceDate = Column(DateTime)
+    BillingCity = Column(String)
+    BillingCountry = Column(String)
+    Total = Column(Float)
+    customer = relationship("Customer", back_populates="invoices")
+    lines = relationship("InvoiceLine", back_populates="invoice")
+
+
+# Create a class-based model for the "InvoiceLine" table.
+class InvoiceLine(base):
+    __tablename__ = "InvoiceLine"
+    InvoiceLineId = Column(Integer, primary_key=True)
+    InvoiceId = Column(Integer, ForeignKey("Invoice.InvoiceId"))
+    TrackId = Column(Integer, ForeignKey("Track.TrackId"))
+    UnitPrice = Column(Float)
+    Quantity = Column(Integer)
+    invoice = relationship("Invoice", back_populates="lines")
+    track = relationship("Track")
+
+
+# Create a class-based model for the "Programmer" table.
+class Programmer(base):
+    # The __tablename__ will match the class itself, "Programmer".
+    __tablename__ = "Programmer"
+    id = Column(Integer, primary_key=True)
+    first_name = Column(String)
+    last_name = Column(String)
+    gender = Column(String)
+    nationality = Column(String)
+    famous_for = Column(String)
+
+
+# The reporting rollups in sql_rollups.py are materialized views, not
+# tables, so their models get a base of their own. That way
+# base.metadata.create_all() in sql_startup.py's migrate never tries to
+# create a plain table with the same name as one of the views.
+reporting_base = declarative_base()
+
+
+# Create a class-based model for the "SalesByArtist" materialized view.
+class SalesByArtist(reporting_base):
+    __tablename__ = "SalesByArtist"
+    ArtistId = Column(Integer, primary_key=True)
+    Name = Column(String)
+    Invoices = Column(Integer)
+    Quantity = Column(Integer)
+    Revenue = Column(Float)
+
+
+# Create a class-based model for the "SalesByGenre" materialized view.
+class SalesByGenre(reporting_base):
+    __tablename__ = "SalesByGenre"
+    GenreId = Column(Integer, primary_key=True)
+    Name = Column(String)
+    Invoices = Column(Integer)
+    Quantity = Column(Integer)
+    Revenue = Column(Float)
+
+
+# Create a class-based model for the "MonthlyInvoiceTotal" materialized
+# view, one row per calendar month.
+class MonthlyInvoiceTotal(reporting_base):
+    __tablename__ = "MonthlyInvoiceTotal"
+    Month = Column(DateTime, primary_key=True)
+    Invoices = Column(Integer)
+    Customers = Column(Integer)
+    Revenue = Column(Float)
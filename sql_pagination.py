@@ -0,0 +1,238 @@
+# HOW TO PAGE THROUGH BIG TABLES WITHOUT OFFSET.
+
+# The usual way to show page N of a table is
+#   SELECT * FROM "PlaylistTrack" ORDER BY ... LIMIT 50 OFFSET 50 * N
+# but OFFSET doesn't skip rows for free: Postgres reads & throws away
+# every one of those 50 * N rows first, so the deeper we page the slower
+# it gets. Query 11 in sql-psycopg2.py avoids paging altogether by
+# fetching the whole "Album" table, which only works while it's small.
+# Keyset (or "seek") pagination remembers the key of the last row on the
+# page instead, and asks for the rows that come after it:
+#   SELECT * FROM "PlaylistTrack"
+#   WHERE ("PlaylistId", "TrackId") > (1, 3500)
+#   ORDER BY "PlaylistId", "TrackId" LIMIT 50
+# which the primary key index answers by jumping straight to (1, 3500),
+# however deep into the table that is.
+# The key of the last row is handed to the caller as an opaque "cursor"
+# string, so they only ever pass back what we gave them.
+import argparse
+import base64
+import binascii
+import collections
+import datetime
+import decimal
+import json
+import time
+
+from sqlalchemy import func, inspect, select, tuple_
+from sqlalchemy.orm import sessionmaker
+
+from sql_connection import get_engine
+from sql_models import InvoiceLine, PlaylistTrack, Track
+
+
+DEFAULT_PAGE_SIZE = 50
+
+# One page of results, plus the cursor for the page after it (None if
+# this is the last page).
+Page = collections.namedtuple("Page", ["rows", "next_cursor"])
+
+
+# Key values json can't write by itself are written as {"type": "text"}
+# objects, so they come back as the same type rather than as strings.
+CURSOR_TYPES = {
+    "datetime": (datetime.datetime, datetime.datetime.fromisoformat),
+    "date": (datetime.date, datetime.date.fromisoformat),
+    "decimal": (decimal.Decimal, decimal.Decimal),
+}
+
+
+def cursor_default(value):
+    # datetime is checked before date, since it's a subclass of it.
+    for name, (kind, _) in CURSOR_TYPES.items():
+        if isinstance(value, kind):
+            return {name: value.isoformat() if name != "decimal"
+                    else str(value)}
+    raise TypeError(repr(value))
+
+
+def cursor_object_hook(value):
+    if len(value) == 1:
+        (name, text), = value.items()
+        if name in CURSOR_TYPES:
+            return CURSOR_TYPES[name][1](text)
+    return value
+
+
+# Turn the key of the last row into an opaque, URL-safe cursor. The names
+# of the key columns go in too, so a cursor from one table can't be used
+# to page through another.
+def encode_cursor(columns, values):
+    payload = json.dumps(
+        {"k": [column.name for column in columns], "v": list(values)},
+        separators=(",", ":"), default=cursor_default)
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+# Turn a cursor back into the key values it holds, checking that it was
+# made for these key columns.
+def decode_cursor(cursor, columns):
+    try:
+        payload = json.loads(
+            base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)),
+            object_hook=cursor_object_hook)
+        names, values = payload["k"], payload["v"]
+    except (binascii.Error, ValueError, TypeError, KeyError,
+            decimal.InvalidOperation):
+        raise ValueError("Invalid pagination cursor: {!r}".format(cursor))
+    if (not isinstance(names, list) or not isinstance(values, list)
+            or len(values) != len(names)):
+        raise ValueError("Invalid pagination cursor: {!r}".format(cursor))
+    expected = [column.name for column in columns]
+    if names != expected:
+        raise ValueError(
+            "Pagination cursor is for ({}), not ({})".format(
+                ", ".join(map(str, names)), ", ".join(expected)))
+    return values
+
+
+# Only the rows whose key comes after the cursor, in key order. A row
+# value comparison like ("PlaylistId", "TrackId") > (1, 3500) is what lets
+# Postgres use the composite primary key index to seek to the right place.
+def seek(statement, columns, cursor):
+    if cursor is not None:
+        values = decode_cursor(cursor, columns)
+        if len(columns) == 1:
+            statement = statement.where(columns[0] > values[0])
+        else:
+            statement = statement.where(tuple_(*columns) > tuple_(*values))
+    return statement.order_by(None).order_by(*columns)
+
+
+# We ask for one row more than the page size, so we know whether there's
+# another page without a separate COUNT(*).
+def make_page(rows, columns, page_size, key):
+    if len(rows) <= page_size:
+        return Page(rows, None)
+    rows = rows[:page_size]
+    return Page(rows, encode_cursor(columns, key(rows[-1])))
+
+
+# Page through a Core Table (or any select() on one), e.g.
+#   page = paginate_table(conn, track_table)
+#   page = paginate_table(conn, track_table, cursor=page.next_cursor)
+# By default the table's primary key is used as the key.
+def paginate_table(conn, table, cursor=None, page_size=DEFAULT_PAGE_SIZE,
+                   columns=None, statement=None):
+    columns = list(columns or table.primary_key.columns)
+    statement = seek(
+        statement if statement is not None else select(table),
+        columns, cursor)
+    rows = conn.execute(statement.limit(page_size + 1)).fetchall()
+    return make_page(
+        rows, columns, page_size,
+        lambda row: [row._mapping[column] for column in columns])
+
+
+# Page through an ORM query on one model, e.g.
+#   page = paginate_query(session.query(Track).filter_by(GenreId=1))
+#   page = paginate_query(..., cursor=page.next_cursor)
+# Any ORDER BY on the query is replaced by the model's primary key.
+def paginate_query(query, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    mapper = inspect(query.column_descriptions[0]["entity"])
+    columns = list(mapper.primary_key)
+    rows = seek(query, columns, cursor).limit(page_size + 1).all()
+    return make_page(
+        rows, columns, page_size, mapper.primary_key_from_instance)
+
+
+# Every page in turn, e.g. for exporting a whole table in chunks.
+def iterate_pages(fetch_page, page_size=DEFAULT_PAGE_SIZE):
+    cursor = None
+    while True:
+        page = fetch_page(cursor=cursor, page_size=page_size)
+        yield page
+        if page.next_cursor is None:
+            return
+        cursor = page.next_cursor
+
+
+# The OFFSET way of getting page number 'page', for comparison.
+def offset_page(conn, table, page, page_size=DEFAULT_PAGE_SIZE):
+    columns = list(table.primary_key.columns)
+    return conn.execute(
+        select(table).order_by(*columns)
+        .limit(page_size).offset(page * page_size)).fetchall()
+
+
+# The cursor that a client paging from the start would be holding when
+# asking for page number 'page'.
+def cursor_for_page(conn, table, page, page_size=DEFAULT_PAGE_SIZE):
+    if page == 0:
+        return None
+    columns = list(table.primary_key.columns)
+    row = conn.execute(
+        select(*columns).order_by(*columns)
+        .limit(1).offset(page * page_size - 1)).fetchone()
+    return encode_cursor(columns, list(row))
+
+
+def fastest(run, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+# The latency of fetching pages at different depths with OFFSET & keyset
+# pagination, for each table.
+def benchmark(models, page_size, repeat, depths=(0, 0.25, 0.5, 0.75, 1)):
+    print(
+        "Table", "Page", "Of", "OFFSET ms", "Keyset ms", "Keyset ORM ms",
+        sep=" | ")
+    Session = sessionmaker(get_engine())
+    for model in models:
+        table = model.__table__
+        session = Session()
+        try:
+            with get_engine().connect() as conn:
+                rows = conn.execute(
+                    select(func.count()).select_from(table)).scalar()
+                pages = max((rows - 1) // page_size, 0)
+                for depth in depths:
+                    page = int(pages * depth)
+                    cursor = cursor_for_page(conn, table, page, page_size)
+                    print(
+                        table.name,
+                        page,
+                        pages,
+                        "{:.3f}".format(fastest(
+                            lambda: offset_page(conn, table, page, page_size),
+                            repeat)),
+                        "{:.3f}".format(fastest(
+                            lambda: paginate_table(
+                                conn, table, cursor, page_size),
+                            repeat)),
+                        "{:.3f}".format(fastest(
+                            lambda: paginate_query(
+                                session.query(model), cursor, page_size),
+                            repeat)),
+                        sep=" | "
+                    )
+        finally:
+            session.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare OFFSET & keyset pagination at every depth.")
+    parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    benchmark([Track, PlaylistTrack, InvoiceLine], args.page_size, args.repeat)
+
+# command to type at the terminal in order to run our code is:
+# python3 sql_pagination.py --page-size 50
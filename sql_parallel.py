@@ -0,0 +1,213 @@
+# HOW TO READ A WHOLE TABLE USING EVERY CPU CORE.
+
+# session.query(Track).all() or SELECT * FROM "InvoiceLine" runs on one
+# connection, and turning every row into Python objects happens on one
+# core. On a big table that conversion, not Postgres, is what we wait on.
+# A parallel scan splits the table into ranges of its primary key, e.g.
+#   "TrackId" < 1000, 1000 <= "TrackId" < 2000, ..., "TrackId" >= 9000
+# and reads each range in its own worker process, on that process's own
+# pooled connection, so the conversion is spread over all the cores.
+# Every worker reads from the same snapshot of the database (exported by
+# the process that starts the scan), so the ranges fit together exactly
+# as if the table had been read in one go, even if it's being written to.
+import argparse
+import itertools
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from sqlalchemy import select, text
+
+from sql_connection import connection, get_engine
+from sql_models import base
+
+
+# The primary key each table is split on.
+SCAN_KEYS = {
+    "Track": "TrackId",
+    "Album": "AlbumId",
+    "Invoice": "InvoiceId",
+    "InvoiceLine": "InvoiceLineId",
+}
+
+# How many ranges to make per worker. More, smaller ranges keep every
+# worker busy even when some ranges are slower than others.
+RANGES_PER_WORKER = 4
+
+
+# Split the key into 'parts' ranges with about the same number of rows in
+# each, as [(low, high), ...] where low is inclusive, high is exclusive &
+# None means "no limit". percentile_disc picks the boundaries by reading
+# the primary key index once.
+def key_ranges(cursor, table, parts):
+    key = SCAN_KEYS[table]
+    cursor.execute(
+        'SELECT percentile_disc(%s::float8[]) WITHIN GROUP (ORDER BY "{}") '
+        'FROM "{}"'.format(key, table),
+        [[part / parts for part in range(1, parts)]])
+    bounds = sorted(set(
+        bound for bound in (cursor.fetchone()[0] or []) if bound is not None))
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+# Start a REPEATABLE READ transaction & return the id of its snapshot,
+# which other connections can then read from with SNAPSHOT_STATEMENTS.
+def export_snapshot(cursor):
+    cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+    cursor.execute("SELECT pg_export_snapshot()")
+    return cursor.fetchone()[0]
+
+
+# These must be the first statements of the worker's transaction.
+SNAPSHOT_STATEMENTS = [
+    "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ",
+    "SET TRANSACTION SNAPSHOT '{}'",
+]
+
+
+def range_sql(table, low, high):
+    key = SCAN_KEYS[table]
+    conditions, params = [], []
+    if low is not None:
+        conditions.append('"{}" >= %s'.format(key))
+        params.append(low)
+    if high is not None:
+        conditions.append('"{}" < %s'.format(key))
+        params.append(high)
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    return 'SELECT * FROM "{}"{}'.format(table, where), params
+
+
+# What the worker processes run: read one range of a table & return its
+# rows, or whatever 'process' makes of them (e.g. a sum), so that work is
+# spread over the workers too instead of all landing on the caller.
+def scan_range_psycopg2(job):
+    table, low, high, snapshot, process = job
+    sql, params = range_sql(table, low, high)
+    with connection() as conn:
+        cursor = conn.cursor()
+        if snapshot is not None:
+            for statement in SNAPSHOT_STATEMENTS:
+                cursor.execute(statement.format(snapshot))
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    return process(rows) if process is not None else rows
+
+
+def scan_range_core(job):
+    table_name, low, high, snapshot, process = job
+    table = base.metadata.tables[table_name]
+    key = table.c[SCAN_KEYS[table_name]]
+    statement = select(table)
+    if low is not None:
+        statement = statement.where(key >= low)
+    if high is not None:
+        statement = statement.where(key < high)
+    with get_engine().connect() as conn:
+        if snapshot is not None:
+            for sql in SNAPSHOT_STATEMENTS:
+                conn.execute(text(sql.format(snapshot)))
+        rows = [tuple(row) for row in conn.execute(statement)]
+    return process(rows) if process is not None else rows
+
+
+SCANNERS = {"psycopg2": scan_range_psycopg2, "core": scan_range_core}
+
+
+# A pool of worker processes for parallel_scan(). "spawn" starts each one
+# from scratch, so none of them inherit the caller's open connections.
+def scan_executor(workers=None):
+    return ProcessPoolExecutor(
+        workers or os.cpu_count(),
+        mp_context=multiprocessing.get_context("spawn"))
+
+
+# Read a whole table in parallel & yield each range's result as soon as
+# it's ready, e.g.
+#   with scan_executor() as executor:
+#       for rows in parallel_scan("InvoiceLine", executor):
+#           ...
+# With ordered=True the ranges come back in key order instead. 'process'
+# has to be a top-level function so it can be sent to the workers.
+# By default there are RANGES_PER_WORKER ranges for each of the
+# executor's workers (not each of the machine's cores), since every range
+# costs a connection & a snapshot import of its own.
+def parallel_scan(table, executor, path="psycopg2", parts=None,
+                  process=None, ordered=False):
+    workers = getattr(executor, "_max_workers", None) or os.cpu_count()
+    parts = parts or workers * RANGES_PER_WORKER
+    with connection() as conn:
+        # The snapshot only exists while this transaction is open, so we
+        # hold on to the connection until every range has been read.
+        cursor = conn.cursor()
+        snapshot = export_snapshot(cursor)
+        jobs = [
+            (table, low, high, snapshot, process)
+            for low, high in key_ranges(cursor, table, parts)
+        ]
+        futures = [executor.submit(SCANNERS[path], job) for job in jobs]
+        for future in (futures if ordered else as_completed(futures)):
+            yield future.result()
+
+
+# The whole table as one list of rows, in key order.
+def parallel_fetch_all(table, executor, path="psycopg2", parts=None):
+    return list(itertools.chain.from_iterable(
+        parallel_scan(table, executor, path, parts, ordered=True)))
+
+
+# The ordinary way, on one connection in this process, for comparison.
+def serial_fetch_all(table, path="psycopg2"):
+    return SCANNERS[path]((table, None, None, None, None))
+
+
+def timed(run):
+    started = time.perf_counter()
+    rows = run()
+    return time.perf_counter() - started, len(rows)
+
+
+def benchmark(tables, worker_counts, repeat):
+    print(
+        "Table", "Path", "Workers", "Rows", "Seconds", "Speed-up",
+        sep=" | ")
+    for table in tables:
+        for path in SCANNERS:
+            serial = min(
+                timed(lambda: serial_fetch_all(table, path))[0]
+                for _ in range(repeat))
+            print(table, path, "serial", "-", "{:.3f}".format(serial), "1.0",
+                  sep=" | ")
+            for workers in worker_counts:
+                with scan_executor(workers) as executor:
+                    # The first scan also starts the worker processes.
+                    parallel_fetch_all(table, executor, path)
+                    runs = [
+                        timed(lambda: parallel_fetch_all(
+                            table, executor, path))
+                        for _ in range(repeat)
+                    ]
+                elapsed, rows = min(runs)
+                print(
+                    table, path, workers, rows, "{:.3f}".format(elapsed),
+                    "{:.1f}".format(serial / elapsed), sep=" | ")
+
+
+if __name__ == "__main__":
+    cores = os.cpu_count()
+    parser = argparse.ArgumentParser(
+        description="Compare serial & parallel full-table reads.")
+    parser.add_argument(
+        "--tables", nargs="+", choices=list(SCAN_KEYS),
+        default=["Track", "InvoiceLine"])
+    parser.add_argument(
+        "--workers", type=int, nargs="+",
+        default=sorted({1, 2, 4, cores} & set(range(1, cores + 1))))
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    benchmark(args.tables, args.workers, args.repeat)
+
+# command to type at the terminal in order to run our code is:
+# python3 sql_scaling.py generate --scale 100   (to have enough rows)
+# python3 sql_parallel.py --tables Track InvoiceLine --workers 1 2 4 8
@@ -0,0 +1,656 @@
+# HOW TO SPLIT "Invoice" & "InvoiceLine" INTO ONE TABLE PER MONTH.
+
+# "Invoice" & "InvoiceLine" only ever grow, and Chinook only indexes them
+# by "CustomerId" & "InvoiceId", so every "sales for last month" query
+# reads the whole history to find the few rows it wants.
+# "python3 sql_partitioning.py migrate" turns both tables into tables
+# partitioned by "InvoiceDate", i.e. one partition (an ordinary table
+# underneath) per calendar month, e.g. "Invoice_2013_12". A query whose
+# WHERE clause limits "InvoiceDate" to a range is then only run against
+# the partitions for that range; Postgres skips (or "prunes") the rest.
+# To make that work for "InvoiceLine" too, each line gets a copy of its
+# invoice's "InvoiceDate", and the primary keys become ("InvoiceId",
+# "InvoiceDate") & ("InvoiceLineId", "InvoiceDate"), since a partitioned
+# table's primary key has to include the column it's partitioned by.
+# Code that inserts lines without an "InvoiceDate" (like the InvoiceLine
+# model, which doesn't know about it) still works: see LINE_DATE_FUNCTION.
+# Changing an invoice's "InvoiceDate" changes its lines' copy too (ON
+# UPDATE CASCADE), which moves them to the right month. Moving an invoice
+# to a different month needs Postgres 15 or later; older versions treat
+# it as a delete, which its lines then refuse.
+# Pruning only happens when the date column is compared directly, e.g.
+#   "InvoiceDate" >= '2013-01-01' AND "InvoiceDate" < '2013-02-01'
+# and never for date_trunc('month', "InvoiceDate") = ... or extract(...),
+# so the helpers below always build the first kind.
+# "maintain" creates the partitions for the coming months (run it from
+# cron), and "detach" takes old months out of the tables so they can be
+# archived or dropped without touching the rest.
+import argparse
+import datetime
+import re
+import time
+
+from sqlalchemy import (
+    DateTime, and_, func, literal, literal_column, select
+)
+from sqlalchemy.orm import sessionmaker
+
+from sql_connection import connection, get_engine
+from sql_models import Invoice, InvoiceLine
+
+
+# The tables we partition, parents before children.
+PARTITIONED_TABLES = ["Invoice", "InvoiceLine"]
+
+# The primary key of each table once it's partitioned.
+PRIMARY_KEYS = {
+    "Invoice": '"InvoiceId", "InvoiceDate"',
+    "InvoiceLine": '"InvoiceLineId", "InvoiceDate"',
+}
+
+# How many months ahead "maintain" makes sure there are partitions for.
+FUTURE_MONTHS = 3
+
+# Where "detach" moves old partitions to, unless told to drop them.
+ARCHIVE_SCHEMA = "archive"
+
+# The original tables are renamed to this while migrating (and kept under
+# that name with --keep-old, e.g. to benchmark against).
+OLD_SUFFIX = "_unpartitioned"
+
+# Fills in the "InvoiceDate" of a line inserted without one from its
+# invoice. Postgres picks the partition before any BEFORE trigger runs &
+# refuses to let a trigger change it, so a trigger on "InvoiceLine" itself
+# can't do this. Instead, a line without a date (i.e. NULL) is sent to
+# the DEFAULT partition, whose trigger looks up the date & inserts the
+# line again through "InvoiceLine", which sends it to the right month.
+# The original insert is then skipped (RETURN NULL), so it reports 0
+# rows, and INSERT ... RETURNING returns nothing for such lines.
+LINE_DATE_FUNCTION = """
+    CREATE OR REPLACE FUNCTION invoice_line_date() RETURNS trigger AS $$
+    BEGIN
+        IF NEW."InvoiceDate" IS NOT NULL THEN
+            RETURN NEW;
+        END IF;
+        SELECT "InvoiceDate" INTO NEW."InvoiceDate"
+        FROM "Invoice" WHERE "InvoiceId" = NEW."InvoiceId";
+        IF NOT FOUND THEN
+            RAISE foreign_key_violation USING MESSAGE = format(
+                'Invoice %s does not exist', NEW."InvoiceId");
+        END IF;
+        INSERT INTO "InvoiceLine" VALUES (NEW.*);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+# A partition's bounds as pg_get_expr() shows them.
+BOUND_RE = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+
+def month_start(value):
+    return datetime.datetime(value.year, value.month, 1)
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return datetime.datetime(index // 12, index % 12 + 1, 1)
+
+
+# The [start, end) range of one calendar month or year, e.g. for
+# invoices_between(session, *month_range(2013, 12)).
+def month_range(year, month):
+    start = datetime.datetime(year, month, 1)
+    return start, add_months(start, 1)
+
+
+def year_range(year):
+    return datetime.datetime(year, 1, 1), datetime.datetime(year + 1, 1, 1)
+
+
+def partition_name(table, month):
+    return "{}_{:%Y_%m}".format(table, month)
+
+
+def is_partitioned(cursor, table):
+    cursor.execute(
+        "SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)",
+        ['"{}"'.format(table)])
+    row = cursor.fetchone()
+    return row is not None and row[0] == "p"
+
+
+# Every monthly partition of 'table' as [(name, start, end)], oldest
+# first. The DEFAULT partition has no bounds, so it isn't included.
+def partitions(cursor, table):
+    cursor.execute(
+        """
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)
+        """,
+        ['"{}"'.format(table)])
+    found = []
+    for name, bound in cursor.fetchall():
+        match = BOUND_RE.search(bound or "")
+        if match is not None:
+            start, end = (
+                datetime.datetime.fromisoformat(value)
+                for value in match.groups())
+            found.append((name, start, end))
+    return sorted(found, key=lambda partition: partition[1])
+
+
+def default_partition(table):
+    return "{}_default".format(table)
+
+
+# The months that have rows in the DEFAULT partition of 'table', i.e. the
+# ones that had no partition of their own when the rows arrived.
+def stranded_months(cursor, table):
+    cursor.execute(
+        "SELECT to_regclass(%s) IS NOT NULL",
+        ['"{}"'.format(default_partition(table))])
+    if not cursor.fetchone()[0]:
+        return []
+    cursor.execute(
+        'SELECT DISTINCT date_trunc(\'month\', "InvoiceDate") FROM "{}" '
+        "ORDER BY 1".format(default_partition(table)))
+    return [row[0] for row in cursor.fetchall()]
+
+
+# The foreign key from lines to their invoices. It's the only one that
+# has to include "InvoiceDate", and changing an invoice's date moves its
+# lines along with it.
+def add_line_invoice_key(cursor):
+    cursor.execute(
+        'ALTER TABLE "InvoiceLine" ADD CONSTRAINT "FK_InvoiceLineInvoiceId" '
+        'FOREIGN KEY ("InvoiceId", "InvoiceDate") '
+        'REFERENCES "Invoice" ("InvoiceId", "InvoiceDate") '
+        "ON UPDATE CASCADE")
+
+
+# Create the partition of 'table' for one month, if it isn't there yet.
+# Postgres won't make a partition while the DEFAULT one holds rows that
+# belong in it (e.g. because "maintain" wasn't run in time), so those
+# rows are moved into a new table first, which is then attached as the
+# partition. Invoices can't be moved while lines point at them, so
+# ensure_partitions() drops the foreign key around this.
+def create_partition(cursor, table, month):
+    name, end = partition_name(table, month), add_months(month, 1)
+    cursor.execute("SELECT to_regclass(%s)", ['"{}"'.format(name)])
+    if cursor.fetchone()[0] is not None:
+        return
+    if month not in stranded_months(cursor, table):
+        cursor.execute(
+            'CREATE TABLE "{}" PARTITION OF "{}" '
+            "FOR VALUES FROM (%s) TO (%s)".format(name, table),
+            [month, end])
+        return
+    cursor.execute(
+        'CREATE TABLE "{}" (LIKE "{}" INCLUDING DEFAULTS '
+        "INCLUDING CONSTRAINTS)".format(name, table))
+    cursor.execute(
+        'WITH moved AS (DELETE FROM "{}" WHERE "InvoiceDate" >= %s '
+        'AND "InvoiceDate" < %s RETURNING *) '
+        'INSERT INTO "{}" SELECT * FROM moved'.format(
+            default_partition(table), name),
+        [month, end])
+    print("Moved {} rows from {} to {}".format(
+        cursor.rowcount, default_partition(table), name))
+    cursor.execute(
+        'ALTER TABLE "{}" ATTACH PARTITION "{}" '
+        "FOR VALUES FROM (%s) TO (%s)".format(table, name),
+        [month, end])
+
+
+# Make sure every partitioned table has a partition for this month & the
+# next 'months_ahead', so new invoices never end up in the DEFAULT one,
+# and for every month that already has rows in the DEFAULT one. Moving
+# those rows means dropping the foreign key from lines to invoices while
+# they're moved & adding it back afterwards, which checks every line
+# again, but that only happens when a month was missed.
+def ensure_partitions(cursor, months_ahead=FUTURE_MONTHS, today=None):
+    this_month = month_start(today or datetime.datetime.now())
+    stranded = any(stranded_months(cursor, table) for table in
+                   PARTITIONED_TABLES)
+    if stranded:
+        cursor.execute(
+            'ALTER TABLE "InvoiceLine" '
+            'DROP CONSTRAINT IF EXISTS "FK_InvoiceLineInvoiceId"')
+    created = 0
+    for table in PARTITIONED_TABLES:
+        existing = {start for _, start, _ in partitions(cursor, table)}
+        wanted = set(stranded_months(cursor, table))
+        wanted.update(
+            add_months(this_month, months)
+            for months in range(months_ahead + 1))
+        for month in sorted(wanted - existing):
+            create_partition(cursor, table, month)
+            created += 1
+    if stranded:
+        add_line_invoice_key(cursor)
+    return created
+
+
+# The CREATE INDEX statements for a table's indexes, other than its
+# primary key, so they can be made again on the partitioned table.
+# Unique indexes would have to include "InvoiceDate", so they're skipped.
+def index_definitions(cursor, table):
+    cursor.execute(
+        """
+        SELECT c.relname, pg_get_indexdef(i.indexrelid), i.indisunique
+        FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE i.indrelid = to_regclass(%s) AND NOT i.indisprimary
+        """,
+        ['"{}"'.format(table)])
+    definitions = []
+    for name, definition, unique in cursor.fetchall():
+        if unique:
+            print("Not copying unique index", name)
+        else:
+            definitions.append(definition)
+    return definitions
+
+
+def rename_with_indexes(cursor, table, new_name):
+    cursor.execute(
+        "SELECT c.relname FROM pg_index i "
+        "JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE i.indrelid = to_regclass(%s)",
+        ['"{}"'.format(table)])
+    for (index,) in cursor.fetchall():
+        cursor.execute('ALTER INDEX "{}" RENAME TO "{}{}"'.format(
+            index, index, OLD_SUFFIX))
+    cursor.execute('ALTER TABLE "{}" RENAME TO "{}"'.format(table, new_name))
+
+
+# The features from sql_rollups.py & sql_changefeed.py that hang off
+# these tables & have to be set up again on the new ones.
+def installed_extras(cursor):
+    cursor.execute("SELECT to_regclass('\"SalesByArtist\"') IS NOT NULL")
+    rollups = cursor.fetchone()[0]
+    cursor.execute(
+        "SELECT DISTINCT c.relname FROM pg_trigger t "
+        "JOIN pg_class c ON c.oid = t.tgrelid "
+        "WHERE starts_with(t.tgname, 'TR_ChangeFeed') "
+        "AND c.relname = ANY(%s)",
+        [PARTITIONED_TABLES])
+    return rollups, [row[0] for row in cursor.fetchall()]
+
+
+# Turn "Invoice" & "InvoiceLine" into monthly partitioned tables, in one
+# transaction, so if anything goes wrong nothing has changed. Writers are
+# blocked while it runs, so run it when the shop is quiet.
+def migrate(cursor, keep_old=False, months_ahead=FUTURE_MONTHS):
+    if is_partitioned(cursor, "Invoice"):
+        print('"Invoice" is already partitioned.')
+        return
+    rollups, feeds = installed_extras(cursor)
+    if rollups:
+        # The reporting views read from the old tables, so they're made
+        # again afterwards.
+        import sql_rollups
+        for view in sql_rollups.VIEWS:
+            cursor.execute(
+                'DROP MATERIALIZED VIEW IF EXISTS "{}"'.format(view))
+
+    indexes = {}
+    for table in PARTITIONED_TABLES:
+        indexes[table] = index_definitions(cursor, table)
+        rename_with_indexes(cursor, table, table + OLD_SUFFIX)
+
+    cursor.execute(
+        'SELECT min("InvoiceDate"), max("InvoiceDate") FROM "{}"'.format(
+            "Invoice" + OLD_SUFFIX))
+    first, last = cursor.fetchone()
+    today = datetime.datetime.now()
+    first = month_start(first or today)
+    last = month_start(last or today)
+
+    cursor.execute(
+        'CREATE TABLE "Invoice" (LIKE "Invoice{}" INCLUDING DEFAULTS '
+        'INCLUDING CONSTRAINTS) PARTITION BY RANGE ("InvoiceDate")'
+        .format(OLD_SUFFIX))
+    cursor.execute(
+        'CREATE TABLE "InvoiceLine" (LIKE "InvoiceLine{}" INCLUDING DEFAULTS '
+        "INCLUDING CONSTRAINTS, "
+        '"InvoiceDate" timestamp NOT NULL) '
+        'PARTITION BY RANGE ("InvoiceDate")'.format(OLD_SUFFIX))
+    for table in PARTITIONED_TABLES:
+        month = first
+        while month <= last:
+            create_partition(cursor, table, month)
+            month = add_months(month, 1)
+        # Anything outside every month's range lands here rather than
+        # being refused. "status" warns if it's ever not empty, and
+        # "maintain" moves it into partitions of its own.
+        cursor.execute(
+            'CREATE TABLE "{}" PARTITION OF "{}" DEFAULT'.format(
+                default_partition(table), table))
+    ensure_partitions(cursor, months_ahead, today)
+    cursor.execute(LINE_DATE_FUNCTION)
+    cursor.execute(
+        'CREATE TRIGGER "TR_InvoiceLineDate" BEFORE INSERT ON "{}" '
+        "FOR EACH ROW EXECUTE PROCEDURE invoice_line_date()".format(
+            default_partition("InvoiceLine")))
+
+    started = time.perf_counter()
+    cursor.execute('INSERT INTO "Invoice" SELECT * FROM "Invoice{}"'.format(
+        OLD_SUFFIX))
+    cursor.execute(
+        'INSERT INTO "InvoiceLine" SELECT il.*, i."InvoiceDate" '
+        'FROM "InvoiceLine{0}" il '
+        'JOIN "Invoice{0}" i ON i."InvoiceId" = il."InvoiceId"'.format(
+            OLD_SUFFIX))
+    print("Copied the rows in {:.1f}s".format(time.perf_counter() - started))
+
+    # Keys & indexes are made after copying, which is much quicker than
+    # keeping them up to date row by row. Indexes on the parent table are
+    # made on every partition, including ones created later.
+    for table in PARTITIONED_TABLES:
+        cursor.execute(
+            'ALTER TABLE "{0}" ADD CONSTRAINT "PK_{0}" PRIMARY KEY ({1})'
+            .format(table, PRIMARY_KEYS[table]))
+        for definition in indexes[table]:
+            cursor.execute(definition)
+    cursor.execute(
+        'ALTER TABLE "Invoice" ADD CONSTRAINT "FK_InvoiceCustomerId" '
+        'FOREIGN KEY ("CustomerId") REFERENCES "Customer" ("CustomerId")')
+    add_line_invoice_key(cursor)
+    cursor.execute(
+        'ALTER TABLE "InvoiceLine" ADD CONSTRAINT "FK_InvoiceLineTrackId" '
+        'FOREIGN KEY ("TrackId") REFERENCES "Track" ("TrackId")')
+
+    if not keep_old:
+        for table in reversed(PARTITIONED_TABLES):
+            cursor.execute('DROP TABLE "{}{}"'.format(table, OLD_SUFFIX))
+    if feeds:
+        import sql_changefeed
+        sql_changefeed.setup(cursor, feeds)
+    if rollups:
+        sql_rollups.setup(cursor)
+    for table in PARTITIONED_TABLES:
+        cursor.execute('ANALYZE "{}"'.format(table))
+
+
+# Take every month that ends on or before 'before' out of the partitioned
+# tables. The detached tables are moved to the 'archive' schema, where
+# they can still be queried (or dumped with pg_dump), or dropped if
+# 'archive' is None. Lines go first, as their invoices can't be detached
+# while lines still point at them.
+def detach_partitions(cursor, before, archive=ARCHIVE_SCHEMA):
+    if archive is not None:
+        cursor.execute('CREATE SCHEMA IF NOT EXISTS "{}"'.format(archive))
+    detached = []
+    for table in reversed(PARTITIONED_TABLES):
+        for name, _, end in partitions(cursor, table):
+            if end > before:
+                continue
+            cursor.execute('ALTER TABLE "{}" DETACH PARTITION "{}"'.format(
+                table, name))
+            # A detached table of lines keeps its own copy of the foreign
+            # key to "Invoice", which would stop that month's invoices
+            # being detached too.
+            cursor.execute(
+                "SELECT conname FROM pg_constraint WHERE contype = 'f' "
+                "AND conrelid = to_regclass(%s)",
+                ['"{}"'.format(name)])
+            for (constraint,) in cursor.fetchall():
+                cursor.execute(
+                    'ALTER TABLE "{}" DROP CONSTRAINT "{}"'.format(
+                        name, constraint))
+            if archive is None:
+                cursor.execute('DROP TABLE "{}"'.format(name))
+            else:
+                cursor.execute('ALTER TABLE "{}" SET SCHEMA "{}"'.format(
+                    name, archive))
+            detached.append(name)
+    return detached
+
+
+# The "InvoiceDate" column that "InvoiceLine" gets when it's partitioned.
+# Like "SearchVector" in sql_search.py it isn't part of the InvoiceLine
+# model, so the model still works on a database that hasn't been migrated.
+def invoice_line_date():
+    return literal_column('"InvoiceLine"."InvoiceDate"', DateTime)
+
+
+# A prunable [start, end) condition on a date column, e.g.
+#   .filter(in_period(Invoice.InvoiceDate, *month_range(2013, 12)))
+def in_period(column, start, end):
+    return and_(
+        column >= literal(start, DateTime), column < literal(end, DateTime))
+
+
+# How lines join to their invoices once both are partitioned: matching
+# "InvoiceDate" as well means each month of lines only has to be joined
+# to the same month of invoices.
+def invoice_lines_join():
+    return and_(
+        InvoiceLine.InvoiceId == Invoice.InvoiceId,
+        invoice_line_date() == Invoice.InvoiceDate)
+
+
+# The ORM helpers, e.g.
+#   for invoice in invoices_between(session, *month_range(2013, 12)):
+#       print(invoice.InvoiceId, invoice.Total)
+def invoices_between(session, start, end):
+    return (
+        session.query(Invoice)
+        .filter(in_period(Invoice.InvoiceDate, start, end))
+        .order_by(Invoice.InvoiceDate)
+    )
+
+
+def lines_between(session, start, end):
+    return (
+        session.query(InvoiceLine)
+        .filter(in_period(invoice_line_date(), start, end))
+    )
+
+
+# The Core version: total sales in [start, end), per 'group_by' column of
+# "Invoice". Both tables are limited to the period, so both are pruned.
+def sales_between(start, end, group_by=Invoice.BillingCountry):
+    revenue = func.sum(InvoiceLine.UnitPrice * InvoiceLine.Quantity)
+    return (
+        select(group_by, revenue.label("Revenue"))
+        .select_from(Invoice.__table__.join(
+            InvoiceLine.__table__, invoice_lines_join()))
+        .where(in_period(Invoice.InvoiceDate, start, end))
+        .where(in_period(invoice_line_date(), start, end))
+        .group_by(group_by)
+        .order_by(revenue.desc())
+    )
+
+
+# Time-windowed queries for the benchmark, run against the partitioned
+# tables & (with "migrate --keep-old") the original ones. The original
+# "InvoiceLine" has no "InvoiceDate", so it's only joined by "InvoiceId".
+BENCHMARK_QUERIES = {
+    "sales for one month": """
+        SELECT sum(il."UnitPrice" * il."Quantity")
+        FROM "{invoice}" i JOIN "{line}" il ON {join}
+        WHERE i."InvoiceDate" >= %(start)s AND i."InvoiceDate" < %(end)s
+        {line_filter}
+    """,
+    "sales by country for one month": """
+        SELECT i."BillingCountry", sum(il."UnitPrice" * il."Quantity")
+        FROM "{invoice}" i JOIN "{line}" il ON {join}
+        WHERE i."InvoiceDate" >= %(start)s AND i."InvoiceDate" < %(end)s
+        {line_filter}
+        GROUP BY 1
+    """,
+    "invoices for one month": """
+        SELECT * FROM "{invoice}" i
+        WHERE i."InvoiceDate" >= %(start)s AND i."InvoiceDate" < %(end)s
+    """,
+}
+
+BENCHMARK_TABLES = {
+    "partitioned": {
+        "invoice": "Invoice",
+        "line": "InvoiceLine",
+        "join": 'il."InvoiceId" = i."InvoiceId" '
+                'AND il."InvoiceDate" = i."InvoiceDate"',
+        "line_filter": 'AND il."InvoiceDate" >= %(start)s '
+                       'AND il."InvoiceDate" < %(end)s',
+    },
+    "unpartitioned": {
+        "invoice": "Invoice" + OLD_SUFFIX,
+        "line": "InvoiceLine" + OLD_SUFFIX,
+        "join": 'il."InvoiceId" = i."InvoiceId"',
+        "line_filter": "",
+    },
+}
+
+
+# How many tables (partitions) a query's plan actually reads.
+def tables_scanned(cursor, sql, params):
+    cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+    plan = cursor.fetchone()[0]
+    relations = set()
+
+    def walk(node):
+        if "Relation Name" in node:
+            relations.add(node["Relation Name"])
+        for child in node.get("Plans", []):
+            walk(child)
+
+    walk(plan[0]["Plan"])
+    return len(relations)
+
+
+def fastest(cursor, sql, params, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        cursor.execute(sql, params)
+        cursor.fetchall()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def benchmark(repeat):
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT count(*), max("InvoiceDate") FROM "Invoice"')
+        invoices, last = cursor.fetchone()
+        if last is None:
+            print('"Invoice" is empty, so there is nothing to time.')
+            return
+        start, end = month_range(last.year, last.month)
+        cursor.execute(
+            "SELECT to_regclass(%s) IS NOT NULL",
+            ['"Invoice{}"'.format(OLD_SUFFIX)])
+        layouts = ["partitioned"]
+        if cursor.fetchone()[0]:
+            layouts.append("unpartitioned")
+        print("{} invoices, timing the month of {:%B %Y}".format(
+            invoices, start))
+        print("Query", "Tables", "Tables read", "ms", sep=" | ")
+        params = {"start": start, "end": end}
+        for name, template in BENCHMARK_QUERIES.items():
+            for layout in layouts:
+                sql = template.format(**BENCHMARK_TABLES[layout])
+                print(
+                    name, layout, tables_scanned(cursor, sql, params),
+                    "{:.2f}".format(fastest(cursor, sql, params, repeat)),
+                    sep=" | ")
+
+    # The same month through the ORM & Core helpers.
+    session = sessionmaker(get_engine())()
+    try:
+        helpers = {
+            "invoices_between() (ORM)":
+                lambda: invoices_between(session, start, end).all(),
+            "sales_between() (Core)":
+                lambda: session.execute(sales_between(start, end)).all(),
+        }
+        for name, run in helpers.items():
+            started = time.perf_counter()
+            rows = run()
+            elapsed = (time.perf_counter() - started) * 1000
+            print(name, "{} rows".format(len(rows)),
+                  "{:.2f} ms".format(elapsed), sep=" | ")
+    finally:
+        session.close()
+
+
+def print_status(cursor):
+    print("Table", "Partitions", "From", "To", "Rows in DEFAULT", sep=" | ")
+    warnings = []
+    for table in PARTITIONED_TABLES:
+        if not is_partitioned(cursor, table):
+            print(table, "not partitioned", sep=" | ")
+            continue
+        found = partitions(cursor, table)
+        cursor.execute(
+            'SELECT count(*) FROM "{}"'.format(default_partition(table)))
+        stranded = cursor.fetchone()[0]
+        print(
+            table, len(found),
+            "{:%Y-%m}".format(found[0][1]) if found else "-",
+            "{:%Y-%m}".format(found[-1][1]) if found else "-",
+            stranded, sep=" | ")
+        if stranded:
+            warnings.append(
+                'WARNING: {} rows of "{}" are in "{}", which means a month '
+                'was missed. Run "maintain" to move them into partitions '
+                "of their own.".format(
+                    stranded, table, default_partition(table)))
+    for warning in warnings:
+        print(warning)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Partition "Invoice" & "InvoiceLine" by month.')
+    parser.add_argument(
+        "command",
+        choices=["migrate", "maintain", "detach", "status", "benchmark"])
+    parser.add_argument(
+        "--keep-old", action="store_true",
+        help="keep the original tables as Invoice{0} & InvoiceLine{0}"
+        .format(OLD_SUFFIX))
+    parser.add_argument("--months-ahead", type=int, default=FUTURE_MONTHS)
+    parser.add_argument(
+        "--before", type=datetime.date.fromisoformat,
+        help="detach every month that ends on or before this date")
+    parser.add_argument(
+        "--drop", action="store_true",
+        help="drop detached months instead of archiving them")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.command == "benchmark":
+        benchmark(args.repeat)
+    else:
+        with connection() as conn:
+            cursor = conn.cursor()
+            if args.command == "migrate":
+                migrate(cursor, args.keep_old, args.months_ahead)
+                print_status(cursor)
+            elif args.command == "maintain":
+                print("Created", ensure_partitions(cursor, args.months_ahead),
+                      "partitions")
+            elif args.command == "detach":
+                if args.before is None:
+                    parser.error("detach needs --before")
+                before = datetime.datetime.combine(
+                    args.before, datetime.time())
+                for name in detach_partitions(
+                        cursor, before, None if args.drop else ARCHIVE_SCHEMA):
+                    print("Detached", name)
+            else:
+                print_status(cursor)
+
+# command to type at the terminal in order to run our code is:
+# python3 sql_scaling.py generate --scale 1000   (a multi-million row
+#                                                  history to work on)
+# python3 sql_partitioning.py migrate --keep-old
+# python3 sql_partitioning.py benchmark
+# python3 sql_partitioning.py maintain --months-ahead 3
+# python3 sql_partitioning.py detach --before 2010-01-01
@@ -0,0 +1,223 @@
+# HOW TO STOP RE-PARSING & RE-PLANNING THE SAME QUERIES ON EVERY CALL.
+
+# Every cursor.execute('SELECT * FROM "Artist" WHERE "ArtistId" = %s', [51])
+# makes Postgres parse & plan the query from scratch, and every
+# track_table.select().where(...) or session.query(Track).filter_by(...)
+# builds a brand new statement object in Python before SQLAlchemy can
+# even look it up in its cache of compiled SQL.
+# This module keeps a registry of named queries:
+#   - on the psycopg2 path each one is sent to the server ONCE per pooled
+#     connection with PREPARE, and then run with EXECUTE, so Postgres can
+#     reuse the parsed (and, after a few runs, the planned) statement.
+#   - on the SQLAlchemy path each one is a lambda statement, which is only
+#     built & compiled the first time; later calls just swap in the values.
+import argparse
+import itertools
+import re
+import time
+import weakref
+
+from sqlalchemy import lambda_stmt, select
+from sqlalchemy.orm import sessionmaker
+
+from sql_connection import connection, get_engine
+from sql_models import Album, Artist, Track
+from sql_queries import QUERIES
+
+
+# Matches the psycopg2 %s placeholders & its escaped %% signs, read left
+# to right, so %%s is a literal "%s" rather than a placeholder.
+PLACEHOLDER_RE = re.compile(r"%([%s])")
+
+
+# Turn psycopg2's %s placeholders into the $1, $2, ... that PREPARE uses.
+# PREPARE is run without any parameters, so psycopg2 leaves the SQL alone
+# & each %% has to be turned back into the single % it stands for.
+def to_positional(sql):
+    counter = itertools.count(1)
+
+    def replace(match):
+        if match.group(1) == "%":
+            return "%"
+        return "${}".format(next(counter))
+
+    return PLACEHOLDER_RE.sub(replace, sql)
+
+
+class PreparedRegistry:
+    # The named queries we know how to PREPARE, and which of them each
+    # connection has already prepared. The connections are held weakly,
+    # so one that gets closed is simply forgotten.
+    def __init__(self, queries=None):
+        self.queries = {}
+        self._prepared = weakref.WeakKeyDictionary()
+        for name, (sql, _) in (queries or {}).items():
+            self.register(name, sql)
+
+    def register(self, name, sql):
+        self.queries[name] = to_positional(sql)
+
+    # Run a named query on 'cursor', preparing it first if this connection
+    # hasn't seen it yet.
+    def execute(self, cursor, name, params=None):
+        params = params or []
+        prepared = self._prepared.setdefault(cursor.connection, set())
+        if name not in prepared:
+            cursor.execute(
+                "PREPARE {} AS {}".format(name, self.queries[name]))
+            prepared.add(name)
+        if params:
+            cursor.execute(
+                "EXECUTE {} ({})".format(
+                    name, ", ".join(["%s"] * len(params))),
+                params)
+        else:
+            cursor.execute("EXECUTE {}".format(name))
+        return cursor
+
+
+# The six queries from sql_queries.py, ready to be prepared.
+registry = PreparedRegistry(QUERIES)
+
+
+# Run one of the named queries on a pooled connection & return its rows.
+def run_prepared(name, params=None):
+    with connection() as conn:
+        return registry.execute(conn.cursor(), name, params).fetchall()
+
+
+# The same queries as SQLAlchemy lambda statements. The lambda is only
+# analysed once; after that, calling it again just pulls the new values
+# out of its closure & reuses the cached SQL.
+def artist_by_name_statement(name="Queen"):
+    return lambda_stmt(lambda: select(Artist).where(Artist.Name == name))
+
+
+def artist_by_id_statement(artist_id=51):
+    return lambda_stmt(
+        lambda: select(Artist).where(Artist.ArtistId == artist_id))
+
+
+def albums_by_artist_statement(artist_id=51):
+    return lambda_stmt(
+        lambda: select(Album).where(Album.ArtistId == artist_id))
+
+
+def tracks_by_composer_statement(composer="Queen"):
+    return lambda_stmt(
+        lambda: select(Track).where(Track.Composer == composer))
+
+
+LAMBDA_STATEMENTS = {
+    "artist_by_name": artist_by_name_statement,
+    "artist_by_id": artist_by_id_statement,
+    "albums_by_artist": albums_by_artist_statement,
+    "tracks_by_composer": tracks_by_composer_statement,
+}
+
+
+# The usual ways of writing the same lookups, for comparison.
+artist_table = Artist.__table__
+album_table = Album.__table__
+track_table = Track.__table__
+
+CORE_QUERIES = {
+    "artist_by_name": lambda value: artist_table.select().where(
+        artist_table.c.Name == value),
+    "artist_by_id": lambda value: artist_table.select().where(
+        artist_table.c.ArtistId == value),
+    "albums_by_artist": lambda value: album_table.select().where(
+        album_table.c.ArtistId == value),
+    "tracks_by_composer": lambda value: track_table.select().where(
+        track_table.c.Composer == value),
+}
+
+ORM_QUERIES = {
+    "artist_by_name": lambda session, value: session.query(Artist).filter_by(
+        Name=value),
+    "artist_by_id": lambda session, value: session.query(Artist).filter_by(
+        ArtistId=value),
+    "albums_by_artist": lambda session, value: session.query(
+        Album).filter_by(ArtistId=value),
+    "tracks_by_composer": lambda session, value: session.query(
+        Track).filter_by(Composer=value),
+}
+
+
+# Time 'iterations' calls of 'run' & return the wall-clock & client CPU
+# time per call in microseconds. Whatever isn't client CPU is time spent
+# waiting on the network & the server.
+def per_call(run, iterations):
+    run()
+    wall_started = time.perf_counter()
+    cpu_started = time.process_time()
+    for _ in range(iterations):
+        run()
+    wall = (time.perf_counter() - wall_started) / iterations * 1e6
+    cpu = (time.process_time() - cpu_started) / iterations * 1e6
+    return wall, cpu
+
+
+# How long the server spends planning a plain query & its EXECUTE.
+def planning_times(name, params):
+    sql, _ = QUERIES[name]
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "EXPLAIN (ANALYZE, FORMAT JSON) " + sql, params)
+        plain = cursor.fetchone()[0][0]["Planning Time"]
+        registry.execute(cursor, name, params).fetchall()
+        cursor.execute(
+            "EXPLAIN (ANALYZE, FORMAT JSON) EXECUTE {} ({})".format(
+                name, ", ".join(["%s"] * len(params))),
+            params)
+        prepared = cursor.fetchone()[0][0]["Planning Time"]
+    return plain, prepared
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure what prepared & cached statements save.")
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    Session = sessionmaker(get_engine())
+    session = Session()
+
+    print("Query", "Path", "Wall us/call", "Client CPU us/call", sep=" | ")
+    for name, statement in LAMBDA_STATEMENTS.items():
+        sql, params = QUERIES[name]
+
+        def plain():
+            with connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(sql, params)
+                cursor.fetchall()
+
+        def core(build):
+            with get_engine().connect() as conn:
+                conn.execute(build(params[0])).fetchall()
+
+        paths = {
+            "psycopg2 execute": plain,
+            "psycopg2 prepared": lambda: run_prepared(name, params),
+            "core select": lambda: core(CORE_QUERIES[name]),
+            "core lambda": lambda: core(statement),
+            "orm query": lambda: ORM_QUERIES[name](session, params[0]).all(),
+            "orm lambda": lambda: session.execute(
+                statement(params[0])).scalars().all(),
+        }
+        for path, run in paths.items():
+            wall, cpu = per_call(run, args.iterations)
+            print(
+                name, path, "{:.1f}".format(wall), "{:.1f}".format(cpu),
+                sep=" | ")
+
+        plain_ms, prepared_ms = planning_times(name, params)
+        print(
+            name, "server planning ms (plain -> prepared)",
+            "{:.3f} -> {:.3f}".format(plain_ms, prepared_ms), sep=" | ")
+    session.close()
+
+# command to type at the terminal in order to run our code is:
+# python3 sql_prepared.py --iterations 2000
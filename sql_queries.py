@@ -0,0 +1,27 @@
+# THE SIX CANONICAL CHINOOK QUERIES AS PLAIN, PARAMETERIZED SQL.
+
+# sql-psycopg2.py, sql-expression.py & sql-orm.py all run the same six
+# queries, each in their own way. This module writes them down once as
+# raw SQL with psycopg2 "%s" placeholders, so our tooling (index advisor,
+# benchmarks etc.) can run exactly the same lookups the scripts do.
+# Each entry is:  name: (SQL, parameters)
+QUERIES = {
+    # Query 1 - Select ALL records from the "Artist" table.
+    "all_artists": ('SELECT * FROM "Artist"', None),
+    # Query 2 - Select only the "Name" column from the "Artist" table.
+    "artist_names": ('SELECT "Name" FROM "Artist"', None),
+    # Query 3 - Select only the "Queen" from the "Artist" table.
+    "artist_by_name": (
+        'SELECT * FROM "Artist" WHERE "Name" = %s', ["Queen"]),
+    # Query 4 - Select only by "ArtistId" #51 from the "Artist" table.
+    "artist_by_id": (
+        'SELECT * FROM "Artist" WHERE "ArtistId" = %s', [51]),
+    # Query 5 - Select only the albums with "ArtistId" #51 on the "Album"
+    # table.
+    "albums_by_artist": (
+        'SELECT * FROM "Album" WHERE "ArtistId" = %s', [51]),
+    # Query 6 - Select all tracks where the composer is "Queen" from the
+    # "Track" table.
+    "tracks_by_composer": (
+        'SELECT * FROM "Track" WHERE "Composer" = %s', ["Queen"]),
+}
@@ -0,0 +1,344 @@
+# HOW TO KEEP SALES REPORTS PRECOMPUTED INSTEAD OF JOINING ON EVERY REQUEST.
+
+# Sales by artist means joining "InvoiceLine" -> "Track" -> "Album" ->
+# "Artist" & adding everything up, and sales by genre & monthly totals are
+# much the same. Doing that on every dashboard request means the same work
+# over & over, and it gets slower the more invoices we have.
+# This module keeps each report as a Postgres materialized view, i.e. a
+# query whose result is stored like a table, and maps the models in
+# sql_models.py (SalesByArtist, SalesByGenre & MonthlyInvoiceTotal) onto
+# them so reading a report is a plain indexed SELECT.
+# To know when a view needs refreshing, a trigger on each table it reads
+# from adds a row to "RollupChange" for every statement that writes to
+# it. Refreshing a view consumes its pending changes & runs
+# REFRESH MATERIALIZED VIEW CONCURRENTLY, so readers are never blocked,
+# and only views with new "Invoice"/"InvoiceLine" rows are refreshed.
+import argparse
+import time
+
+from sqlalchemy.orm import sessionmaker
+
+from sql_connection import connection, get_engine
+from sql_models import MonthlyInvoiceTotal, SalesByArtist, SalesByGenre
+
+
+# Each view's query, the column(s) that make a row unique (CONCURRENTLY
+# needs a unique index to match old rows to new ones) & the tables whose
+# writes make it stale.
+VIEWS = {
+    "SalesByArtist": (
+        """
+        SELECT ar."ArtistId", ar."Name",
+            count(DISTINCT il."InvoiceId") AS "Invoices",
+            sum(il."Quantity") AS "Quantity",
+            sum(il."UnitPrice" * il."Quantity") AS "Revenue"
+        FROM "InvoiceLine" il
+        JOIN "Track" t ON t."TrackId" = il."TrackId"
+        JOIN "Album" al ON al."AlbumId" = t."AlbumId"
+        JOIN "Artist" ar ON ar."ArtistId" = al."ArtistId"
+        GROUP BY ar."ArtistId"
+        """,
+        '"ArtistId"',
+        ["InvoiceLine", "Track", "Album", "Artist"],
+    ),
+    "SalesByGenre": (
+        """
+        SELECT g."GenreId", g."Name",
+            count(DISTINCT il."InvoiceId") AS "Invoices",
+            sum(il."Quantity") AS "Quantity",
+            sum(il."UnitPrice" * il."Quantity") AS "Revenue"
+        FROM "InvoiceLine" il
+        JOIN "Track" t ON t."TrackId" = il."TrackId"
+        JOIN "Genre" g ON g."GenreId" = t."GenreId"
+        GROUP BY g."GenreId"
+        """,
+        '"GenreId"',
+        ["InvoiceLine", "Track", "Genre"],
+    ),
+    "MonthlyInvoiceTotal": (
+        """
+        SELECT date_trunc('month', "InvoiceDate") AS "Month",
+            count(*) AS "Invoices",
+            count(DISTINCT "CustomerId") AS "Customers",
+            sum("Total") AS "Revenue"
+        FROM "Invoice"
+        GROUP BY 1
+        """,
+        '"Month"',
+        ["Invoice"],
+    ),
+}
+
+# The tables & trigger function that track what changed & when each view
+# was last refreshed. The trigger is passed the names of the views that
+# depend on its table, and queues one change for each of them.
+BOOKKEEPING = [
+    """
+    CREATE TABLE IF NOT EXISTS "RollupChange" (
+        "ChangeId" bigserial PRIMARY KEY,
+        "ViewName" text NOT NULL,
+        "TableName" text NOT NULL,
+        "ChangedAt" timestamptz NOT NULL DEFAULT clock_timestamp()
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS "IX_RollupChangeViewName"
+        ON "RollupChange" ("ViewName", "ChangedAt")
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS "RollupState" (
+        "ViewName" text PRIMARY KEY,
+        "RefreshedAt" timestamptz NOT NULL,
+        "RefreshSeconds" double precision NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE OR REPLACE FUNCTION rollup_log_change() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO "RollupChange" ("ViewName", "TableName")
+        SELECT view_name, TG_TABLE_NAME FROM unnest(TG_ARGV) AS view_name;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+]
+
+# A view is refreshed once its oldest pending change is this many seconds
+# old. 0 refreshes on every run that finds a change.
+DEFAULT_MAX_LAG = 0
+
+DEFAULT_ITERATIONS = 200
+
+
+# Which views read from each table, e.g. {"Track": ["SalesByArtist", ...]}.
+def dependent_views():
+    tables = {}
+    for view, (_, _, sources) in VIEWS.items():
+        for table in sources:
+            tables.setdefault(table, []).append(view)
+    return tables
+
+
+# Create the bookkeeping tables, one change-logging trigger per source
+# table & every view (with its indexes), populated & marked fresh.
+def setup(cursor):
+    for statement in BOOKKEEPING:
+        cursor.execute(statement)
+
+    # A statement-level trigger fires once per INSERT/UPDATE/DELETE however
+    # many rows it touches, so bulk loads only log one change.
+    for table, views in dependent_views().items():
+        cursor.execute(
+            'DROP TRIGGER IF EXISTS "TR_RollupChange" ON "{}"'.format(table))
+        cursor.execute(
+            'CREATE TRIGGER "TR_RollupChange" '
+            'AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON "{}" '
+            'FOR EACH STATEMENT EXECUTE PROCEDURE rollup_log_change({})'
+            .format(table, ", ".join("'{}'".format(v) for v in views)))
+
+    for view, (query, key, _) in VIEWS.items():
+        started = time.perf_counter()
+        cursor.execute('DROP MATERIALIZED VIEW IF EXISTS "{}"'.format(view))
+        cursor.execute(
+            'CREATE MATERIALIZED VIEW "{}" AS {}'.format(view, query))
+        cursor.execute(
+            'CREATE UNIQUE INDEX "UX_{0}" ON "{0}" ({1})'.format(view, key))
+        if view != "MonthlyInvoiceTotal":
+            # Lets "the top 10 by revenue" read 10 index entries.
+            cursor.execute(
+                'CREATE INDEX "IX_{0}Revenue" ON "{0}" ("Revenue" DESC)'
+                .format(view))
+        mark_refreshed(cursor, view, time.perf_counter() - started)
+        cursor.execute(
+            'DELETE FROM "RollupChange" WHERE "ViewName" = %s', [view])
+
+
+def mark_refreshed(cursor, view, seconds):
+    cursor.execute(
+        """
+        INSERT INTO "RollupState" ("ViewName", "RefreshedAt", "RefreshSeconds")
+        VALUES (%s, now(), %s)
+        ON CONFLICT ("ViewName") DO UPDATE
+        SET "RefreshedAt" = excluded."RefreshedAt",
+            "RefreshSeconds" = excluded."RefreshSeconds"
+        """,
+        [view, seconds])
+
+
+# Refresh one view & return how many pending changes it consumed.
+# The changes are deleted BEFORE the refresh runs, so the refresh always
+# sees at least everything we deleted. A change that's committed while we
+# work isn't visible to the DELETE, so it stays queued for next time
+# rather than being lost.
+def refresh_view(cursor, view, concurrently=True):
+    cursor.execute(
+        'DELETE FROM "RollupChange" WHERE "ViewName" = %s', [view])
+    consumed = cursor.rowcount
+    started = time.perf_counter()
+    cursor.execute('REFRESH MATERIALIZED VIEW {}"{}"'.format(
+        "CONCURRENTLY " if concurrently else "", view))
+    mark_refreshed(cursor, view, time.perf_counter() - started)
+    return consumed
+
+
+# How stale every view is, as
+# {view: (refreshed at, pending changes, seconds behind, refresh seconds)}.
+# "seconds behind" is how long the oldest change has been waiting, so a
+# view with nothing pending is 0 seconds behind however old it is.
+def staleness(cursor):
+    cursor.execute(
+        """
+        SELECT s."ViewName", s."RefreshedAt", count(c."ChangeId"),
+            coalesce(extract(epoch FROM now() - min(c."ChangedAt")), 0),
+            s."RefreshSeconds"
+        FROM "RollupState" s
+        LEFT JOIN "RollupChange" c ON c."ViewName" = s."ViewName"
+        GROUP BY s."ViewName"
+        ORDER BY s."ViewName"
+        """)
+    return {
+        view: (refreshed_at, pending, float(behind), refresh_seconds)
+        for view, refreshed_at, pending, behind, refresh_seconds
+        in cursor.fetchall()
+    }
+
+
+# Refresh every view that has pending changes older than 'max_lag'
+# seconds (or every view with force=True). Each view is refreshed in its
+# own transaction, so one slow refresh doesn't hold up the others.
+def refresh_stale(max_lag=DEFAULT_MAX_LAG, force=False, concurrently=True):
+    with connection() as conn:
+        state = staleness(conn.cursor())
+    refreshed = {}
+    for view in VIEWS:
+        _, pending, behind, _ = state.get(view, (None, 0, 0.0, 0.0))
+        if force or (pending and behind >= max_lag):
+            with connection() as conn:
+                refreshed[view] = refresh_view(
+                    conn.cursor(), view, concurrently)
+    return refreshed
+
+
+# The dashboard reads, straight from the precomputed views.
+def top_artists(session, limit=10):
+    return (
+        session.query(SalesByArtist)
+        .order_by(SalesByArtist.Revenue.desc())
+        .limit(limit)
+        .all()
+    )
+
+
+def top_genres(session, limit=10):
+    return (
+        session.query(SalesByGenre)
+        .order_by(SalesByGenre.Revenue.desc())
+        .limit(limit)
+        .all()
+    )
+
+
+def monthly_totals(session, start=None, end=None):
+    query = session.query(MonthlyInvoiceTotal)
+    if start is not None:
+        query = query.filter(MonthlyInvoiceTotal.Month >= start)
+    if end is not None:
+        query = query.filter(MonthlyInvoiceTotal.Month < end)
+    return query.order_by(MonthlyInvoiceTotal.Month).all()
+
+
+# The same reports worked out from scratch, for comparison.
+def live_report(cursor, view, limit=10):
+    query, key, _ = VIEWS[view]
+    order = key if view == "MonthlyInvoiceTotal" else '"Revenue" DESC'
+    cursor.execute(
+        "SELECT * FROM ({}) AS live ORDER BY {} LIMIT %s".format(
+            query, order),
+        [limit])
+    return cursor.fetchall()
+
+
+def benchmark(iterations=DEFAULT_ITERATIONS):
+    readers = {
+        "SalesByArtist": top_artists,
+        "SalesByGenre": top_genres,
+        "MonthlyInvoiceTotal": monthly_totals,
+    }
+    session = sessionmaker(get_engine())()
+    print("View", "Live ms/read", "View ms/read", sep=" | ")
+    try:
+        with connection() as conn:
+            cursor = conn.cursor()
+            for view, read in readers.items():
+                started = time.perf_counter()
+                for _ in range(iterations):
+                    live_report(cursor, view)
+                live = (time.perf_counter() - started) / iterations * 1000
+
+                started = time.perf_counter()
+                for _ in range(iterations):
+                    read(session)
+                    # Forget the objects so each read really hits the view.
+                    session.expunge_all()
+                stored = (time.perf_counter() - started) / iterations * 1000
+                print(
+                    view, "{:.3f}".format(live), "{:.3f}".format(stored),
+                    sep=" | ")
+    finally:
+        session.close()
+
+
+def print_status():
+    with connection() as conn:
+        state = staleness(conn.cursor())
+    print(
+        "View", "Refreshed at", "Pending changes", "Seconds behind",
+        "Last refresh (s)", sep=" | ")
+    for view, (refreshed_at, pending, behind, seconds) in state.items():
+        print(
+            view, refreshed_at, pending, "{:.1f}".format(behind),
+            "{:.3f}".format(seconds), sep=" | ")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build, refresh & inspect the Chinook sales rollups.")
+    parser.add_argument(
+        "command", choices=["setup", "refresh", "status", "benchmark"])
+    parser.add_argument(
+        "--max-lag", type=float, default=DEFAULT_MAX_LAG,
+        help="only refresh views whose oldest change is this old (s)")
+    parser.add_argument(
+        "--force", action="store_true",
+        help="refresh every view, changed or not")
+    parser.add_argument(
+        "--blocking", action="store_true",
+        help="refresh without CONCURRENTLY (faster, but blocks readers)")
+    parser.add_argument(
+        "--every", type=float,
+        help="keep refreshing, checking every this many seconds")
+    parser.add_argument("--iterations", type=int, default=DEFAULT_ITERATIONS)
+    args = parser.parse_args()
+
+    if args.command == "setup":
+        with connection() as conn:
+            setup(conn.cursor())
+        print_status()
+    elif args.command == "refresh":
+        while True:
+            refreshed = refresh_stale(
+                args.max_lag, args.force, not args.blocking)
+            for view, consumed in refreshed.items():
+                print("Refreshed", view, "-", consumed, "pending changes")
+            if args.every is None:
+                break
+            time.sleep(args.every)
+    elif args.command == "status":
+        print_status()
+    else:
+        benchmark(args.iterations)
+
+# command to type at the terminal in order to run our code is:
+# python3 sql_rollups.py setup
+# python3 sql_rollups.py refresh --max-lag 60 --every 10
+# python3 sql_rollups.py status
@@ -0,0 +1,170 @@
+# HOW TO READ ROWS WITHOUT PAYING FOR FULL ORM OBJECTS.
+
+# session.query(Track).all() builds a complete mapped Track for every row:
+# each one is tracked by the session's identity map & carries the state
+# the ORM needs to notice changes & lazy load relationships. Our scripts
+# only ever print the fields, so all of that is wasted memory & time.
+# read_only() takes the same ORM query & runs it for just the model's
+# columns, which skips the identity map & the attribute bookkeeping, and
+# hands back one of these much lighter rows:
+#   "row"        - SQLAlchemy's own Row (a tuple with named fields),
+#   "namedtuple" - a namedtuple made from the model's columns,
+#   "slots"      - a small read-only class with __slots__ for the columns.
+# All three are read the same way as the model, e.g. track.Name.
+import argparse
+import collections
+import functools
+import time
+import tracemalloc
+
+from sqlalchemy.orm import sessionmaker
+
+from sql_connection import get_engine
+from sql_models import Album, Artist, Track
+from sql_scaling import scale_tracks, unscale_tracks
+
+
+# The base class of the "slots" rows. With __slots__ there's no __dict__
+# per object, so each row is just the object header plus one pointer per
+# column, and setting an attribute after it's made is an error.
+class ReadOnlyRow:
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(
+            "{} is read-only".format(type(self).__name__))
+
+    def __iter__(self):
+        return (getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and tuple(self) == tuple(other)
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join(
+            "{}={!r}".format(name, getattr(self, name))
+            for name in self.__slots__))
+
+
+# The column names of a model, in table order, e.g. Artist -> ArtistId,
+# Name. Only real columns are included, never relationships.
+def column_names(model):
+    return [column.key for column in model.__table__.columns]
+
+
+# One row class per model & kind, built the first time it's asked for.
+@functools.lru_cache(maxsize=None)
+def namedtuple_class(model):
+    return collections.namedtuple(model.__name__ + "Row", column_names(model))
+
+
+@functools.lru_cache(maxsize=None)
+def slots_class(model):
+    return type(
+        model.__name__ + "Row", (ReadOnlyRow,),
+        {"__slots__": tuple(column_names(model))})
+
+
+# How to turn one Core Row into each kind of read-only row.
+ROW_FACTORIES = {
+    "row": lambda model: None,
+    "namedtuple": lambda model: namedtuple_class(model)._make,
+    "slots": lambda model: lambda row: slots_class(model)(*row),
+}
+
+
+# Run an ORM query for one model as a read-only query, e.g.
+#   tracks = read_only(session.query(Track).filter_by(Composer="Queen"))
+#   print(tracks[0].Name)
+# Filters, ordering & limits on the query are all kept. The rows are not
+# added to the session, can't be changed & don't load relationships.
+def read_only(query, kind="slots"):
+    model = query.column_descriptions[0]["entity"]
+    rows = query.with_entities(*model.__table__.columns)
+    make = ROW_FACTORIES[kind](model)
+    if make is None:
+        return rows.all()
+    return [make(row) for row in rows]
+
+
+# The same rows as generators over a server-side cursor, 'batch' at a
+# time, for tables too big to hold in memory at once.
+def iter_read_only(query, kind="slots", batch=1000):
+    model = query.column_descriptions[0]["entity"]
+    rows = query.with_entities(*model.__table__.columns).yield_per(batch)
+    make = ROW_FACTORIES[kind](model)
+    return iter(rows) if make is None else (make(row) for row in rows)
+
+
+# The normal way, for comparison.
+def full_objects(query):
+    return query.all()
+
+
+# Rows per second & bytes of Python memory still held per row once the
+# result has been built, for one way of reading 'model'.
+def measure(read, model, repeat):
+    Session = sessionmaker(get_engine())
+    best = None
+    for _ in range(repeat):
+        session = Session()
+        try:
+            started = time.perf_counter()
+            rows = read(session.query(model))
+            elapsed = time.perf_counter() - started
+        finally:
+            session.close()
+        best = elapsed if best is None else min(best, elapsed)
+
+    session = Session()
+    try:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        rows = read(session.query(model))
+        held = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+    finally:
+        session.close()
+    count = len(rows)
+    return count, count / best if best else 0, held / count if count else 0
+
+
+READERS = {
+    "orm objects": full_objects,
+    "core row": functools.partial(read_only, kind="row"),
+    "namedtuple": functools.partial(read_only, kind="namedtuple"),
+    "slots": functools.partial(read_only, kind="slots"),
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare full ORM objects with read-only rows.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--scale", type=int, default=1,
+        help="make the Track table this many times bigger first")
+    args = parser.parse_args()
+
+    offset = scale_tracks(args.scale) if args.scale > 1 else None
+    try:
+        print("Model", "Kind", "Rows", "Rows/s", "Bytes/row", sep=" | ")
+        for model in (Artist, Album, Track):
+            for kind, read in READERS.items():
+                count, rate, size = measure(read, model, args.repeat)
+                print(
+                    model.__name__, kind, count, "{:.0f}".format(rate),
+                    "{:.0f}".format(size), sep=" | ")
+    finally:
+        if offset is not None:
+            unscale_tracks(offset)
+
+# command to type at the terminal in order to run our code is:
+# python3 sql_rows.py --scale 10
@@ -0,0 +1,446 @@
+# HOW TO MAKE THE CHINOOK TABLES BIGGER FOR BENCHMARKING.
+
+# Chinook only has 3,503 tracks & 2,240 invoice lines, so every query we
+# run finishes in microseconds & none of our performance work can be
+# tested on anything like real data.
+# scale_tracks() is the quick way: it adds straight copies of "Track".
+# generate() is the realistic way: it grows "Artist", "Album", "Track",
+# "PlaylistTrack", "Invoice" & "InvoiceLine" to N times their size with
+# new rows that:
+#   - only point at rows that exist (every foreign key stays valid),
+#   - look like the real data: a few composers write most of the tracks,
+#     a few tracks get most of the sales, track lengths & genres follow
+#     the real ones, and so on,
+#   - are the same every time for the same seed, however many worker
+#     processes we use, so benchmark runs can be compared.
+# Each table is written with COPY by a pool of worker processes, one
+# chunk of new keys at a time.
+# NOTE: these all write to the database, so only use them against a
+# database you can rebuild (or use "reset" to remove the new rows).
+import argparse
+import bisect
+import datetime
+import io
+import itertools
+import multiprocessing
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from sql_connection import connection
+
+
+DEFAULT_SEED = 42
+# How many new keys one worker generates & COPYs in one go.
+CHUNK_SIZE = 20000
+
+# The largest key of each table in the original Chinook data. Anything
+# above these was added by generate(), which is how "reset" finds it.
+CHINOOK_MAX_IDS = {
+    "Artist": 275,
+    "Album": 347,
+    "Track": 3503,
+    "Invoice": 412,
+}
+
+# The columns we write, in the order they're declared in
+# Chinook_PostgreSql.sql.
+COLUMNS = {
+    "Artist": ["ArtistId", "Name"],
+    "Album": ["AlbumId", "Title", "ArtistId"],
+    "Track": [
+        "TrackId", "Name", "AlbumId", "MediaTypeId", "GenreId", "Composer",
+        "Milliseconds", "Bytes", "UnitPrice",
+    ],
+    "PlaylistTrack": ["PlaylistId", "TrackId"],
+    "Invoice": [
+        "InvoiceId", "CustomerId", "InvoiceDate", "BillingAddress",
+        "BillingCity", "BillingState", "BillingCountry", "BillingPostalCode",
+        "Total",
+    ],
+    "InvoiceLine": [
+        "InvoiceLineId", "InvoiceId", "TrackId", "UnitPrice", "Quantity",
+    ],
+}
+
+# How strongly popularity is skewed towards the top few: the n-th most
+# popular composer (or track) is picked about 1 / n ** skew as often as
+# the most popular one.
+COMPOSER_SKEW = 1.1
+TRACK_SKEW = 0.8
+
+# Chinook's invoices have 1, 2, 4, 6, 9 or 14 lines. Each new invoice's
+# lines get keys from a block of MAX_LINES, so any worker can work out
+# the keys of its lines without asking the others.
+LINES_PER_INVOICE = [1, 2, 4, 6, 9, 14]
+MAX_LINES = max(LINES_PER_INVOICE)
+
+
+# Everything the workers need to know about the existing data, read once
+# up front: the largest keys (before & after scaling), the values to pick
+# names from, and the distributions to copy.
+def read_profile(cursor, scale):
+    profile = {"max": {}, "new_max": {}}
+    for table in ("Artist", "Album", "Track", "Invoice"):
+        cursor.execute(
+            'SELECT coalesce(max("{0}Id"), 0), count(*) FROM "{0}"'
+            .format(table))
+        largest, count = cursor.fetchone()
+        profile["max"][table] = largest
+        profile["new_max"][table] = largest + count * (scale - 1)
+    cursor.execute(
+        'SELECT coalesce(max("InvoiceLineId"), 0) FROM "InvoiceLine"')
+    profile["max"]["InvoiceLine"] = cursor.fetchone()[0]
+    # Once sql_partitioning.py has partitioned "InvoiceLine" by date, each
+    # line carries a copy of its invoice's "InvoiceDate" too.
+    cursor.execute(
+        "SELECT count(*) FROM information_schema.columns "
+        "WHERE table_name = 'InvoiceLine' AND column_name = 'InvoiceDate'")
+    profile["line_dates"] = cursor.fetchone()[0] > 0
+
+    def column(query):
+        cursor.execute(query)
+        return [row[0] for row in cursor.fetchall()]
+
+    # Every list is read in key order, since without an ORDER BY the rows
+    # come back in whatever order the table or plan happens to have, which
+    # VACUUM or an update can change, and the same seed has to pick the
+    # same values every time.
+    profile["artist_names"] = column(
+        'SELECT "Name" FROM "Artist" ORDER BY "ArtistId"')
+    profile["album_titles"] = column(
+        'SELECT "Title" FROM "Album" ORDER BY "AlbumId"')
+    profile["track_names"] = column(
+        'SELECT "Name" FROM "Track" ORDER BY "TrackId"')
+    # Most prolific first, which is the order the skewed pick expects.
+    profile["composers"] = column(
+        'SELECT "Composer" FROM "Track" WHERE "Composer" IS NOT NULL '
+        'GROUP BY "Composer" ORDER BY count(*) DESC, "Composer"')
+    cursor.execute(
+        'SELECT avg(("Composer" IS NULL)::int), '
+        'avg(ln("Milliseconds")), stddev(ln("Milliseconds")), '
+        'avg("Bytes"::float / "Milliseconds") '
+        'FROM "Track" WHERE "Milliseconds" > 0')
+    (profile["no_composer"], profile["log_ms_mean"], profile["log_ms_sd"],
+     profile["bytes_per_ms"]) = [float(value) for value in cursor.fetchone()]
+
+    cursor.execute(
+        'SELECT "GenreId", count(*) FROM "Track" GROUP BY 1 ORDER BY 1')
+    genres = cursor.fetchall()
+    profile["genres"] = [genre for genre, _ in genres]
+    profile["genre_weights"] = list(
+        itertools.accumulate(count for _, count in genres))
+    cursor.execute(
+        'SELECT "MediaTypeId", count(*), '
+        'mode() WITHIN GROUP (ORDER BY "UnitPrice") '
+        'FROM "Track" GROUP BY 1 ORDER BY 1')
+    media_types = cursor.fetchall()
+    profile["media_types"] = [media for media, _, _ in media_types]
+    profile["media_weights"] = list(
+        itertools.accumulate(count for _, count, _ in media_types))
+    profile["media_prices"] = {
+        media: price for media, _, price in media_types}
+    cursor.execute(
+        'SELECT "TrackId", "UnitPrice" FROM "Track" WHERE "TrackId" <= %s',
+        [CHINOOK_MAX_IDS["Track"]])
+    profile["track_prices"] = dict(cursor.fetchall())
+
+    profile["playlists"] = column(
+        'SELECT "PlaylistId" FROM "Playlist" ORDER BY 1')
+    profile["playlists_per_track"] = column(
+        'SELECT count(pt."PlaylistId") FROM "Track" t '
+        'LEFT JOIN "PlaylistTrack" pt ON pt."TrackId" = t."TrackId" '
+        'WHERE t."TrackId" <= {} GROUP BY t."TrackId" '
+        'ORDER BY t."TrackId"'.format(
+            CHINOOK_MAX_IDS["Track"]))
+    cursor.execute(
+        'SELECT "CustomerId", "Address", "City", "State", "Country", '
+        '"PostalCode" FROM "Customer" ORDER BY 1')
+    profile["customers"] = cursor.fetchall()
+    cursor.execute(
+        'SELECT extract(epoch FROM min("InvoiceDate")), '
+        'extract(epoch FROM max("InvoiceDate")) FROM "Invoice"')
+    profile["first_invoice"], profile["last_invoice"] = [
+        float(value) for value in cursor.fetchone()]
+    return profile
+
+
+# Pick index 0..n-1, where index k comes up about 1 / (k + 1) ** skew as
+# often as index 0 (a continuous approximation of Zipf's law, which needs
+# no table of weights however big n is).
+def skewed_index(rng, n, skew):
+    u = rng.random()
+    if skew == 1:
+        x = (n + 1) ** u
+    else:
+        x = (u * ((n + 1) ** (1 - skew) - 1) + 1) ** (1 / (1 - skew))
+    return min(int(x) - 1, n - 1)
+
+
+# A fraction in [0, 1) that only depends on 'value', so every worker
+# agrees on it without sharing any state.
+def stable_fraction(value, salt):
+    return ((value * 2654435761 + salt * 40503) % 4294967296) / 4294967296
+
+
+# The media type of a new track depends only on its key, so a worker
+# writing invoice lines knows its price without seeing the "Track" rows.
+def track_media_type(profile, track_id):
+    weights = profile["media_weights"]
+    position = stable_fraction(track_id, 1) * weights[-1]
+    return profile["media_types"][bisect.bisect_right(weights, position)]
+
+
+def track_price(profile, track_id):
+    if track_id in profile["track_prices"]:
+        return profile["track_prices"][track_id]
+    return profile["media_prices"][track_media_type(profile, track_id)]
+
+
+# The rows for one chunk of new keys, as {table: [row, ...]}.
+def artist_rows(rng, ids, profile):
+    return {"Artist": [
+        (artist_id, "{} {}".format(
+            rng.choice(profile["artist_names"]), artist_id))
+        for artist_id in ids
+    ]}
+
+
+def album_rows(rng, ids, profile):
+    artists = profile["new_max"]["Artist"]
+    return {"Album": [
+        (album_id, rng.choice(profile["album_titles"]),
+         rng.randint(1, artists))
+        for album_id in ids
+    ]}
+
+
+# New tracks, plus the playlists they're on. A new track can only be on
+# each playlist once, so ("PlaylistId", "TrackId") stays unique.
+def track_rows(rng, ids, profile):
+    albums = profile["new_max"]["Album"]
+    composers = profile["composers"]
+    tracks, playlist_tracks = [], []
+    for track_id in ids:
+        composer = None
+        if rng.random() >= profile["no_composer"]:
+            composer = composers[
+                skewed_index(rng, len(composers), COMPOSER_SKEW)]
+        milliseconds = int(rng.lognormvariate(
+            profile["log_ms_mean"], profile["log_ms_sd"]))
+        tracks.append((
+            track_id,
+            rng.choice(profile["track_names"]),
+            rng.randint(1, albums),
+            track_media_type(profile, track_id),
+            profile["genres"][bisect.bisect_right(
+                profile["genre_weights"],
+                rng.random() * profile["genre_weights"][-1])],
+            composer,
+            milliseconds,
+            int(milliseconds * profile["bytes_per_ms"]
+                * rng.uniform(0.8, 1.2)),
+            track_price(profile, track_id),
+        ))
+        on = min(
+            rng.choice(profile["playlists_per_track"]),
+            len(profile["playlists"]))
+        for playlist_id in rng.sample(profile["playlists"], on):
+            playlist_tracks.append((playlist_id, track_id))
+    return {"Track": tracks, "PlaylistTrack": playlist_tracks}
+
+
+# New invoices & their lines. Most lines are for the most popular tracks,
+# and each invoice's "Total" is the sum of its lines.
+def invoice_rows(rng, ids, profile):
+    tracks = profile["new_max"]["Track"]
+    span = profile["last_invoice"] - profile["first_invoice"]
+    invoices, lines = [], []
+    for invoice_id in ids:
+        customer_id, address, city, state, country, postal_code = (
+            rng.choice(profile["customers"]))
+        total = 0
+        first_line = profile["max"]["InvoiceLine"] + 1 + MAX_LINES * (
+            invoice_id - profile["max"]["Invoice"] - 1)
+        invoice_lines = []
+        for number in range(rng.choice(LINES_PER_INVOICE)):
+            track_id = skewed_index(rng, tracks, TRACK_SKEW) + 1
+            price = track_price(profile, track_id)
+            total += price
+            invoice_lines.append(
+                (first_line + number, invoice_id, track_id, price, 1))
+        invoice_date = datetime.datetime(1970, 1, 1) + datetime.timedelta(
+            seconds=int(profile["first_invoice"] + rng.random() * span))
+        if profile["line_dates"]:
+            invoice_lines = [line + (invoice_date,) for line in invoice_lines]
+        lines.extend(invoice_lines)
+        invoices.append((
+            invoice_id,
+            customer_id,
+            invoice_date,
+            address, city, state, country, postal_code,
+            "{:.2f}".format(total),
+        ))
+    return {"Invoice": invoices, "InvoiceLine": lines}
+
+
+# The order the tables have to be filled in, so every foreign key points
+# at a row that's already there, & what generates each one's rows.
+STAGES = {
+    "Artist": artist_rows,
+    "Album": album_rows,
+    "Track": track_rows,
+    "Invoice": invoice_rows,
+}
+
+
+# One value in the COPY text format, where NULL is written as \N &
+# backslashes, tabs and newlines are escaped (see sql-copy-loader.py).
+def copy_value(value):
+    if value is None:
+        return "\\N"
+    return (
+        str(value).replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def copy_rows(cursor, table, rows, columns=None):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(copy_value(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+    cursor.copy_expert('COPY "{}" ({}) FROM STDIN'.format(
+        table, ", ".join('"{}"'.format(c) for c in columns or COLUMNS[table])),
+        buffer)
+
+
+# What each worker process runs: generate one chunk of keys & COPY it in.
+# The random generator is seeded from the seed, the table & the chunk, so
+# a chunk always gets the same rows whichever worker ends up writing it.
+def load_chunk(job):
+    stage, start, stop, seed, profile = job
+    rng = random.Random("{}:{}:{}".format(seed, stage, start))
+    tables = STAGES[stage](rng, range(start, stop), profile)
+    with connection() as conn:
+        cursor = conn.cursor()
+        for table, rows in tables.items():
+            columns = COLUMNS[table]
+            if table == "InvoiceLine" and profile["line_dates"]:
+                columns = columns + ["InvoiceDate"]
+            copy_rows(cursor, table, rows, columns)
+    return sum(len(rows) for rows in tables.values())
+
+
+# Grow the tables to 'scale' times their current size.
+def generate(scale, seed=DEFAULT_SEED, workers=None,
+             chunk_size=CHUNK_SIZE):
+    with connection() as conn:
+        profile = read_profile(conn.cursor(), scale)
+
+    # "spawn" starts each worker from scratch, so none of them inherit the
+    # parent's pooled connections.
+    context = multiprocessing.get_context("spawn")
+    print("Table(s)", "Rows", "Seconds", "Rows/s", sep=" | ")
+    with ProcessPoolExecutor(
+            workers or os.cpu_count(), mp_context=context) as executor:
+        for stage in STAGES:
+            first = profile["max"][stage] + 1
+            last = profile["new_max"][stage]
+            jobs = [
+                (stage, start, min(start + chunk_size, last + 1), seed,
+                 profile)
+                for start in range(first, last + 1, chunk_size)
+            ]
+            started = time.perf_counter()
+            rows = sum(executor.map(load_chunk, jobs))
+            elapsed = time.perf_counter() - started
+            print(
+                " & ".join(STAGES[stage](random.Random(), [], profile)),
+                rows,
+                "{:.2f}".format(elapsed),
+                "{:.0f}".format(rows / elapsed if elapsed else 0),
+                sep=" | "
+            )
+
+    with connection() as conn:
+        cursor = conn.cursor()
+        for table in COLUMNS:
+            cursor.execute('ANALYZE "{}"'.format(table))
+
+
+# Delete every row generate() added, children before parents.
+def reset():
+    with connection() as conn:
+        cursor = conn.cursor()
+        for table, column, key in (
+            ("InvoiceLine", "InvoiceId", "Invoice"),
+            ("PlaylistTrack", "TrackId", "Track"),
+            ("Invoice", "InvoiceId", "Invoice"),
+            ("Track", "TrackId", "Track"),
+            ("Album", "AlbumId", "Album"),
+            ("Artist", "ArtistId", "Artist"),
+        ):
+            cursor.execute(
+                'DELETE FROM "{}" WHERE "{}" > %s'.format(table, column),
+                [CHINOOK_MAX_IDS[key]])
+            print("Deleted", cursor.rowcount, "rows from", table)
+        for table in COLUMNS:
+            cursor.execute('ANALYZE "{}"'.format(table))
+
+
+# Add (scale - 1) extra copies of every track, with new TrackIds, so the
+# "Track" table is 'scale' times its normal size.
+def scale_tracks(scale):
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT max("TrackId") FROM "Track"')
+        offset = cursor.fetchone()[0]
+        cursor.execute("""
+            INSERT INTO "Track" ("TrackId", "Name", "AlbumId", "MediaTypeId",
+                "GenreId", "Composer", "Milliseconds", "Bytes", "UnitPrice")
+            SELECT t."TrackId" + c.n * %(offset)s, t."Name", t."AlbumId",
+                t."MediaTypeId", t."GenreId", t."Composer",
+                t."Milliseconds", t."Bytes", t."UnitPrice"
+            FROM "Track" t, generate_series(1, %(copies)s) AS c(n)
+            WHERE t."TrackId" <= %(offset)s
+        """, {"offset": offset, "copies": scale - 1})
+        cursor.execute('ANALYZE "Track"')
+    return offset
+
+
+# Delete the copies added by scale_tracks().
+def unscale_tracks(offset):
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            'DELETE FROM "Track" WHERE "TrackId" > %s', [offset])
+        cursor.execute('ANALYZE "Track"')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Grow the Chinook tables with realistic fake data.")
+    parser.add_argument("command", choices=["generate", "reset"])
+    parser.add_argument(
+        "--scale", type=int, default=100,
+        help="make the tables this many times their current size")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        started = time.perf_counter()
+        generate(args.scale, args.seed, args.workers, args.chunk_size)
+        print("Done in {:.1f}s".format(time.perf_counter() - started))
+    else:
+        reset()
+
+# command to type at the terminal in order to run our code is:
+# python3 sql_scaling.py generate --scale 100 --seed 42 --workers 8
+# python3 sql_scaling.py reset
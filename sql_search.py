@@ -0,0 +1,241 @@
+# HOW TO SEARCH TRACKS & ARTISTS BY WORDS, NOT JUST BY EXACT VALUES.
+
+# Our queries only ever find exact matches: filter_by(Composer="Queen")
+# never finds a track whose Composer is "Queen, Freddie Mercury", and
+#   WHERE "Composer" LIKE '%Queen%'
+# has to read every row of "Track", because a normal index can't help
+# with a pattern that starts with %.
+# This module adds two kinds of search index:
+#   - full-text: a "SearchVector" column (a tsvector, i.e. the list of
+#     words in the Name & Composer) with a GIN index, so a search for
+#     "freddie queen" finds every row containing both words.
+#   - fuzzy: pg_trgm indexes on the text itself, so misspellings like
+#     "Quen" or "Mercuri" still find a close match.
+# search() (psycopg2) & search_orm() (the ORM) run both at once & rank
+# the results, best match first.
+import argparse
+import time
+
+from sqlalchemy import desc, func, literal, literal_column, or_
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import sessionmaker
+
+from sql_connection import connection, get_engine
+from sql_models import Artist, Track
+from sql_scaling import scale_tracks, unscale_tracks
+
+
+# 'simple' splits text into lower-case words without stemming them or
+# dropping "stop words", which suits names better than 'english' does.
+SEARCH_CONFIG = "simple"
+
+DEFAULT_LIMIT = 20
+
+# How each table's "SearchVector" is worked out. Matches on a track's
+# Name (weight A) rank higher than matches on its Composer (weight B).
+SEARCH_VECTORS = {
+    Track: "setweight(to_tsvector('simple', coalesce(\"Name\", '')), 'A') "
+           "|| setweight(to_tsvector('simple', coalesce(\"Composer\", '')), "
+           "'B')",
+    Artist: "to_tsvector('simple', coalesce(\"Name\", ''))",
+}
+
+# The models we can search & the text columns their fuzzy search uses.
+SEARCH_COLUMNS = {
+    Track: [Track.Name, Track.Composer],
+    Artist: [Artist.Name],
+}
+
+# The same searches as plain SQL for the psycopg2 path. A row matches if
+# it contains every word of the search (@@), or if the search is close to
+# a word in one of its columns (<% is pg_trgm's "word similarity"). The
+# two scores are added together for the ranking. %% is how we write a
+# literal % when using psycopg2 placeholders.
+SEARCHES = {
+    "tracks": """
+        SELECT t."TrackId", t."Name", t."Composer",
+            ts_rank_cd(t."SearchVector", query)
+            + greatest(word_similarity(%(term)s, t."Name"),
+                word_similarity(%(term)s, coalesce(t."Composer", '')))
+            AS rank
+        FROM "Track" t, websearch_to_tsquery('simple', %(term)s) AS query
+        WHERE t."SearchVector" @@ query
+            OR %(term)s <%% t."Name"
+            OR %(term)s <%% t."Composer"
+        ORDER BY rank DESC, t."TrackId"
+        LIMIT %(limit)s
+    """,
+    "artists": """
+        SELECT a."ArtistId", a."Name",
+            ts_rank_cd(a."SearchVector", query)
+            + word_similarity(%(term)s, a."Name") AS rank
+        FROM "Artist" a, websearch_to_tsquery('simple', %(term)s) AS query
+        WHERE a."SearchVector" @@ query
+            OR %(term)s <%% a."Name"
+        ORDER BY rank DESC, a."ArtistId"
+        LIMIT %(limit)s
+    """,
+}
+
+# The LIKE scan that the searches replace, for the benchmark.
+LIKE_SEARCHES = {
+    "tracks": """
+        SELECT "TrackId", "Name", "Composer"
+        FROM "Track"
+        WHERE "Name" ILIKE %(pattern)s OR "Composer" ILIKE %(pattern)s
+        LIMIT %(limit)s
+    """,
+    "artists": """
+        SELECT "ArtistId", "Name"
+        FROM "Artist"
+        WHERE "Name" ILIKE %(pattern)s
+        LIMIT %(limit)s
+    """,
+}
+
+
+# Add the "SearchVector" columns (which Postgres fills in itself whenever
+# a row is written), their GIN indexes & the trigram indexes. Safe to run
+# more than once.
+def setup(cursor):
+    cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    for model, columns in SEARCH_COLUMNS.items():
+        table = model.__table__
+        cursor.execute(
+            'ALTER TABLE "{}" ADD COLUMN IF NOT EXISTS "SearchVector" '
+            "tsvector GENERATED ALWAYS AS ({}) STORED".format(
+                table.name, SEARCH_VECTORS[model]))
+        cursor.execute(
+            'CREATE INDEX IF NOT EXISTS "IX_{0}SearchVector" '
+            'ON "{0}" USING gin ("SearchVector")'.format(table.name))
+        # The same names sql-index-advisor.py uses, so it can tell they're
+        # already there.
+        for column in columns:
+            cursor.execute(
+                'CREATE INDEX IF NOT EXISTS "ITRGM_{0}{1}" '
+                'ON "{0}" USING gin ("{1}" gin_trgm_ops)'.format(
+                    table.name, column.key))
+        cursor.execute('ANALYZE "{}"'.format(table.name))
+
+
+# Search "tracks" or "artists" through psycopg2 & return the rows, each
+# with its rank last.
+def search(kind, term, limit=DEFAULT_LIMIT, cursor=None):
+    if cursor is not None:
+        cursor.execute(SEARCHES[kind], {"term": term, "limit": limit})
+        return cursor.fetchall()
+    with connection() as conn:
+        return search(kind, term, limit, conn.cursor())
+
+
+# The "SearchVector" column of a model's table. It isn't part of the
+# models themselves, so it's never loaded by a normal query (and the
+# models still work on a database that hasn't had setup() run).
+def search_vector(model):
+    return literal_column(
+        '"{}"."SearchVector"'.format(model.__table__.name), TSVECTOR)
+
+
+# The same search through the ORM, returning [(object, rank)], e.g.
+#   for track, rank in search_orm(session, Track, "freddie mercury"):
+#       print(track.Name, rank)
+def search_orm(session, model, term, limit=DEFAULT_LIMIT):
+    columns = SEARCH_COLUMNS[model]
+    query = func.websearch_to_tsquery(SEARCH_CONFIG, term)
+    similarity = [
+        func.word_similarity(term, func.coalesce(column, ""))
+        for column in columns
+    ]
+    vector = search_vector(model)
+    rank = func.ts_rank_cd(vector, query) + (
+        similarity[0] if len(similarity) == 1 else func.greatest(*similarity))
+    primary_key = model.__table__.primary_key.columns.values()[0]
+    return (
+        session.query(model, rank.label("rank"))
+        .filter(or_(
+            vector.op("@@")(query),
+            *[literal(term).op("<%")(column) for column in columns]))
+        .order_by(desc("rank"), primary_key)
+        .limit(limit)
+        .all()
+    )
+
+
+# Search with LIKE '%term%' the way we would without these indexes. The
+# index scans are switched off for this one transaction, so we measure
+# the full table scan even once the trigram indexes exist.
+def like_search(kind, term, limit=DEFAULT_LIMIT):
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SET LOCAL enable_bitmapscan = off")
+        cursor.execute("SET LOCAL enable_indexscan = off")
+        cursor.execute(
+            LIKE_SEARCHES[kind], {"pattern": "%" + term + "%", "limit": limit})
+        return cursor.fetchall()
+
+
+def fastest(run, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        rows = run()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000, len(rows)
+
+
+def benchmark(terms, repeat, limit):
+    Session = sessionmaker(get_engine())
+    session = Session()
+    try:
+        print("Term", "Path", "ms", "Rows", sep=" | ")
+        for term in terms:
+            paths = {
+                "LIKE scan": lambda: like_search("tracks", term, limit),
+                "search (psycopg2)": lambda: search("tracks", term, limit),
+                "search (ORM)": lambda: search_orm(
+                    session, Track, term, limit),
+            }
+            for path, run in paths.items():
+                elapsed, rows = fastest(run, repeat)
+                print(term, path, "{:.3f}".format(elapsed), rows, sep=" | ")
+                session.expunge_all()
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Set up & benchmark full-text & fuzzy search.")
+    parser.add_argument("command", choices=["setup", "search", "benchmark"])
+    parser.add_argument(
+        "terms", nargs="*", default=["Queen", "freddie mercury", "Mercuri"])
+    parser.add_argument(
+        "--kind", choices=list(SEARCHES), default="tracks")
+    parser.add_argument("--limit", type=int, default=DEFAULT_LIMIT)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--scale", type=int, default=10,
+        help="benchmark on a Track table this many times its normal size")
+    args = parser.parse_args()
+
+    if args.command == "setup":
+        with connection() as conn:
+            setup(conn.cursor())
+        print("Search columns & indexes are ready.")
+    elif args.command == "search":
+        for term in args.terms:
+            for row in search(args.kind, term, args.limit):
+                print(*row, sep=" | ")
+    else:
+        offset = scale_tracks(args.scale) if args.scale > 1 else None
+        try:
+            benchmark(args.terms, args.repeat, args.limit)
+        finally:
+            if offset is not None:
+                unscale_tracks(offset)
+
+# command to type at the terminal in order to run our code is:
+# python3 sql_search.py setup
+# python3 sql_search.py search "freddie mercury" --kind tracks
+# python3 sql_search.py benchmark Queen Mercuri --scale 10
@@ -0,0 +1,218 @@
+# HOW TO START A SCRIPT QUICKLY & ONLY CHANGE THE SCHEMA WHEN ASKED TO.
+
+# Every time sql-orm.py or sql-crud.py started, it ran
+#   base.metadata.create_all(db)
+# which connects straight away & asks Postgres's catalog whether each of
+# our tables exists, before the script has run a single query of its own.
+# Short-lived workers paid for that (and for importing SQLAlchemy's ORM
+# even when they only used psycopg2) on every job.
+# Now:
+#   - the tables are only created by "python3 sql_startup.py migrate",
+#     which is run once per deployment rather than once per process,
+#   - sql_connection.py only imports SQLAlchemy or psycopg2.pool, and only
+#     connects, when an engine, pool or connection is first used,
+#   - Core scripts that reflect their tables from the database can load
+#     them from an on-disk cache instead, with load_metadata().
+# "python3 sql_startup.py measure" times each way of starting up, from a
+# brand new Python process to the first row of the first query.
+import argparse
+import hashlib
+import os
+import pickle
+import subprocess
+import sys
+import time
+
+from sql_connection import DATABASE_URL, connection, get_engine
+
+
+# Where the reflected metadata is cached. There's one file per database
+# URL & SQLAlchemy version, since a pickle from another version of
+# SQLAlchemy may not load.
+METADATA_CACHE_DIR = os.environ.get(
+    "CHINOOK_METADATA_CACHE", os.path.expanduser("~/.cache/chinook"))
+
+
+def metadata_cache_path():
+    import sqlalchemy
+
+    key = hashlib.sha1(
+        "{} {}".format(DATABASE_URL, sqlalchemy.__version__).encode())
+    return os.path.join(
+        METADATA_CACHE_DIR, "metadata-{}.pickle".format(key.hexdigest()[:16]))
+
+
+# A checksum of our schema: every table, view & index with its columns,
+# plus every constraint. Tables made again (e.g. by sql_partitioning.py's
+# migrate) get new oids, so they change it too. It's one quick query on
+# the catalog, where reflecting everything takes dozens, and it means
+# schema changes made by any of our scripts (sql_partitioning.py,
+# sql_search.py, sql_rollups.py, ...) are noticed without them having to
+# remember to clear the cache.
+SCHEMA_FINGERPRINT = """
+    SELECT md5(
+        coalesce((
+            SELECT string_agg(
+                c.oid || ' ' || c.relname || ' ' || c.relkind || ' '
+                || coalesce(a.attname || ' ' || a.atttypid, ''),
+                ',' ORDER BY c.oid, a.attnum)
+            FROM pg_class c
+            LEFT JOIN pg_attribute a
+                ON a.attrelid = c.oid AND a.attnum > 0
+                AND NOT a.attisdropped
+            WHERE c.relnamespace = current_schema()::regnamespace
+            AND c.relkind IN ('r', 'p', 'v', 'm', 'i', 'f')
+        ), '')
+        || coalesce((
+            SELECT string_agg(oid::text, ',' ORDER BY oid)
+            FROM pg_constraint
+            WHERE connamespace = current_schema()::regnamespace
+        ), ''))
+"""
+
+
+def schema_fingerprint():
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(SCHEMA_FINGERPRINT)
+        return cursor.fetchone()[0]
+
+
+# Throw the cached metadata away, e.g. to force it to be reflected again.
+def clear_metadata_cache():
+    try:
+        os.remove(metadata_cache_path())
+    except FileNotFoundError:
+        pass
+
+
+# The tables of our database as a MetaData, e.g.
+#   track_table = load_metadata().tables["Track"]
+# Reflecting them means a round of catalog queries, so the result is
+# pickled to disk the first time, along with the schema's fingerprint.
+# Every later process only asks for the fingerprint & reads the file back,
+# unless the schema has changed since, when it's reflected again.
+def load_metadata(refresh=False):
+    from sqlalchemy import MetaData
+
+    path = metadata_cache_path()
+    fingerprint = schema_fingerprint()
+    if not refresh:
+        try:
+            with open(path, "rb") as cache:
+                cached_fingerprint, meta = pickle.load(cache)
+            if cached_fingerprint == fingerprint:
+                return meta
+        except (OSError, EOFError, pickle.UnpicklingError, TypeError,
+                ValueError):
+            pass
+    meta = MetaData()
+    meta.reflect(get_engine())
+    # Written to a temporary file & then renamed, so a worker starting at
+    # the same moment never reads half a file.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = "{}.{}".format(path, os.getpid())
+    with open(temporary, "wb") as cache:
+        pickle.dump((fingerprint, meta), cache, pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, path)
+    return meta
+
+
+# Create any of our tables that don't exist yet (what every script used
+# to do when it started), then re-reflect the cached metadata so it
+# matches the schema we've just made.
+def migrate():
+    from sql_models import base
+
+    base.metadata.create_all(get_engine())
+    return load_metadata(refresh=True)
+
+
+# What a fresh worker process runs to get its first row, for each way of
+# starting up. "eager" is how sql-orm.py used to start.
+STARTUPS = {
+    "eager (ORM + create_all)": """
+from sqlalchemy.orm import sessionmaker
+from sql_connection import get_engine
+from sql_models import base, Artist
+db = get_engine()
+base.metadata.create_all(db)
+print(sessionmaker(db)().query(Artist).first())
+""",
+    "lazy (ORM)": """
+from sqlalchemy.orm import sessionmaker
+from sql_connection import get_engine
+from sql_models import Artist
+print(sessionmaker(get_engine())().query(Artist).first())
+""",
+    "reflected (Core)": """
+from sqlalchemy import MetaData
+from sql_connection import get_engine
+meta = MetaData()
+meta.reflect(get_engine(), only=["Artist"])
+with get_engine().connect() as conn:
+    print(conn.execute(meta.tables["Artist"].select().limit(1)).first())
+""",
+    "cached metadata (Core)": """
+from sql_connection import get_engine
+from sql_startup import load_metadata
+artist_table = load_metadata().tables["Artist"]
+with get_engine().connect() as conn:
+    print(conn.execute(artist_table.select().limit(1)).first())
+""",
+    "lazy (psycopg2)": """
+from sql_connection import connection
+with connection() as conn:
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM "Artist" LIMIT 1')
+    print(cursor.fetchone())
+""",
+}
+
+
+# Seconds from starting a new Python process to it having printed the
+# first row, best of 'repeat'. That includes Python's own start up, which
+# our short-lived workers pay for too.
+def time_to_first_query(code, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-c", code], check=True,
+            stdout=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def measure(repeat):
+    # The cached path needs something in the cache to read.
+    load_metadata()
+    print("Startup", "Time to first query ms", sep=" | ")
+    for name, code in STARTUPS.items():
+        print(
+            name, "{:.1f}".format(time_to_first_query(code, repeat) * 1000),
+            sep=" | ")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Create our tables, or time how quickly scripts start.")
+    parser.add_argument("command", choices=["migrate", "clear", "measure"])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        meta = migrate()
+        print("Tables are up to date; cached metadata for {} tables.".format(
+            len(meta.tables)))
+    elif args.command == "clear":
+        clear_metadata_cache()
+        print("Cleared", metadata_cache_path())
+    else:
+        measure(args.repeat)
+
+# command to type at the terminal in order to run our code is:
+# python3 sql_startup.py migrate   (once, before running sql-orm.py)
+# python3 sql_startup.py measure --repeat 5
@@ -0,0 +1,101 @@
+# HOW TO STREAM LARGE RESULT SETS INSTEAD OF FETCHING EVERYTHING AT ONCE.
+
+# cursor.fetchall() pulls every row of a query into Python before we can
+# look at the first one, so a big table like "PlaylistTrack" or
+# "InvoiceLine" needs all of its rows in memory at the same time.
+# A named (server-side) cursor keeps the result on the Postgres server &
+# hands it over 'itersize' rows at a time as we loop over it, so the time
+# to the first row & the memory we use stay the same however big the
+# table gets.
+import itertools
+import sys
+import time
+import tracemalloc
+
+from sql_connection import connection, get_engine
+
+
+# How many rows are fetched from the server in each round trip.
+DEFAULT_ITERSIZE = 2000
+
+# Every named cursor on a connection needs its own unique name.
+_cursor_names = itertools.count(1)
+
+
+# Run a raw SQL query through psycopg2 & yield its rows one at a time.
+# The pooled connection is held for as long as we keep looping, and is
+# handed back as soon as the loop finishes (or we stop early).
+def stream_query(query, params=None, itersize=DEFAULT_ITERSIZE):
+    with connection() as conn:
+        name = "chinook_stream_{}".format(next(_cursor_names))
+        with conn.cursor(name=name) as cursor:
+            cursor.itersize = itersize
+            cursor.execute(query, params)
+            for row in cursor:
+                yield row
+
+
+# The same thing for a SQLAlchemy Core statement, e.g. track_table.select().
+# stream_results asks the psycopg2 driver for a server-side cursor &
+# max_row_buffer caps how many rows are buffered in Python at once.
+def stream_statement(statement, yield_per=DEFAULT_ITERSIZE):
+    with get_engine().connect() as conn:
+        result = conn.execution_options(
+            stream_results=True, max_row_buffer=yield_per
+        ).execute(statement)
+        for row in result:
+            yield row
+
+
+# The same thing for an ORM query, e.g. session.query(Track). yield_per()
+# builds the mapped objects in batches instead of all at once, and turns
+# on stream_results for us behind the scenes.
+def stream_orm(query, yield_per=DEFAULT_ITERSIZE):
+    return query.yield_per(yield_per)
+
+
+# Measure how long it takes to see the first row & how much Python memory
+# is used at the peak, for the normal fetchall() and for streaming.
+def measure(rows_factory):
+    tracemalloc.start()
+    started = time.perf_counter()
+    first_row = None
+    count = 0
+    for _ in rows_factory():
+        if first_row is None:
+            first_row = time.perf_counter() - started
+        count += 1
+    total = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return count, first_row or 0, total, peak
+
+
+def fetch_all(query):
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query)
+        return cursor.fetchall()
+
+
+if __name__ == "__main__":
+    table = sys.argv[1] if len(sys.argv) > 1 else "PlaylistTrack"
+    query = 'SELECT * FROM "{}"'.format(table)
+
+    print("Mode", "Rows", "First row (s)", "Total (s)", "Peak KiB", sep=" | ")
+    for mode, rows_factory in (
+        ("fetchall", lambda: fetch_all(query)),
+        ("stream", lambda: stream_query(query)),
+    ):
+        count, first_row, total, peak = measure(rows_factory)
+        print(
+            mode,
+            count,
+            "{:.4f}".format(first_row),
+            "{:.4f}".format(total),
+            peak // 1024,
+            sep=" | "
+        )
+
+# command to type at the terminal in order to run our code is:
+# python3 sql_streaming.py PlaylistTrack